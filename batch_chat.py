@@ -0,0 +1,79 @@
+"""
+Runs a JSON lines file of chat requests through the chat pipeline and writes the results as JSON lines.
+
+    # In-process, against the database and settings of this checkout
+    python batch_chat.py eval_set.jsonl results.jsonl
+
+    # Include the detected intent, retrieved context and prompt of every turn
+    python batch_chat.py eval_set.jsonl results.jsonl --debug
+
+    # Through a running server's batch endpoint (requires httpx)
+    python batch_chat.py eval_set.jsonl results.jsonl --base-url http://127.0.0.1:8008
+
+Each input line is a ChatRequest, as posted to /api/v1/carton_caps/chat. Each output line is a
+BatchChatResult: the input line number plus the slim chat response, or an error. Results are
+written as turns finish, not in input order. Turns are recorded in the conversation history like
+any other, so point CARTON_CAPS_DB_PATH at a copy of the database for evaluation runs.
+"""
+import argparse
+import asyncio
+import sys
+import time
+from typing import AsyncIterator, IO
+
+BATCH_ENDPOINT = "/api/v1/carton_caps/chat/batch"
+
+
+async def read_lines(path: str) -> AsyncIterator[str]:
+    with (sys.stdin if path == "-" else open(path, encoding="utf-8")) as f:
+        for line in f:
+            yield line
+
+
+async def run_in_process(args: argparse.Namespace, output: IO[str]) -> int:
+    import main as service
+
+    written = 0
+    async with service.lifespan(service.app):
+        async for result in service.run_chat_batch(read_lines(args.input), args.debug):
+            output.write(result.model_dump_json(exclude_none=True) + "\n")
+            written += 1
+    return written
+
+
+async def run_over_http(args: argparse.Namespace, output: IO[str]) -> int:
+    import httpx
+
+    with (sys.stdin.buffer if args.input == "-" else open(args.input, "rb")) as f:
+        body = f.read()
+    written = 0
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout) as client:
+        async with client.stream("POST", BATCH_ENDPOINT, params={"debug": str(args.debug).lower()}, content=body,
+                                 headers={"Content-Type": "application/x-ndjson"}) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line:
+                    output.write(line + "\n")
+                    written += 1
+    return written
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run a JSON lines file of chat requests through the Carton Caps chat pipeline.")
+    parser.add_argument("input", help="JSON lines of ChatRequests ('-' for stdin)")
+    parser.add_argument("output", help="Where to write JSON lines of results ('-' for stdout)")
+    parser.add_argument("--debug", action="store_true", help="Include debug info (intent, retrieved context, prompt)")
+    parser.add_argument("--base-url", help="Send the batch to a running server instead of running it in-process")
+    parser.add_argument("--timeout", type=float, default=3600.0, help="With --base-url, seconds to wait for the whole batch")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with (sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")) as output:
+        runner = run_over_http if args.base_url else run_in_process
+        written = asyncio.run(runner(args, output))
+    elapsed = time.perf_counter() - started
+    print(f"Wrote {written} results in {elapsed:.1f}s ({written / elapsed:.1f} turns/s).", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
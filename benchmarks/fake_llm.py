@@ -0,0 +1,129 @@
+"""
+Local stand-in for the Gemini API, for benchmarks and offline development.
+
+`install_fake_llm()` makes the service's LLM gateway use a fake model instead of
+`genai.GenerativeModel`. It answers after a configurable delay (time to first token plus a
+per-token rate), so runs measure the service itself instead of the network and the API quota.
+Streaming is supported.
+
+    # Serve the app on :8008 with the fake LLM (load test it with --base-url)
+    python benchmarks/fake_llm.py --port 8008 --ttft-ms 300 --tokens-per-second 80
+
+Used in-process by `load_test.py --in-process --fake-llm`.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+from dataclasses import dataclass
+from typing import List, Any, AsyncIterator
+
+_REPLY_WORDS = (
+    "Carton Caps helps your school earn with every purchase. Here is what I found for you, "
+    "based on the products and referral details available right now. Let me know if you would "
+    "like more suggestions or help inviting a friend."
+).split()
+
+
+@dataclass
+class FakeLLMConfig:
+    ttft_ms: float = 300.0  # Time to first token
+    tokens_per_second: float = 80.0  # Generation rate after the first token
+    reply_words: int = 60
+    jitter: float = 0.2  # Latency is scaled by a random factor in [1 - jitter, 1 + jitter]
+    words_per_chunk: int = 8  # Streaming chunk size
+    error_rate: float = 0.0  # Fraction of calls that raise, to exercise error paths
+
+
+class _Part:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _Response:
+    def __init__(self, text: str):
+        self.parts = [_Part(text)]
+
+
+class _StreamingResponse:
+    def __init__(self, chunks: List[str], chunk_delay: float):
+        self._chunks = chunks
+        self._chunk_delay = chunk_delay
+
+    async def __aiter__(self) -> AsyncIterator[_Response]:
+        for index, chunk in enumerate(self._chunks):
+            if index:
+                await asyncio.sleep(self._chunk_delay)
+            yield _Response(chunk)
+
+
+class FakeGenerativeModel:
+    """Mimics the parts of `genai.GenerativeModel` the service uses."""
+
+    config = FakeLLMConfig()
+    calls = 0
+
+    def __init__(self, model_name: str, *args: Any, **kwargs: Any):
+        self.model_name = model_name
+
+    def _reply_chunks(self) -> List[str]:
+        cfg = self.config
+        words = [_REPLY_WORDS[i % len(_REPLY_WORDS)] for i in range(cfg.reply_words)]
+        step = max(1, cfg.words_per_chunk)
+        return [" ".join(words[i:i + step]) + " " for i in range(0, len(words), step)]
+
+    def _scaled(self, seconds: float) -> float:
+        jitter = self.config.jitter
+        return seconds * random.uniform(1 - jitter, 1 + jitter) if jitter else seconds
+
+    async def generate_content_async(self, prompt: str, stream: bool = False, **kwargs: Any) -> Any:
+        cfg = self.config
+        type(self).calls += 1
+        await asyncio.sleep(self._scaled(cfg.ttft_ms / 1000))
+        if cfg.error_rate and random.random() < cfg.error_rate:
+            raise RuntimeError("Fake LLM injected error")
+        chunks = self._reply_chunks()
+        # Approximate one token per word for the generation delay
+        chunk_delay = self._scaled(max(1, cfg.words_per_chunk) / cfg.tokens_per_second) if cfg.tokens_per_second > 0 else 0.0
+        if stream:
+            return _StreamingResponse(chunks, chunk_delay)
+        await asyncio.sleep(chunk_delay * max(0, len(chunks) - 1))
+        return _Response("".join(chunks))
+
+
+def install_fake_llm(service: Any, config: FakeLLMConfig) -> None:
+    """Routes the service's Gemini calls to FakeGenerativeModel."""
+    FakeGenerativeModel.config = config
+    service.llm_gateway.model_factory = FakeGenerativeModel
+    service.GOOGLE_API_KEY = service.GOOGLE_API_KEY or "fake-llm"
+
+
+def add_fake_llm_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = FakeLLMConfig()
+    parser.add_argument("--ttft-ms", type=float, default=defaults.ttft_ms, help="Fake LLM time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=defaults.tokens_per_second, help="Fake LLM generation rate")
+    parser.add_argument("--reply-words", type=int, default=defaults.reply_words, help="Fake LLM reply length")
+    parser.add_argument("--llm-jitter", type=float, default=defaults.jitter, help="Fake LLM latency jitter (0-1)")
+    parser.add_argument("--llm-error-rate", type=float, default=defaults.error_rate, help="Fraction of fake LLM calls that fail")
+
+
+def fake_llm_config_from_args(args: argparse.Namespace) -> FakeLLMConfig:
+    return FakeLLMConfig(ttft_ms=args.ttft_ms, tokens_per_second=args.tokens_per_second, reply_words=args.reply_words,
+                         jitter=args.llm_jitter, error_rate=args.llm_error_rate)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the Carton Caps service with a local fake LLM.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    add_fake_llm_arguments(parser)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main as service
+
+    install_fake_llm(service, fake_llm_config_from_args(args))
+    uvicorn.run(service.app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,211 @@
+"""
+Generates a synthetic CartonCapsData.sqlite at benchmark scale.
+
+The schema matches data/CartonCapsData.sqlite; the service's migrations are applied after the
+bulk load, so the FTS index and history indexes are built once instead of row by row. Output is
+deterministic for a given --seed.
+
+    python benchmarks/generate_db.py /tmp/CartonCapsBench.sqlite --products 1000000 --users 200000 \\
+        --purchases 5000000 --history-sessions 500000
+
+    CARTON_CAPS_DB_PATH=/tmp/CartonCapsBench.sqlite python benchmarks/load_test.py --in-process --fake-llm \\
+        --user-count 200000
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import sys
+import time
+from typing import Iterator, Iterable, Tuple, Any
+
+BASE_SCHEMA = """
+CREATE TABLE Schools (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    address TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE Users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    school_id INTEGER,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL UNIQUE,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (school_id) REFERENCES Schools(id)
+);
+CREATE TABLE Products (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    description TEXT,
+    price REAL NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE Purchase_History (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    purchased_at TEXT NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES Users(id),
+    FOREIGN KEY (product_id) REFERENCES Products(id)
+);
+CREATE TABLE Conversation_History (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    sender TEXT CHECK(sender IN ('user', 'bot')),
+    timestamp TEXT NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES Users(id)
+);
+"""
+
+BATCH_SIZE = 10000
+
+# Product names are built as "<brand> <flavor> <kind>" so keyword searches (cereal, snack, ...) hit realistic fractions
+_BRANDS = ["Sunny", "Harvest", "Golden", "Maple", "Prairie", "Coastal", "Orchard", "Meadow", "Summit", "Valley"]
+_FLAVORS = ["Honey", "Cinnamon", "Berry", "Chocolate", "Vanilla", "Apple", "Peanut", "Strawberry", "Banana", "Original",
+            "Whole Grain", "Cheddar", "Maple", "Lemon", "Coconut", "Almond"]
+_KINDS = [
+    ("Cereal", "A crunchy breakfast cereal"), ("Snack Bars", "Chewy snack bars for lunchboxes"),
+    ("Fruit Cups", "Fruit pieces packed in juice"), ("Cheese Crackers", "Baked crackers made with real cheese"),
+    ("Oatmeal", "Instant oatmeal ready in minutes"), ("Corn Flakes", "Toasted corn flakes"),
+    ("Granola", "Oven-baked granola clusters"), ("Juice Boxes", "Single-serve juice boxes"),
+    ("Yogurt", "Creamy yogurt cups"), ("Pasta", "Quick-cooking pasta"), ("Bread", "Soft sandwich bread"),
+    ("Milk", "Shelf-stable milk cartons"), ("Trail Mix", "A snack mix of nuts and dried fruit"),
+    ("Pretzels", "Crunchy baked pretzels"), ("Popcorn", "Lightly salted popcorn"),
+]
+_FIRST_NAMES = ["Tracy", "Robert", "Maria", "James", "Aisha", "Wei", "Carlos", "Emma", "Noah", "Priya", "Liam", "Sofia",
+                "Omar", "Grace", "Mateo", "Hana", "Ethan", "Zoe", "Lucas", "Amara"]
+_LAST_NAMES = ["Mendez", "Maddox", "Garcia", "Smith", "Khan", "Chen", "Lopez", "Johnson", "Brown", "Patel", "Nguyen",
+               "Kim", "Rossi", "Okafor", "Silva", "Müller", "Cohen", "Ali", "Taylor", "Martin"]
+_SCHOOL_NAMES = ["Elementary", "Primary", "Middle School", "Academy", "Charter School"]
+_CONVERSATION = [
+    ("How do referrals work?", "Share your referral link from the app; when a friend signs up, your school earns a bonus."),
+    ("Recommend a snack for me", "You might like our snack bars or trail mix, both great for lunchboxes."),
+    ("Do you have any cereal?", "Yes! We carry several cereals, including honey and cinnamon varieties."),
+    ("Hello there!", "Hi! I can help you find products or explain the referral program."),
+]
+
+_EPOCH = datetime.datetime(2021, 1, 1)
+
+
+def _timestamp(rng: random.Random, span_days: int = 1500) -> str:
+    return (_EPOCH + datetime.timedelta(seconds=rng.randrange(span_days * 86400))).isoformat(timespec="seconds")
+
+
+def _batched(rows: Iterable[Tuple[Any, ...]], size: int = BATCH_SIZE) -> Iterator[list]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _schools(rng: random.Random, count: int) -> Iterator[Tuple[Any, ...]]:
+    for i in range(1, count + 1):
+        name = f"{rng.choice(_BRANDS)} {rng.choice(_LAST_NAMES)} {rng.choice(_SCHOOL_NAMES)} #{i}"
+        yield (name, f"{rng.randrange(1, 9999)} Main St", _timestamp(rng))
+
+
+def _users(rng: random.Random, count: int, schools: int) -> Iterator[Tuple[Any, ...]]:
+    for i in range(1, count + 1):
+        first, last = rng.choice(_FIRST_NAMES), rng.choice(_LAST_NAMES)
+        yield (rng.randrange(1, schools + 1), f"{first} {last}", f"{first.lower()}.{last.lower()}.{i}@example.com", _timestamp(rng))
+
+
+def _products(rng: random.Random, count: int) -> Iterator[Tuple[Any, ...]]:
+    for _ in range(count):
+        kind, description = rng.choice(_KINDS)
+        flavor = rng.choice(_FLAVORS)
+        yield (f"{rng.choice(_BRANDS)} {flavor} {kind}", f"{description}, {flavor.lower()} flavor.",
+               round(rng.uniform(1.5, 15.0), 2), _timestamp(rng))
+
+
+def _purchases(rng: random.Random, count: int, users: int, products: int) -> Iterator[Tuple[Any, ...]]:
+    # Skewed product popularity: a small head of products accounts for most purchases
+    for _ in range(count):
+        product_id = min(products, int(rng.paretovariate(1.2))) if rng.random() < 0.6 else rng.randrange(1, products + 1)
+        yield (rng.randrange(1, users + 1), product_id, rng.randint(1, 4), _timestamp(rng))
+
+
+def _history(rng: random.Random, sessions: int, turns: int, users: int) -> Iterator[Tuple[Any, ...]]:
+    for session_index in range(sessions):
+        user_id = rng.randrange(1, users + 1)
+        started = _EPOCH + datetime.timedelta(seconds=rng.randrange(1500 * 86400))
+        for turn in range(turns):
+            question, answer = rng.choice(_CONVERSATION)
+            asked_at = started + datetime.timedelta(seconds=turn * 30)
+            session_id = f"synthetic_{session_index}"
+            yield (session_id, user_id, question, "user", asked_at.isoformat(timespec="seconds"))
+            yield (session_id, user_id, answer, "bot", (asked_at + datetime.timedelta(seconds=2)).isoformat(timespec="seconds"))
+
+
+def _load(conn: sqlite3.Connection, label: str, sql: str, rows: Iterable[Tuple[Any, ...]]) -> None:
+    started = time.perf_counter()
+    total = 0
+    for batch in _batched(rows):
+        with conn:
+            conn.executemany(sql, batch)
+        total += len(batch)
+    print(f"  {label}: {total} rows in {time.perf_counter() - started:.1f}s")
+
+
+def generate(path: str, schools: int, users: int, products: int, purchases: int, history_sessions: int,
+             turns_per_session: int, seed: int) -> None:
+    if os.path.exists(path):
+        raise SystemExit(f"{path} already exists; remove it first.")
+    rng = random.Random(seed)
+    print(f"Generating {path} (seed {seed})")
+
+    conn = sqlite3.connect(path)
+    # Bulk-load settings; the database is disposable until generation finishes
+    conn.execute("PRAGMA journal_mode=OFF;")
+    conn.execute("PRAGMA synchronous=OFF;")
+    conn.execute("PRAGMA cache_size=-262144;")
+    conn.executescript(BASE_SCHEMA)
+    _load(conn, "Schools", "INSERT INTO Schools (name, address, created_at) VALUES (?, ?, ?)", _schools(rng, schools))
+    _load(conn, "Users", "INSERT INTO Users (school_id, name, email, created_at) VALUES (?, ?, ?, ?)", _users(rng, users, schools))
+    _load(conn, "Products", "INSERT INTO Products (name, description, price, created_at) VALUES (?, ?, ?, ?)", _products(rng, products))
+    _load(conn, "Purchase_History", "INSERT INTO Purchase_History (user_id, product_id, quantity, purchased_at) VALUES (?, ?, ?, ?)",
+          _purchases(rng, purchases, users, products))
+    conn.close()
+
+    # Apply the service's migrations (FTS index, session_id column, history indexes) against the new file
+    started = time.perf_counter()
+    os.environ["CARTON_CAPS_DB_PATH"] = path
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import db_utils
+
+    version = db_utils.apply_migrations()
+    db_utils.close_connection_pool()
+    print(f"  Migrations: schema version {version} in {time.perf_counter() - started:.1f}s")
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous=OFF;")
+    _load(conn, "Conversation_History",
+          "INSERT INTO Conversation_History (session_id, user_id, message, sender, timestamp) VALUES (?, ?, ?, ?, ?)",
+          _history(rng, history_sessions, turns_per_session, users))
+    with conn:
+        conn.execute("ANALYZE;")
+    conn.close()
+    print(f"Done: {os.path.getsize(path) / 1024 / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Carton Caps database for benchmarks.")
+    parser.add_argument("path", help="Output database file (must not exist)")
+    parser.add_argument("--schools", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--products", type=int, default=1000000)
+    parser.add_argument("--purchases", type=int, default=2000000)
+    parser.add_argument("--history-sessions", type=int, default=100000, help="Conversation sessions to pre-populate")
+    parser.add_argument("--turns-per-session", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    generate(args.path, args.schools, args.users, args.products, args.purchases, args.history_sessions,
+             args.turns_per_session, args.seed)
@@ -0,0 +1,259 @@
+"""
+Concurrent-session load test for the chat endpoint.
+
+Drives /api/v1/carton_caps/chat with N concurrent sessions sending a weighted mix of referral,
+product and general messages, and reports throughput and latency percentiles overall and per
+intent. Requires httpx (`pip install httpx`).
+
+    # Against a running server (e.g. `python benchmarks/fake_llm.py --port 8008`)
+    python benchmarks/load_test.py --base-url http://127.0.0.1:8008 --sessions 50 --turns 5
+
+    # In-process with the fake LLM (no server or API key needed)
+    python benchmarks/load_test.py --in-process --fake-llm --sessions 50 --turns 5
+
+    # Save a report and compare a later run against it
+    python benchmarks/load_test.py --in-process --fake-llm --output before.json
+    python benchmarks/load_test.py --in-process --fake-llm --baseline before.json
+
+    # Compare payload sizes of the full and slim (delta-only) chat responses
+    python benchmarks/load_test.py --in-process --fake-llm --response-mode slim
+
+With --stream, time to first frame is only meaningful over the network: the in-process ASGI
+transport buffers the whole response.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+from typing import List, Optional, Dict, Any, Tuple
+
+import httpx
+
+from fake_llm import add_fake_llm_arguments, fake_llm_config_from_args, install_fake_llm
+
+CHAT_PATH = "/api/v1/carton_caps/chat"
+CHAT_STREAM_PATH = "/api/v1/carton_caps/chat/stream"
+
+# Messages per intent class; sessions draw from these according to --mix
+INTENT_MESSAGES: Dict[str, List[str]] = {
+    "referral": [
+        "How do referrals work?",
+        "What bonus does my friend get?",
+        "Is there a limit on how many friends I can refer?",
+        "When does my school get the referral reward?",
+    ],
+    "product": [
+        "Recommend a snack for me",
+        "Do you have any cereal?",
+        "Find me some fruit cups",
+        "I want to buy cheese crackers",
+        "Search for oatmeal",
+    ],
+    "general": [
+        "Hello there!",
+        "Thanks, that's helpful",
+        "What can you do?",
+    ],
+}
+DEFAULT_MIX = "referral=0.3,product=0.5,general=0.2"
+
+
+def parse_mix(mix: str) -> List[Tuple[str, float]]:
+    """Parses "referral=0.3,product=0.5,general=0.2" into (intent, weight) pairs."""
+    weights = []
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in INTENT_MESSAGES:
+            raise SystemExit(f"Unknown intent '{name}' in --mix (expected one of {', '.join(INTENT_MESSAGES)})")
+        weights.append((name.strip(), float(weight or 1)))
+    return weights
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2),
+    }
+
+
+async def post_turn(client: httpx.AsyncClient, payload: Dict[str, Any], stream: bool,
+                    response_mode: str = "full") -> Tuple[int, Optional[float], int]:
+    """Sends one turn; returns (status code, time to first streamed frame or None, response body bytes)."""
+    if not stream:
+        response = await client.post(CHAT_PATH, json=payload, params={"response_mode": response_mode})
+        return response.status_code, None, len(response.content)
+    started = time.perf_counter()
+    first_frame = None
+    body_bytes = 0
+    async with client.stream("POST", CHAT_STREAM_PATH, json=payload) as response:
+        async for line in response.aiter_lines():
+            if line and first_frame is None:
+                first_frame = time.perf_counter() - started
+            body_bytes += len(line.encode()) + 1
+        return response.status_code, first_frame, body_bytes
+
+
+async def run_session(client: httpx.AsyncClient, session_index: int, turns: int, rng: random.Random,
+                      mix: List[Tuple[str, float]], user_ids: List[str], stream: bool, response_mode: str,
+                      results: Dict[str, List[float]], first_frames: List[float], response_bytes: List[int],
+                      errors: List[str]) -> None:
+    session_id = f"loadtest_{os.getpid()}_{session_index}"
+    user_id = rng.choice(user_ids)
+    names, weights = zip(*mix)
+    for _ in range(turns):
+        intent = rng.choices(names, weights)[0]
+        payload = {"user_id": user_id, "session_id": session_id, "message": {"text": rng.choice(INTENT_MESSAGES[intent])}}
+        started = time.perf_counter()
+        try:
+            status_code, first_frame, body_bytes = await post_turn(client, payload, stream, response_mode)
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+            continue
+        if status_code != 200:
+            errors.append(f"HTTP {status_code}")
+            continue
+        results.setdefault(intent, []).append(time.perf_counter() - started)
+        response_bytes.append(body_bytes)
+        if first_frame is not None:
+            first_frames.append(first_frame)
+
+
+async def run_load_test(client: httpx.AsyncClient, sessions: int, turns: int, mix: List[Tuple[str, float]],
+                        user_ids: List[str], stream: bool, seed: int, response_mode: str = "full") -> Dict[str, Any]:
+    results: Dict[str, List[float]] = {}
+    first_frames: List[float] = []
+    response_bytes: List[int] = []
+    errors: List[str] = []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        run_session(client, i, turns, random.Random(seed * 100003 + i), mix, user_ids, stream, response_mode,
+                    results, first_frames, response_bytes, errors)
+        for i in range(sessions)
+    ))
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [latency for latencies in results.values() for latency in latencies]
+    report = {
+        "sessions": sessions,
+        "turns": turns,
+        "stream": stream,
+        "response_mode": "stream" if stream else response_mode,
+        "elapsed_s": round(elapsed, 3),
+        "ok": len(all_latencies),
+        "failed": len(errors),
+        "throughput_rps": round(len(all_latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency": summarize(all_latencies),
+        "by_intent": {intent: summarize(latencies) for intent, latencies in sorted(results.items())},
+        "mean_response_bytes": round(statistics.mean(response_bytes), 1) if response_bytes else 0.0,
+        "errors_sample": errors[:5],
+    }
+    if first_frames:
+        report["first_frame"] = summarize(first_frames)
+    return report
+
+
+def _format_summary(summary: Dict[str, float]) -> str:
+    if not summary.get("count"):
+        return "no successful requests"
+    return (f"n={summary['count']} mean={summary['mean_ms']:.1f} p50={summary['p50_ms']:.1f} "
+            f"p95={summary['p95_ms']:.1f} p99={summary['p99_ms']:.1f} max={summary['max_ms']:.1f}")
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    print(f"Concurrent sessions: {report['sessions']}, turns per session: {report['turns']}, streaming: {report['stream']}")
+    print(f"Requests: {report['ok']} ok, {report['failed']} failed in {report['elapsed_s']:.2f}s ({report['throughput_rps']:.1f} req/s)")
+    print(f"Latency ms: {_format_summary(report['latency'])}")
+    print(f"Mean response size: {report['mean_response_bytes']:.0f} bytes ({report['response_mode']} responses)")
+    for intent, summary in report["by_intent"].items():
+        print(f"  {intent:<9} {_format_summary(summary)}")
+    if "first_frame" in report:
+        print(f"First frame ms: {_format_summary(report['first_frame'])}")
+    if report["errors_sample"]:
+        print(f"Errors (first 5): {report['errors_sample']}")
+    if baseline:
+        print("Change vs baseline:")
+        for label, current, previous in (
+            ("throughput_rps", report["throughput_rps"], baseline.get("throughput_rps")),
+            ("p50_ms", report["latency"].get("p50_ms"), baseline.get("latency", {}).get("p50_ms")),
+            ("p95_ms", report["latency"].get("p95_ms"), baseline.get("latency", {}).get("p95_ms")),
+            ("p99_ms", report["latency"].get("p99_ms"), baseline.get("latency", {}).get("p99_ms")),
+            ("response_bytes", report["mean_response_bytes"], baseline.get("mean_response_bytes")),
+        ):
+            if current is None or not previous:
+                continue
+            print(f"  {label:<15} {previous:>10.2f} -> {current:>10.2f} ({(current - previous) / previous * 100:+.1f}%)")
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    mix = parse_mix(args.mix)
+    if args.user_count:
+        user_ids = [str(user_id) for user_id in range(1, args.user_count + 1)]
+    else:
+        user_ids = args.user_ids.split(",")
+
+    if args.in_process:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import main as service
+
+        if args.fake_llm:
+            install_fake_llm(service, fake_llm_config_from_args(args))
+        async with service.lifespan(service.app):
+            transport = httpx.ASGITransport(app=service.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=args.timeout) as client:
+                return await run_load_test(client, args.sessions, args.turns, mix, user_ids, args.stream, args.seed,
+                                   args.response_mode)
+    limits = httpx.Limits(max_connections=args.sessions, max_keepalive_connections=args.sessions)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        return await run_load_test(client, args.sessions, args.turns, mix, user_ids, args.stream, args.seed,
+                                   args.response_mode)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the Carton Caps chat endpoint.")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8008")
+    parser.add_argument("--in-process", action="store_true", help="Run the app in-process instead of over the network")
+    parser.add_argument("--fake-llm", action="store_true", help="With --in-process, answer with the local fake LLM")
+    parser.add_argument("--sessions", type=int, default=20, help="Number of concurrent sessions")
+    parser.add_argument("--turns", type=int, default=5, help="Messages sent sequentially per session")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Intent weights, e.g. referral=0.3,product=0.5,general=0.2")
+    parser.add_argument("--stream", action="store_true", help="Use the NDJSON streaming endpoint")
+    parser.add_argument("--response-mode", choices=("full", "slim"), default="full",
+                        help="Chat response mode: full history echo or only this turn's messages")
+    parser.add_argument("--user-ids", default="1,2,3,4,5", help="Comma-separated user ids to spread sessions over")
+    parser.add_argument("--user-count", type=int, default=0, help="Spread sessions over user ids 1..N instead (synthetic DBs)")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the message and user sequence")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against a report written earlier with --output")
+    add_fake_llm_arguments(parser)
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
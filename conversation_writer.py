@@ -0,0 +1,142 @@
+import asyncio
+import datetime
+import logging
+import os
+import sqlite3
+import time
+from typing import Optional, List, Dict, Any, Tuple
+
+from db_utils import save_conversation_messages, run_in_db_executor
+
+logger = logging.getLogger(__name__)
+
+# --- Write-behind settings (overridable through environment variables) ---
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("CARTON_CAPS_HISTORY_BATCH_SIZE", "64"))
+WRITE_BEHIND_FLUSH_INTERVAL_SECONDS = float(os.getenv("CARTON_CAPS_HISTORY_FLUSH_INTERVAL", "0.5"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("CARTON_CAPS_HISTORY_MAX_PENDING", "50000"))
+
+PendingMessage = Tuple[str, str, str, str, datetime.datetime]
+
+
+class ConversationWriteBehind:
+    """
+    Buffers Conversation_History inserts and writes them in batched transactions.
+
+    `enqueue()` is non-blocking and never touches the database, which takes the commit off the
+    response path. A background task flushes when `batch_size` messages are pending or every
+    `flush_interval` seconds, whichever comes first. `stop()` drains the buffer, so messages
+    are only lost if the process dies without running the FastAPI shutdown hook.
+    """
+
+    def __init__(self, batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+                 flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL_SECONDS,
+                 max_pending: int = WRITE_BEHIND_MAX_PENDING):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: List[PendingMessage] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        # Metrics
+        self.messages_enqueued = 0
+        self.messages_written = 0
+        self.messages_dropped = 0
+        self.flush_count = 0
+        self.flush_failures = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def enqueue(self, session_id: str, user_id: str, role: str, content: str, timestamp: datetime.datetime) -> None:
+        """Buffers one message for the next batch."""
+        self._pending.append((session_id, user_id, role, content, timestamp))
+        self.messages_enqueued += 1
+        if len(self._pending) > self.max_pending:
+            # Bound memory if the database is unavailable for a long time: drop the oldest messages
+            overflow = len(self._pending) - self.max_pending
+            del self._pending[:overflow]
+            self.messages_dropped += overflow
+            logger.warning("Conversation write-behind queue full, dropped %d oldest messages.", overflow)
+        if self._wakeup is not None and len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    async def start(self) -> None:
+        """Starts the background flush task (call once from the application lifespan)."""
+        if self._task is not None:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run(), name="conversation-write-behind")
+
+    async def stop(self) -> None:
+        """Stops the background task and flushes everything still buffered."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        while self._pending:
+            if not await self.flush():
+                logger.error("%d conversation messages could not be saved on shutdown.", len(self._pending))
+                break
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            await self.flush()
+
+    async def flush(self) -> bool:
+        """Writes up to `batch_size` buffered messages per transaction until the buffer is empty."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                started = time.perf_counter()
+                try:
+                    await run_in_db_executor(save_conversation_messages, batch)
+                except (sqlite3.Error, FileNotFoundError) as e:
+                    # Keep the batch buffered; the next flush retries it
+                    self.flush_failures += 1
+                    logger.error("Database error flushing %d conversation messages: %s", len(batch), e)
+                    return False
+                elapsed = time.perf_counter() - started
+                del self._pending[:len(batch)]
+                self.messages_written += len(batch)
+                self.flush_count += 1
+                self.last_flush_seconds = elapsed
+                self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+                self.total_flush_seconds += elapsed
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.queue_depth,
+            "messages_enqueued": self.messages_enqueued,
+            "messages_written": self.messages_written,
+            "messages_dropped": self.messages_dropped,
+            "flush_count": self.flush_count,
+            "flush_failures": self.flush_failures,
+            "last_flush_ms": round(self.last_flush_seconds * 1000, 3),
+            "max_flush_ms": round(self.max_flush_seconds * 1000, 3),
+            "avg_flush_ms": round(self.total_flush_seconds / self.flush_count * 1000, 3) if self.flush_count else 0.0,
+        }
+
+
+# Shared instance used by the chat endpoint
+conversation_writer = ConversationWriteBehind()
@@ -1,71 +1,478 @@
+import asyncio
+import functools
+import logging
 import sqlite3
 import os
+import queue
+import re
+import threading
 import datetime # Ensure datetime is imported
-from typing import Optional, List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional, List, Dict, Any, Iterator, Callable, TypeVar, Tuple
+
+from workers import FileLock
+
+logger = logging.getLogger(__name__)
 
 # --- IMPORTANT: Adjust this path if your DB is located elsewhere relative to this file ---
 # Assuming 'data' subdirectory at the same level as db_utils.py
 DATABASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 DATABASE_NAME = 'CartonCapsData.sqlite' # Make sure this matches your actual DB file name
-DATABASE_PATH = os.path.join(DATABASE_DIR, DATABASE_NAME)
+DATABASE_PATH = os.getenv("CARTON_CAPS_DB_PATH", os.path.join(DATABASE_DIR, DATABASE_NAME)) # Override to point at a copy or a synthetic benchmark DB
+
+# --- Connection pool settings (overridable through environment variables) ---
+DB_POOL_SIZE = int(os.getenv("CARTON_CAPS_DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("CARTON_CAPS_DB_POOL_TIMEOUT", "5.0"))
+DB_CACHED_STATEMENTS = int(os.getenv("CARTON_CAPS_DB_CACHED_STATEMENTS", "128"))
+DB_BUSY_TIMEOUT_MS = 5000
+DB_MMAP_SIZE_BYTES = 256 * 1024 * 1024
+DB_CACHE_SIZE_KIB = 64 * 1024  # Negative PRAGMA cache_size is expressed in KiB
+
+def _configure_connection(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """Applies the row factory and performance pragmas to a new connection."""
+    conn.row_factory = sqlite3.Row # Makes rows accessible by column name
+    conn.execute("PRAGMA journal_mode=WAL;") # Readers no longer block behind writers
+    conn.execute("PRAGMA synchronous=NORMAL;") # Safe with WAL, avoids an fsync per commit
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS};")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE_BYTES};")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KIB};")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    return conn
 
 def get_db_connection():
-    """Establishes a connection to the SQLite database."""
+    """Establishes a new, unpooled connection to the SQLite database."""
     if not os.path.exists(DATABASE_PATH):
-        print(f"Database file not found at: {DATABASE_PATH}")
+        logger.error("Database file not found at: %s", DATABASE_PATH)
         raise FileNotFoundError(f"Database file not found at: {DATABASE_PATH}")
     
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row # Makes rows accessible by column name
-    return conn
+    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+    return _configure_connection(conn)
+
+class ConnectionPool:
+    """
+    Fixed-size, thread-safe pool of SQLite connections.
+
+    Connections are opened lazily up to `size` and then reused, so each keeps its
+    compiled statement cache warm. Use `with pool.connection() as conn:`; the
+    transaction is committed on success and rolled back on error.
+    """
+
+    def __init__(self, database_path: str, size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT_SECONDS):
+        if not os.path.exists(database_path):
+            logger.error("Database file not found at: %s", database_path)
+            raise FileNotFoundError(f"Database file not found at: {database_path}")
+        self.database_path = database_path
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.database_path, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+        return _configure_connection(conn)
+
+    def acquire(self) -> sqlite3.Connection:
+        if self._closed:
+            raise sqlite3.ProgrammingError("Connection pool is closed")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._opened -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"Timed out after {self.timeout}s waiting for a pooled database connection")
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if self._closed:
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self.acquire()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        """Closes all idle connections; connections still checked out close on release."""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+def get_connection_pool() -> ConnectionPool:
+    """Returns the shared connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DATABASE_PATH)
+    return _pool
+
+def close_connection_pool() -> None:
+    """Closes the DB executor and shared connection pool (called on application shutdown)."""
+    global _pool, _executor
+    with _pool_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+# --- Dedicated executor for the async API ---
+# Sized to the pool so offloaded calls never queue on connection checkout inside a worker thread
+_executor: Optional[ThreadPoolExecutor] = None
+
+T = TypeVar("T")
+
+def get_db_executor() -> ThreadPoolExecutor:
+    """Returns the thread pool that runs blocking SQLite calls for the async API."""
+    global _executor
+    if _executor is None:
+        with _pool_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="carton-caps-db")
+    return _executor
+
+async def run_in_db_executor(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Runs a blocking db_utils function on the DB executor without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_db_executor(), functools.partial(func, *args, **kwargs))
+
+@contextmanager
+def db_connection() -> Iterator[sqlite3.Connection]:
+    """Borrows a connection from the shared pool for the duration of the block."""
+    with get_connection_pool().connection() as conn:
+        yield conn
+
+# --- Schema migrations ---
+# Applied in order and tracked with PRAGMA user_version, so each runs exactly once per database file.
+SCHEMA_MIGRATIONS: List[str] = [
+    # 1: FTS5 full-text index over Products, kept in sync with the base table by triggers
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS Products_FTS USING fts5(
+        name, description, content='Products', content_rowid='id', tokenize='porter unicode61'
+    );
+    CREATE TRIGGER IF NOT EXISTS Products_FTS_ai AFTER INSERT ON Products BEGIN
+        INSERT INTO Products_FTS(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END;
+    CREATE TRIGGER IF NOT EXISTS Products_FTS_ad AFTER DELETE ON Products BEGIN
+        INSERT INTO Products_FTS(Products_FTS, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    END;
+    CREATE TRIGGER IF NOT EXISTS Products_FTS_au AFTER UPDATE ON Products BEGIN
+        INSERT INTO Products_FTS(Products_FTS, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO Products_FTS(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END;
+    INSERT INTO Products_FTS(Products_FTS) VALUES ('rebuild');
+    """,
+    # 2: Session-scoped conversation history. Rows written before this migration keep a NULL session_id.
+    """
+    ALTER TABLE Conversation_History ADD COLUMN session_id TEXT;
+    CREATE INDEX IF NOT EXISTS idx_conversation_history_session_ts ON Conversation_History (session_id, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_conversation_history_user_ts ON Conversation_History (user_id, timestamp);
+    """,
+    # 3: Per-user purchase lookups (purchase summaries for the user profile cache)
+    """
+    CREATE INDEX IF NOT EXISTS idx_purchase_history_user_product ON Purchase_History (user_id, product_id);
+    """,
+    # 4: Change log of product ids whose name or description changed, drained by the semantic index
+    """
+    CREATE TABLE IF NOT EXISTS Product_Changes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL
+    );
+    CREATE TRIGGER IF NOT EXISTS Product_Changes_ai AFTER INSERT ON Products BEGIN
+        INSERT INTO Product_Changes(product_id) VALUES (new.id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS Product_Changes_ad AFTER DELETE ON Products BEGIN
+        INSERT INTO Product_Changes(product_id) VALUES (old.id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS Product_Changes_au AFTER UPDATE OF name, description ON Products BEGIN
+        INSERT INTO Product_Changes(product_id) VALUES (new.id);
+    END;
+    """,
+    # 5: Recent message window and rolling summary per session, shared by all worker processes
+    """
+    CREATE TABLE IF NOT EXISTS Session_Windows (
+        session_id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        messages TEXT NOT NULL,
+        summary TEXT,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_session_windows_updated ON Session_Windows (updated_at);
+    """,
+    # 6: Latest profile invalidation per user, polled by every worker process to drop stale cached profiles
+    """
+    CREATE TABLE IF NOT EXISTS Profile_Invalidations (
+        user_id TEXT PRIMARY KEY,
+        invalidated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_profile_invalidations_at ON Profile_Invalidations (invalidated_at);
+    """,
+]
+
+def apply_migrations() -> int:
+    """Brings the database schema up to date. Returns the resulting schema version."""
+    # Worker processes starting together take turns, so each migration is applied by exactly one
+    with FileLock(DATABASE_PATH + ".migrate.lock"), db_connection() as conn:
+        version = conn.execute("PRAGMA user_version;").fetchone()[0]
+        for target_version, migration_sql in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+            logger.info("Applying database migration %d...", target_version)
+            # executescript() commits any open transaction first, so wrap the migration in its own
+            conn.executescript(f"BEGIN;\n{migration_sql}\nPRAGMA user_version = {target_version};\nCOMMIT;")
+            version = target_version
+    return version
+
+def rebuild_product_search_index() -> None:
+    """Rebuilds Products_FTS from the Products table (e.g. after bulk loads that bypassed triggers)."""
+    with db_connection() as conn:
+        conn.execute("INSERT INTO Products_FTS(Products_FTS) VALUES ('rebuild');")
+
+# --- Queries (module-level so every pooled connection reuses the same cached statements) ---
+USER_DETAILS_QUERY = """
+    SELECT 
+        u.id as user_id, 
+        u.name as user_name, 
+        u.email as user_email,
+        s.id as school_id,
+        s.name as school_name,
+        s.address as school_address
+    FROM Users u
+    LEFT JOIN Schools s ON u.school_id = s.id
+    WHERE u.id = ?;
+"""
+
+# Name matches weigh more than description matches in the BM25 ranking
+PRODUCTS_FULL_TEXT_QUERY = """
+    SELECT p.id, p.name, p.description, p.price 
+    FROM Products_FTS
+    JOIN Products p ON p.id = Products_FTS.rowid
+    WHERE Products_FTS MATCH ?
+    ORDER BY bm25(Products_FTS, 10.0, 1.0)
+    LIMIT ?;
+"""
+
+# Fallback used only when the FTS index has not been created yet
+PRODUCTS_BY_KEYWORD_QUERY = """
+    SELECT id, name, description, price 
+    FROM Products 
+    WHERE name LIKE ? OR description LIKE ? 
+    LIMIT ?;
+"""
+
+# Conversational filler that should not be used as product search terms
+_PRODUCT_SEARCH_STOPWORDS = frozenset({
+    "a", "about", "an", "and", "any", "are", "buy", "can", "could", "do", "does", "find", "for", "get",
+    "good", "have", "i", "in", "is", "it", "like", "looking", "me", "more", "my", "of", "on", "or",
+    "please", "product", "products", "recommend", "search", "show", "some", "something", "suggest",
+    "tell", "that", "the", "there", "to", "want", "what", "with", "you",
+})
+
+def build_product_search_query(text: str) -> Optional[str]:
+    """Turns free text into an FTS5 MATCH expression (OR of quoted terms), or None if nothing is searchable."""
+    terms = []
+    for token in re.findall(r"\w+", text.lower()):
+        if token not in _PRODUCT_SEARCH_STOPWORDS and token not in terms:
+            terms.append(token)
+    if not terms:
+        return None
+    # Quoting each term keeps user input from being parsed as FTS5 query syntax
+    return " OR ".join(f'"{term}"' for term in terms)
+
+PURCHASE_HISTORY_QUERY = """
+    SELECT 
+        ph.id as purchase_id,
+        ph.product_id,
+        p.name as product_name,
+        ph.quantity,
+        ph.purchased_at
+    FROM Purchase_History ph
+    JOIN Products p ON ph.product_id = p.id
+    WHERE ph.user_id = ?
+    ORDER BY ph.purchased_at DESC
+    LIMIT ?;
+"""
+
+# A user's most purchased products (by total quantity, then most recent)
+USER_PURCHASE_SUMMARY_QUERY = """
+    SELECT 
+        ph.product_id,
+        p.name as product_name,
+        SUM(ph.quantity) as total_quantity,
+        MAX(ph.purchased_at) as last_purchased_at
+    FROM Purchase_History ph
+    JOIN Products p ON ph.product_id = p.id
+    WHERE ph.user_id = ?
+    GROUP BY ph.product_id
+    ORDER BY total_quantity DESC, last_purchased_at DESC
+    LIMIT ?;
+"""
+
+# Users with the most recent conversation activity, for preloading the profile cache
+RECENTLY_ACTIVE_USERS_QUERY = """
+    SELECT user_id
+    FROM Conversation_History
+    GROUP BY user_id
+    ORDER BY MAX(timestamp) DESC
+    LIMIT ?;
+"""
+
+# Every user's purchases aggregated per product, with the user's school (-1 if none), for building the
+# recommendation index (grouping follows the (user_id, product_id) index, so rows stream out without a sort)
+USER_PRODUCT_PURCHASES_QUERY = """
+    SELECT 
+        ph.user_id,
+        COALESCE(u.school_id, -1) as school_id,
+        ph.product_id,
+        SUM(ph.quantity) as quantity
+    FROM Purchase_History ph
+    LEFT JOIN Users u ON u.id = ph.user_id
+    GROUP BY ph.user_id, ph.product_id;
+"""
+
+# Purchase_History only grows, so its highest id tells whether derived indexes are stale
+PURCHASE_HISTORY_VERSION_QUERY = "SELECT COALESCE(MAX(id), 0) FROM Purchase_History;"
+
+# All product texts, in id order, for building the semantic index
+PRODUCT_TEXTS_QUERY = "SELECT id, name, description FROM Products ORDER BY id;"
+
+PRODUCT_CHANGES_QUERY = "SELECT id, product_id FROM Product_Changes ORDER BY id LIMIT ?;"
+PRODUCT_CHANGES_VERSION_QUERY = "SELECT COALESCE(MAX(id), 0) FROM Product_Changes;"
+CLEAR_PRODUCT_CHANGES_QUERY = "DELETE FROM Product_Changes WHERE id <= ?;"
+
+# Bulk variants take an IN list; ids are sent in chunks of this size to stay under SQLite's variable limit
+BULK_QUERY_CHUNK_SIZE = 500
+
+def _user_details_bulk_query(count: int) -> str:
+    return USER_DETAILS_QUERY.replace("WHERE u.id = ?", f"WHERE u.id IN ({','.join('?' * count)})")
+
+def _products_by_ids_query(count: int) -> str:
+    return f"SELECT id, name, description, price FROM Products WHERE id IN ({','.join('?' * count)});"
+
+def _purchase_summaries_bulk_query(count: int) -> str:
+    return f"""
+    SELECT user_id, product_id, product_name, total_quantity, last_purchased_at FROM (
+        SELECT 
+            ph.user_id,
+            ph.product_id,
+            p.name as product_name,
+            SUM(ph.quantity) as total_quantity,
+            MAX(ph.purchased_at) as last_purchased_at,
+            ROW_NUMBER() OVER (PARTITION BY ph.user_id ORDER BY SUM(ph.quantity) DESC, MAX(ph.purchased_at) DESC) as purchase_rank
+        FROM Purchase_History ph
+        JOIN Products p ON ph.product_id = p.id
+        WHERE ph.user_id IN ({','.join('?' * count)})
+        GROUP BY ph.user_id, ph.product_id
+    )
+    WHERE purchase_rank <= ?
+    ORDER BY user_id, purchase_rank;
+"""
+
+SAVE_CONVERSATION_MESSAGE_QUERY = """
+    INSERT INTO Conversation_History (session_id, user_id, message, sender, timestamp) 
+    VALUES (?, ?, ?, ?, ?);
+"""
+
+# The history queries below are served by the (session_id, timestamp) and (user_id, timestamp)
+# indexes; the implicit rowid at the end of each index entry breaks timestamp ties without a sort.
+SESSION_HISTORY_QUERY = """
+    SELECT id, user_id, message as content, sender as role, timestamp 
+    FROM Conversation_History
+    WHERE session_id = ? 
+    ORDER BY timestamp DESC, id DESC 
+    LIMIT ?;
+"""
+
+SESSION_HISTORY_PAGE_QUERY = """
+    SELECT id, user_id, message as content, sender as role, timestamp 
+    FROM Conversation_History
+    WHERE session_id = ? AND (timestamp, id) < (?, ?) 
+    ORDER BY timestamp DESC, id DESC 
+    LIMIT ?;
+"""
+
+USER_HISTORY_QUERY = """
+    SELECT id, user_id, message as content, sender as role, timestamp 
+    FROM Conversation_History
+    WHERE user_id = ? 
+    ORDER BY timestamp DESC, id DESC 
+    LIMIT ?;
+"""
+
+SESSION_WINDOW_QUERY = "SELECT messages, summary FROM Session_Windows WHERE session_id = ? AND updated_at >= ?;"
+SESSION_SUMMARY_QUERY = "SELECT summary FROM Session_Windows WHERE session_id = ? AND updated_at >= ?;"
+UPSERT_SESSION_WINDOW_QUERY = """
+    INSERT INTO Session_Windows (session_id, user_id, messages, summary, updated_at) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(session_id) DO UPDATE SET
+        user_id = excluded.user_id, messages = excluded.messages, summary = excluded.summary, updated_at = excluded.updated_at;
+"""
+DELETE_EXPIRED_SESSION_WINDOWS_QUERY = "DELETE FROM Session_Windows WHERE updated_at < ?;"
+RECORD_PROFILE_INVALIDATION_QUERY = """
+    INSERT INTO Profile_Invalidations (user_id, invalidated_at) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET invalidated_at = excluded.invalidated_at;
+"""
+PROFILE_INVALIDATIONS_SINCE_QUERY = "SELECT user_id, invalidated_at FROM Profile_Invalidations WHERE invalidated_at >= ?;"
+DELETE_OLD_PROFILE_INVALIDATIONS_QUERY = "DELETE FROM Profile_Invalidations WHERE invalidated_at < ?;"
 
 def get_user_details(user_id: str) -> Optional[Dict[str, Any]]:
     """Fetches user details and their associated school name."""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        query = """
-            SELECT 
-                u.id as user_id, 
-                u.name as user_name, 
-                u.email as user_email,
-                s.id as school_id,
-                s.name as school_name,
-                s.address as school_address
-            FROM Users u
-            LEFT JOIN Schools s ON u.school_id = s.id
-            WHERE u.id = ?;
-        """
-        cursor.execute(query, (user_id,))
-        user_data = cursor.fetchone()
-        conn.close()
+        with db_connection() as conn:
+            user_data = conn.execute(USER_DETAILS_QUERY, (user_id,)).fetchone()
         return dict(user_data) if user_data else None
     except sqlite3.Error as e:
-        print(f"Database error in get_user_details: {e}")
+        logger.error("Database error in get_user_details: %s", e)
         return None
     except FileNotFoundError:
-        # Error already printed by get_db_connection
+        # Error already printed by the connection pool
         return None
 
 def get_products_by_keyword(keyword: str, limit: int = 5) -> List[Dict[str, Any]]:
-    """Fetches products matching a keyword in name or description."""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        # Using two LIKE clauses for broader search
-        query = """
-            SELECT id, name, description, price 
-            FROM Products 
-            WHERE name LIKE ? OR description LIKE ? 
-            LIMIT ?;
-        """
-        search_term = f"%{keyword}%"
-        cursor.execute(query, (search_term, search_term, limit))
-        products = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return products
-    except sqlite3.Error as e:
-        print(f"Database error in get_products_by_keyword: {e}")
+    """Fetches products matching a keyword (or free-text query) in name or description, best matches first."""
+    match_expression = build_product_search_query(keyword)
+    if match_expression is None:
+        return []
+    try:
+        with db_connection() as conn:
+            try:
+                rows = conn.execute(PRODUCTS_FULL_TEXT_QUERY, (match_expression, limit)).fetchall()
+            except sqlite3.OperationalError as e:
+                if "no such table" not in str(e):
+                    raise
+                # Migrations not applied yet: fall back to the unindexed LIKE scan
+                search_term = f"%{keyword}%"
+                rows = conn.execute(PRODUCTS_BY_KEYWORD_QUERY, (search_term, search_term, limit)).fetchall()
+        return [dict(row) for row in rows]
+    except sqlite3.Error as e:
+        logger.error("Database error in get_products_by_keyword: %s", e)
         return []
     except FileNotFoundError:
         return []
@@ -73,91 +480,393 @@ def get_products_by_keyword(keyword: str, limit: int = 5) -> List[Dict[str, Any]
 def get_purchase_history(user_id: str, limit: int = 5) -> List[Dict[str, Any]]:
     """Fetches purchase history for a user, joining with product names."""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        query = """
-            SELECT 
-                ph.id as purchase_id,
-                ph.product_id,
-                p.name as product_name,
-                ph.quantity,
-                ph.purchased_at
-            FROM Purchase_History ph
-            JOIN Products p ON ph.product_id = p.id
-            WHERE ph.user_id = ?
-            ORDER BY ph.purchased_at DESC
-            LIMIT ?;
-        """
-        cursor.execute(query, (user_id, limit))
-        history = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        with db_connection() as conn:
+            history = [dict(row) for row in conn.execute(PURCHASE_HISTORY_QUERY, (user_id, limit))]
         return history
     except sqlite3.Error as e:
-        print(f"Database error in get_purchase_history: {e}")
+        logger.error("Database error in get_purchase_history: %s", e)
+        return []
+    except FileNotFoundError:
+        return []
+
+def get_user_purchase_summary(user_id: str, limit: int = 5) -> List[Dict[str, Any]]:
+    """Fetches a user's most purchased products with their total quantities."""
+    try:
+        with db_connection() as conn:
+            return [dict(row) for row in conn.execute(USER_PURCHASE_SUMMARY_QUERY, (user_id, limit))]
+    except sqlite3.Error as e:
+        logger.error("Database error in get_user_purchase_summary: %s", e)
+        return []
+    except FileNotFoundError:
+        return []
+
+def get_user_details_bulk(user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Fetches user details for many users at once, keyed by user id (as a string)."""
+    details: Dict[str, Dict[str, Any]] = {}
+    try:
+        with db_connection() as conn:
+            for start in range(0, len(user_ids), BULK_QUERY_CHUNK_SIZE):
+                chunk = user_ids[start:start + BULK_QUERY_CHUNK_SIZE]
+                for row in conn.execute(_user_details_bulk_query(len(chunk)), chunk):
+                    details[str(row["user_id"])] = dict(row)
+    except sqlite3.Error as e:
+        logger.error("Database error in get_user_details_bulk: %s", e)
+    except FileNotFoundError:
+        pass
+    return details
+
+def get_purchase_summaries_bulk(user_ids: List[str], limit: int = 5) -> Dict[str, List[Dict[str, Any]]]:
+    """Fetches the purchase summary of many users at once, keyed by user id (as a string)."""
+    summaries: Dict[str, List[Dict[str, Any]]] = {}
+    try:
+        with db_connection() as conn:
+            for start in range(0, len(user_ids), BULK_QUERY_CHUNK_SIZE):
+                chunk = user_ids[start:start + BULK_QUERY_CHUNK_SIZE]
+                for row in conn.execute(_purchase_summaries_bulk_query(len(chunk)), (*chunk, limit)):
+                    entry = dict(row)
+                    summaries.setdefault(str(entry.pop("user_id")), []).append(entry)
+    except sqlite3.Error as e:
+        logger.error("Database error in get_purchase_summaries_bulk: %s", e)
+    except FileNotFoundError:
+        pass
+    return summaries
+
+def get_recently_active_user_ids(limit: int) -> List[str]:
+    """Returns the ids of the users who chatted most recently."""
+    try:
+        with db_connection() as conn:
+            return [str(row["user_id"]) for row in conn.execute(RECENTLY_ACTIVE_USERS_QUERY, (limit,))]
+    except sqlite3.Error as e:
+        logger.error("Database error in get_recently_active_user_ids: %s", e)
+        return []
+    except FileNotFoundError:
+        return []
+
+def get_products_by_ids(product_ids: List[int]) -> List[Dict[str, Any]]:
+    """Fetches products by id, in the order given (unknown ids are skipped)."""
+    products: Dict[int, Dict[str, Any]] = {}
+    try:
+        with db_connection() as conn:
+            for start in range(0, len(product_ids), BULK_QUERY_CHUNK_SIZE):
+                chunk = product_ids[start:start + BULK_QUERY_CHUNK_SIZE]
+                for row in conn.execute(_products_by_ids_query(len(chunk)), chunk):
+                    products[row["id"]] = dict(row)
+    except sqlite3.Error as e:
+        logger.error("Database error in get_products_by_ids: %s", e)
+    except FileNotFoundError:
+        pass
+    return [products[product_id] for product_id in product_ids if product_id in products]
+
+def get_purchase_history_version() -> int:
+    """Returns the highest Purchase_History id (0 when empty or unavailable)."""
+    try:
+        with db_connection() as conn:
+            return conn.execute(PURCHASE_HISTORY_VERSION_QUERY).fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error("Database error in get_purchase_history_version: %s", e)
+        return 0
+    except FileNotFoundError:
+        return 0
+
+def iter_user_product_purchases(batch_size: int = 100_000) -> Iterator[List[Tuple[int, int, int, int]]]:
+    """
+    Streams every (user_id, school_id, product_id, quantity) purchase aggregate in batches.
+    Unlike the lookups above, database errors propagate: a partial result would build a skewed index.
+    """
+    with db_connection() as conn:
+        cursor = conn.execute(USER_PRODUCT_PURCHASES_QUERY)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [tuple(row) for row in rows]
+
+def iter_product_texts(batch_size: int = 50_000) -> Iterator[List[Tuple[int, str, str]]]:
+    """Streams every (id, name, description) product in batches. Database errors propagate."""
+    with db_connection() as conn:
+        cursor = conn.execute(PRODUCT_TEXTS_QUERY)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [tuple(row) for row in rows]
+
+def get_product_changes(limit: int = 10_000) -> List[Tuple[int, int]]:
+    """Returns the oldest (change_id, product_id) entries of the product change log."""
+    try:
+        with db_connection() as conn:
+            return [tuple(row) for row in conn.execute(PRODUCT_CHANGES_QUERY, (limit,))]
+    except sqlite3.Error as e:
+        logger.error("Database error in get_product_changes: %s", e)
         return []
     except FileNotFoundError:
         return []
 
+def get_product_changes_version() -> int:
+    """Returns the id of the newest product change log entry (0 if there is none)."""
+    try:
+        with db_connection() as conn:
+            return conn.execute(PRODUCT_CHANGES_VERSION_QUERY).fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error("Database error in get_product_changes_version: %s", e)
+        return 0
+    except FileNotFoundError:
+        return 0
+
+def clear_product_changes(up_to_id: int) -> None:
+    """Removes product change log entries up to and including `up_to_id` once they are applied."""
+    try:
+        with db_connection() as conn:
+            conn.execute(CLEAR_PRODUCT_CHANGES_QUERY, (up_to_id,))
+    except sqlite3.Error as e:
+        logger.error("Database error in clear_product_changes: %s", e)
+    except FileNotFoundError:
+        pass
+
 # --- Functions for Conversation History (Task 2.4) ---
 def save_conversation_message(session_id: str, user_id: str, role: str, content: str, timestamp: datetime.datetime) -> Optional[int]:
     """Saves a message to the Conversation_History table."""
     # Ensure this table exists and matches the schema in your DB.
-    # The current DB dump has `Conversation_History` with (id, user_id, message, sender, timestamp)
-    # We'll map `role` to `sender` and `content` to `message`.
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        query = """
-            INSERT INTO Conversation_History (user_id, message, sender, timestamp) 
-            VALUES (?, ?, ?, ?);
-        """
-        # Assuming 'sender' in DB corresponds to 'role'
-        cursor.execute(query, (user_id, content, role, timestamp.isoformat()))
-        conn.commit()
-        message_db_id = cursor.lastrowid
-        conn.close()
-        print(f"Saved message for session {session_id} (DB ID: {message_db_id})")
+    # The current DB dump has `Conversation_History` with (id, user_id, message, sender, timestamp);
+    # migration 2 adds `session_id`. We'll map `role` to `sender` and `content` to `message`.
+    try:
+        with db_connection() as conn:
+            # Assuming 'sender' in DB corresponds to 'role'
+            cursor = conn.execute(SAVE_CONVERSATION_MESSAGE_QUERY, (session_id, user_id, content, role, timestamp.isoformat()))
+            message_db_id = cursor.lastrowid
+        logger.debug("Saved message for session %s (DB ID: %s)", session_id, message_db_id)
         return message_db_id
     except sqlite3.Error as e:
-        print(f"Database error in save_conversation_message for session {session_id}: {e}")
+        logger.error("Database error in save_conversation_message for session %s: %s", session_id, e)
         return None
     except FileNotFoundError:
         return None
 
+def save_conversation_messages(messages: List[Tuple[str, str, str, str, datetime.datetime]]) -> int:
+    """
+    Saves a batch of (session_id, user_id, role, content, timestamp) messages in a single transaction.
+    Raises sqlite3.Error on failure so callers (the write-behind queue) can retry the batch.
+    """
+    if not messages:
+        return 0
+    rows = [(session_id, user_id, content, role, timestamp.isoformat()) for session_id, user_id, role, content, timestamp in messages]
+    with db_connection() as conn:
+        conn.executemany(SAVE_CONVERSATION_MESSAGE_QUERY, rows)
+    return len(rows)
 
-def get_conversation_history_from_db(session_id: str, user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
-    """Fetches conversation history for a user from the Conversation_History table."""
-    # Note: The DB table doesn't have session_id.
-    # This function will fetch by user_id for now, which might mix sessions if one user has multiple.
-    # For true session isolation with DB, the Conversation_History table would need a session_id column.
-    # Or, we rely on the in-memory `conversation_sessions` for strict session isolation in the prototype.
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        query = """
-            SELECT id, user_id, message as content, sender as role, timestamp 
-            FROM Conversation_History
-            WHERE user_id = ? 
-            ORDER BY timestamp DESC 
-            LIMIT ?;
-        """
-        cursor.execute(query, (user_id, limit))
-        # Convert timestamps back to datetime objects if stored as strings
-        history_raw = [dict(row) for row in cursor.fetchall()]
-        history = []
-        for msg_raw in reversed(history_raw): # Reverse to get chronological order
-            try:
-                msg_raw['timestamp'] = datetime.datetime.fromisoformat(msg_raw['timestamp'])
-                history.append(msg_raw)
-            except (TypeError, ValueError) as e:
-                print(f"Warning: Could not parse timestamp for message ID {msg_raw.get('id')}: {msg_raw.get('timestamp')}, error: {e}")
-                # Add with original timestamp string or skip
-                history.append(msg_raw)
-
-        conn.close()
-        return history
+
+def _parse_history_rows(history_raw: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Converts newest-first history rows into chronological order with datetime timestamps."""
+    history = []
+    for msg_raw in reversed(history_raw): # Reverse to get chronological order
+        try:
+            msg_raw['timestamp'] = datetime.datetime.fromisoformat(msg_raw['timestamp'])
+            history.append(msg_raw)
+        except (TypeError, ValueError) as e:
+            logger.warning("Could not parse timestamp for message ID %s: %s, error: %s", msg_raw.get('id'), msg_raw.get('timestamp'), e)
+            # Add with original timestamp string or skip
+            history.append(msg_raw)
+    return history
+
+def get_conversation_history_from_db(session_id: Optional[str], user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """
+    Fetches the most recent messages of a session from the Conversation_History table.
+    Without a session_id, falls back to the user's most recent messages across all sessions.
+    """
+    try:
+        with db_connection() as conn:
+            if session_id:
+                rows = conn.execute(SESSION_HISTORY_QUERY, (session_id, limit))
+            else:
+                rows = conn.execute(USER_HISTORY_QUERY, (user_id, limit))
+            history_raw = [dict(row) for row in rows]
+        return _parse_history_rows(history_raw)
     except sqlite3.Error as e:
-        print(f"Database error in get_conversation_history_from_db for user {user_id}: {e}")
+        logger.error("Database error in get_conversation_history_from_db for user %s: %s", user_id, e)
         return []
     except FileNotFoundError:
-        return [] 
\ No newline at end of file
+        return []
+
+def encode_history_cursor(message: Dict[str, Any]) -> str:
+    """Builds the opaque keyset cursor ('<timestamp>|<id>') pointing just before a message."""
+    timestamp = message['timestamp']
+    if isinstance(timestamp, datetime.datetime):
+        timestamp = timestamp.isoformat()
+    return f"{timestamp}|{message['id']}"
+
+def decode_history_cursor(cursor: str) -> Tuple[str, int]:
+    """Parses a cursor produced by encode_history_cursor. Raises ValueError if malformed."""
+    timestamp, _, message_id = cursor.rpartition("|")
+    if not timestamp:
+        raise ValueError(f"Malformed history cursor: {cursor!r}")
+    try:
+        datetime.datetime.fromisoformat(timestamp)
+        return timestamp, int(message_id)
+    except ValueError:
+        raise ValueError(f"Malformed history cursor: {cursor!r}") from None
+
+def get_conversation_history_page(session_id: str, before: Optional[str] = None, limit: int = 20) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Keyset-paginated session history. Returns (messages in chronological order, cursor for the
+    next older page or None). Each page is an index range scan, so its cost does not grow with
+    the table size or with how far back the client has paged.
+    """
+    with db_connection() as conn:
+        if before:
+            before_timestamp, before_id = decode_history_cursor(before)
+            rows = conn.execute(SESSION_HISTORY_PAGE_QUERY, (session_id, before_timestamp, before_id, limit + 1))
+        else:
+            rows = conn.execute(SESSION_HISTORY_QUERY, (session_id, limit + 1))
+        history_raw = [dict(row) for row in rows]
+    # One extra row is fetched to know whether an older page exists
+    has_more = len(history_raw) > limit
+    history = _parse_history_rows(history_raw[:limit])
+    next_cursor = encode_history_cursor(history[0]) if has_more and history else None
+    return history, next_cursor
+
+
+# --- Functions for shared session windows (multi-worker session store) ---
+def get_session_window(session_id: str, oldest: float) -> Optional[Dict[str, Any]]:
+    """Returns a session's stored window (`messages` and `summary` as JSON text) if it was updated at or after `oldest`."""
+    try:
+        with db_connection() as conn:
+            row = conn.execute(SESSION_WINDOW_QUERY, (session_id, oldest)).fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        logger.error("Database error in get_session_window for session %s: %s", session_id, e)
+        return None
+    except FileNotFoundError:
+        return None
+
+def get_session_summary(session_id: str, oldest: float) -> Optional[str]:
+    """Returns a session's stored rolling summary (JSON text) if the session was updated at or after `oldest`."""
+    try:
+        with db_connection() as conn:
+            row = conn.execute(SESSION_SUMMARY_QUERY, (session_id, oldest)).fetchone()
+        return row["summary"] if row else None
+    except sqlite3.Error as e:
+        logger.error("Database error in get_session_summary for session %s: %s", session_id, e)
+        return None
+    except FileNotFoundError:
+        return None
+
+def update_session_window(session_id: str, user_id: str, oldest: float, updated_at: float,
+                          update: Callable[[Optional[Dict[str, Any]]], Tuple[str, Optional[str]]]) -> None:
+    """
+    Read-modify-write of a session window: `update` gets the current window (None if missing or
+    older than `oldest`) and returns the new (messages, summary). The transaction takes the write
+    lock up front, so workers appending to the same session at once never drop each other's
+    messages. Raises sqlite3.Error on failure.
+    """
+    with db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE;")
+        row = conn.execute(SESSION_WINDOW_QUERY, (session_id, oldest)).fetchone()
+        messages, summary = update(dict(row) if row else None)
+        conn.execute(UPSERT_SESSION_WINDOW_QUERY, (session_id, user_id, messages, summary, updated_at))
+
+def delete_expired_session_windows(oldest: float) -> int:
+    """Deletes session windows last updated before `oldest`. Returns the number deleted."""
+    try:
+        with db_connection() as conn:
+            return conn.execute(DELETE_EXPIRED_SESSION_WINDOWS_QUERY, (oldest,)).rowcount
+    except sqlite3.Error as e:
+        logger.error("Database error in delete_expired_session_windows: %s", e)
+        return 0
+    except FileNotFoundError:
+        return 0
+
+def record_profile_invalidation(user_id: str, invalidated_at: float) -> bool:
+    """Records that a user's cached profile is stale as of `invalidated_at`. Returns whether it was recorded."""
+    try:
+        with db_connection() as conn:
+            conn.execute(RECORD_PROFILE_INVALIDATION_QUERY, (user_id, invalidated_at))
+        return True
+    except sqlite3.Error as e:
+        logger.error("Database error in record_profile_invalidation for user %s: %s", user_id, e)
+        return False
+    except FileNotFoundError:
+        return False
+
+def get_profile_invalidations_since(oldest: float) -> List[Tuple[str, float]]:
+    """Returns (user_id, invalidated_at) for invalidations at or after `oldest`, deleting older ones."""
+    try:
+        with db_connection() as conn:
+            conn.execute(DELETE_OLD_PROFILE_INVALIDATIONS_QUERY, (oldest,))
+            return [(row["user_id"], row["invalidated_at"]) for row in conn.execute(PROFILE_INVALIDATIONS_SINCE_QUERY, (oldest,))]
+    except sqlite3.Error as e:
+        logger.error("Database error in get_profile_invalidations_since: %s", e)
+        return []
+    except FileNotFoundError:
+        return []
+
+
+# --- Async API (same semantics as the functions above, run on the DB executor) ---
+async def get_user_details_async(user_id: str) -> Optional[Dict[str, Any]]:
+    return await run_in_db_executor(get_user_details, user_id)
+
+async def get_products_by_keyword_async(keyword: str, limit: int = 5) -> List[Dict[str, Any]]:
+    return await run_in_db_executor(get_products_by_keyword, keyword, limit)
+
+async def get_purchase_history_async(user_id: str, limit: int = 5) -> List[Dict[str, Any]]:
+    return await run_in_db_executor(get_purchase_history, user_id, limit)
+
+async def get_user_purchase_summary_async(user_id: str, limit: int = 5) -> List[Dict[str, Any]]:
+    return await run_in_db_executor(get_user_purchase_summary, user_id, limit)
+
+async def get_user_details_bulk_async(user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    return await run_in_db_executor(get_user_details_bulk, user_ids)
+
+async def get_purchase_summaries_bulk_async(user_ids: List[str], limit: int = 5) -> Dict[str, List[Dict[str, Any]]]:
+    return await run_in_db_executor(get_purchase_summaries_bulk, user_ids, limit)
+
+async def get_recently_active_user_ids_async(limit: int) -> List[str]:
+    return await run_in_db_executor(get_recently_active_user_ids, limit)
+
+async def get_products_by_ids_async(product_ids: List[int]) -> List[Dict[str, Any]]:
+    return await run_in_db_executor(get_products_by_ids, product_ids)
+
+async def save_conversation_message_async(session_id: str, user_id: str, role: str, content: str, timestamp: datetime.datetime) -> Optional[int]:
+    return await run_in_db_executor(save_conversation_message, session_id, user_id, role, content, timestamp)
+
+async def get_conversation_history_from_db_async(session_id: Optional[str], user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
+    return await run_in_db_executor(get_conversation_history_from_db, session_id, user_id, limit)
+
+async def get_conversation_history_page_async(session_id: str, before: Optional[str] = None, limit: int = 20) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    return await run_in_db_executor(get_conversation_history_page, session_id, before, limit)
+
+async def get_session_window_async(session_id: str, oldest: float) -> Optional[Dict[str, Any]]:
+    return await run_in_db_executor(get_session_window, session_id, oldest)
+
+async def get_session_summary_async(session_id: str, oldest: float) -> Optional[str]:
+    return await run_in_db_executor(get_session_summary, session_id, oldest)
+
+async def update_session_window_async(session_id: str, user_id: str, oldest: float, updated_at: float,
+                                      update: Callable[[Optional[Dict[str, Any]]], Tuple[str, Optional[str]]]) -> None:
+    return await run_in_db_executor(update_session_window, session_id, user_id, oldest, updated_at, update)
+
+async def delete_expired_session_windows_async(oldest: float) -> int:
+    return await run_in_db_executor(delete_expired_session_windows, oldest)
+
+async def record_profile_invalidation_async(user_id: str, invalidated_at: float) -> bool:
+    return await run_in_db_executor(record_profile_invalidation, user_id, invalidated_at)
+
+async def get_profile_invalidations_since_async(oldest: float) -> List[Tuple[str, float]]:
+    return await run_in_db_executor(get_profile_invalidations_since, oldest)
+
+
+# --- Maintenance commands ---
+# python db_utils.py migrate | rebuild-product-index
+if __name__ == "__main__":
+    import sys
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if command == "migrate":
+        print(f"Database schema is at version {apply_migrations()}")
+    elif command == "rebuild-product-index":
+        apply_migrations()
+        rebuild_product_search_index()
+        print("Product search index rebuilt.")
+    else:
+        print(f"Unknown command: {command}. Expected 'migrate' or 'rebuild-product-index'.")
+        sys.exit(1)
+    close_connection_pool()
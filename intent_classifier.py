@@ -0,0 +1,275 @@
+import json
+import logging
+import math
+import os
+import random
+import re
+import zlib
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Tuple, Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# --- Intent classifier settings (overridable through environment variables) ---
+# Path to a JSON model written by `python intent_classifier.py train ...`; unset disables the classifier
+INTENT_MODEL_PATH = os.getenv("CARTON_CAPS_INTENT_MODEL")
+INTENT_MIN_CONFIDENCE = float(os.getenv("CARTON_CAPS_INTENT_MIN_CONFIDENCE", "0.6"))
+
+REFERRAL_INTENT = "referral_question"
+PRODUCT_INTENT = "product_query"
+GENERAL_INTENT = "general_conversation"
+
+# Rule scores below this are treated as "no rule fired"
+_MIN_RULE_SCORE = 0.75
+
+
+@dataclass(frozen=True)
+class KeywordRule:
+    """What a matched phrase contributes: a score towards `intent` and, for product terms, a search slot."""
+    intent: str
+    weight: float = 1.0
+    slot: Optional[str] = None
+
+
+# Phrases are matched on word boundaries, so "refer" no longer fires inside "preferences" and
+# "bar" no longer fires inside "barely". Weak cues ("find", "friend") only decide the intent when
+# nothing stronger is present, e.g. "Can my friend find cereal here?" is a product query.
+REFERRAL_PHRASES: Dict[str, float] = {
+    "referral": 1.0, "referrals": 1.0, "refer": 1.0, "referring": 1.0, "referred": 1.0,
+    "refer a friend": 1.5, "referral link": 1.5, "referral code": 1.5, "referral bonus": 1.5,
+    "invite": 1.0, "invites": 1.0, "inviting": 1.0, "invitation": 1.0,
+    "friend": 0.5, "friends": 0.5, "sign up bonus": 1.0, "bonus": 0.5, "reward": 0.5, "rewards": 0.5,
+}
+PRODUCT_CUES: Dict[str, float] = {
+    "product": 1.0, "products": 1.0, "recommend": 1.0, "recommendation": 1.0, "recommendations": 1.0,
+    "suggest": 0.75, "buy": 0.75, "shop": 0.75, "price": 0.75, "find": 0.5, "search": 0.5,
+    "healthy": 0.75, "lunch": 0.75, "lunchbox": 1.0, "lunchboxes": 1.0, "lunch box": 1.0, "lunch boxes": 1.0,
+}
+# Product term -> canonical search term. The FTS index stems, so the canonical form covers plurals.
+PRODUCT_TERMS: Dict[str, str] = {
+    "cereal": "cereal", "cereals": "cereal", "flakes": "flakes", "corn flakes": "flakes",
+    "snack": "snack", "snacks": "snack", "bar": "bar", "bars": "bar", "granola": "granola",
+    "fruit": "fruit", "fruits": "fruit", "fruit cup": "fruit", "fruit cups": "fruit",
+    "cheese": "cheese", "mac and cheese": "cheese", "macaroni": "macaroni", "crackers": "crackers", "cracker": "crackers",
+    "oatmeal": "oatmeal", "oats": "oatmeal", "juice": "juice", "juices": "juice", "milk": "milk",
+    "yogurt": "yogurt", "yoghurt": "yogurt", "pasta": "pasta", "bread": "bread",
+    "pretzels": "pretzels", "popcorn": "popcorn", "trail mix": "trail mix", "breakfast": "breakfast",
+}
+
+
+def default_rules() -> Dict[str, KeywordRule]:
+    """The built-in vocabulary as phrase -> KeywordRule."""
+    rules = {phrase: KeywordRule(REFERRAL_INTENT, weight) for phrase, weight in REFERRAL_PHRASES.items()}
+    rules.update({phrase: KeywordRule(PRODUCT_INTENT, weight) for phrase, weight in PRODUCT_CUES.items()})
+    rules.update({phrase: KeywordRule(PRODUCT_INTENT, 1.0, slot) for phrase, slot in PRODUCT_TERMS.items()})
+    return rules
+
+
+class PhraseAutomaton:
+    """
+    Aho-Corasick automaton over lowercase phrases.
+
+    All phrases are found in a single left-to-right pass over the text, so matching cost
+    depends on the text length and number of matches, not on the vocabulary size.
+    """
+
+    def __init__(self, phrases: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._outputs: List[List[str]] = [[]]
+        for phrase in phrases:
+            self._add(phrase.lower())
+        self._build_failure_links()
+
+    def _add(self, phrase: str) -> None:
+        node = 0
+        for char in phrase:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+            node = next_node
+        self._outputs[node].append(phrase)
+
+    def _build_failure_links(self) -> None:
+        pending = deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, child in self._goto[node].items():
+                pending.append(child)
+                if node:
+                    fallback = self._fail[node]
+                    while fallback and char not in self._goto[fallback]:
+                        fallback = self._fail[fallback]
+                    self._fail[child] = self._goto[fallback].get(char, 0)
+                # Inherit the fallback's outputs so matching never walks the failure chain for outputs
+                self._outputs[child] = self._outputs[child] + self._outputs[self._fail[child]]
+
+    def find(self, text: str) -> Iterator[Tuple[int, str]]:
+        """Yields (start offset, phrase) for every phrase occurring in `text` on word boundaries."""
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for phrase in outputs[node]:
+                start = end - len(phrase) + 1
+                if (start == 0 or not text[start - 1].isalnum()) and (end + 1 == len(text) or not text[end + 1].isalnum()):
+                    yield start, phrase
+
+
+class HashedNgramClassifier:
+    """
+    Multinomial logistic regression over hashed word unigrams and bigrams.
+
+    Small enough to train in seconds on a few hundred labelled messages and to score with a
+    single pass over the tokens. Used as a fallback when no keyword rule fires.
+    """
+
+    _TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+    def __init__(self, labels: List[str], n_features: int = 4096, weights: Optional[List[List[float]]] = None,
+                 bias: Optional[List[float]] = None):
+        self.labels = labels
+        self.n_features = n_features
+        self.weights = weights or [[0.0] * n_features for _ in labels]
+        self.bias = bias or [0.0] * len(labels)
+
+    def features(self, text: str) -> Dict[int, float]:
+        tokens = self._TOKEN_PATTERN.findall(text.lower())
+        grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        counts: Dict[int, float] = {}
+        for gram in grams:
+            index = zlib.crc32(gram.encode("utf-8")) % self.n_features
+            counts[index] = counts.get(index, 0.0) + 1.0
+        return counts
+
+    def _probabilities(self, features: Dict[int, float]) -> List[float]:
+        scores = [bias + sum(row[i] * value for i, value in features.items()) for row, bias in zip(self.weights, self.bias)]
+        top = max(scores)
+        exps = [math.exp(score - top) for score in scores]
+        total = sum(exps)
+        return [value / total for value in exps]
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """Returns (label, probability) for the most likely label."""
+        probabilities = self._probabilities(self.features(text))
+        best = max(range(len(self.labels)), key=probabilities.__getitem__)
+        return self.labels[best], probabilities[best]
+
+    def fit(self, examples: List[Tuple[str, str]], epochs: int = 30, learning_rate: float = 0.5,
+            l2: float = 1e-4, seed: int = 0) -> None:
+        """Trains with plain SGD on (text, label) pairs."""
+        label_index = {label: i for i, label in enumerate(self.labels)}
+        encoded = [(self.features(text), label_index[label]) for text, label in examples]
+        rng = random.Random(seed)
+        for _ in range(epochs):
+            rng.shuffle(encoded)
+            for features, target in encoded:
+                probabilities = self._probabilities(features)
+                for k, row in enumerate(self.weights):
+                    gradient = probabilities[k] - (1.0 if k == target else 0.0)
+                    self.bias[k] -= learning_rate * gradient
+                    for i, value in features.items():
+                        row[i] -= learning_rate * (gradient * value + l2 * row[i])
+
+    def save(self, path: str) -> None:
+        # Only non-zero weights are stored; most hashed buckets are never touched
+        sparse = [{str(i): round(w, 6) for i, w in enumerate(row) if w} for row in self.weights]
+        with open(path, "w") as f:
+            json.dump({"labels": self.labels, "n_features": self.n_features, "bias": self.bias, "weights": sparse}, f)
+
+    @classmethod
+    def load(cls, path: str) -> "HashedNgramClassifier":
+        with open(path) as f:
+            data = json.load(f)
+        weights = []
+        for sparse_row in data["weights"]:
+            row = [0.0] * data["n_features"]
+            for index, value in sparse_row.items():
+                row[int(index)] = value
+            weights.append(row)
+        return cls(data["labels"], data["n_features"], weights, data["bias"])
+
+
+@dataclass
+class IntentResult:
+    intent: str
+    product_terms: List[str] = field(default_factory=list)
+    confidence: float = 1.0
+    source: str = "rules"  # "rules", "classifier" or "default"
+
+
+class IntentEngine:
+    """
+    Detects the intent of a chat message and extracts product search terms.
+
+    Keyword and synonym rules are compiled into one PhraseAutomaton, so a single pass yields
+    every matched phrase; their weights are summed per intent and every product term is
+    collected as a slot. When no rule fires, the optional classifier decides (if confident).
+    """
+
+    def __init__(self, rules: Optional[Dict[str, KeywordRule]] = None, classifier: Optional[HashedNgramClassifier] = None,
+                 min_confidence: float = INTENT_MIN_CONFIDENCE):
+        self.rules = {phrase.lower(): rule for phrase, rule in (rules or default_rules()).items()}
+        self.automaton = PhraseAutomaton(self.rules)
+        self.classifier = classifier
+        self.min_confidence = min_confidence
+
+    def load_classifier(self, path: Optional[str] = INTENT_MODEL_PATH) -> None:
+        """Loads the optional n-gram classifier (called once at startup)."""
+        if not path:
+            return
+        try:
+            self.classifier = HashedNgramClassifier.load(path)
+            logger.info("Intent classifier loaded from %s (%s).", path, ", ".join(self.classifier.labels))
+        except (OSError, ValueError, KeyError) as e:
+            logger.error("Could not load intent classifier from %s: %s", path, e)
+
+    def detect(self, message_text: str) -> IntentResult:
+        scores: Dict[str, float] = {}
+        product_terms: List[str] = []
+        for _, phrase in self.automaton.find(message_text.lower()):
+            rule = self.rules[phrase]
+            scores[rule.intent] = scores.get(rule.intent, 0.0) + rule.weight
+            # Synonyms share a canonical slot, so overlapping matches ("fruit" in "fruit cups") add it once
+            if rule.slot and rule.slot not in product_terms:
+                product_terms.append(rule.slot)
+
+        if scores:
+            intent, score = max(scores.items(), key=lambda item: (item[1], item[0] == REFERRAL_INTENT))
+            if score >= _MIN_RULE_SCORE:
+                total = sum(scores.values())
+                return IntentResult(intent, product_terms if intent == PRODUCT_INTENT else [], round(score / total, 3))
+
+        if self.classifier is not None:
+            label, probability = self.classifier.predict(message_text)
+            if probability >= self.min_confidence:
+                return IntentResult(label, product_terms if label == PRODUCT_INTENT else [], round(probability, 3), "classifier")
+        return IntentResult(GENERAL_INTENT, [], 1.0, "default")
+
+
+# Shared instance used by the chat endpoint
+intent_engine = IntentEngine()
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: python intent_classifier.py train examples.jsonl model.json
+    #   where each line of examples.jsonl is {"text": "...", "intent": "..."}
+    if len(sys.argv) != 4 or sys.argv[1] != "train":
+        print("Usage: python intent_classifier.py train <examples.jsonl> <model.json>")
+        sys.exit(1)
+    with open(sys.argv[2]) as f:
+        training_examples = [(row["text"], row["intent"]) for row in (json.loads(line) for line in f if line.strip())]
+    classifier = HashedNgramClassifier(sorted({label for _, label in training_examples}))
+    classifier.fit(training_examples)
+    correct = sum(classifier.predict(text)[0] == label for text, label in training_examples)
+    classifier.save(sys.argv[3])
+    print(f"Trained on {len(training_examples)} examples ({correct / len(training_examples):.1%} training accuracy); saved to {sys.argv[3]}")
@@ -0,0 +1,241 @@
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional, List, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+# --- Knowledge base documents (referral program PDFs) ---
+# Assuming 'data' subdirectory at the same level as knowledge_base.py
+KNOWLEDGE_BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+REFERRAL_DOCUMENTS = {
+    "Referral_FAQ_PDF": os.path.join(KNOWLEDGE_BASE_DIR, 'CartonCapsReferralFAQs.pdf'),
+    "Referral_Rules_PDF": os.path.join(KNOWLEDGE_BASE_DIR, 'CartonCapsReferralProgramRules.pdf'),
+}
+# Parsed chunks are saved here, keyed by the documents' mtimes, so restarts and other worker
+# processes skip PDF parsing (and importing PyMuPDF) until a document changes
+KNOWLEDGE_BASE_CACHE_PATH = os.getenv("CARTON_CAPS_KNOWLEDGE_BASE_CACHE",
+                                      os.path.join(KNOWLEDGE_BASE_DIR, 'knowledge_base_cache.json'))
+
+# After a document fails to parse, searches wait this long before parsing again
+PARSE_RETRY_SECONDS = 60
+
+# Chunks longer than this (in words) are split into overlapping windows
+MAX_CHUNK_WORDS = 120
+CHUNK_OVERLAP_WORDS = 20
+
+# BM25 tuning parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+# Numbered FAQ/rules headings, e.g. "2. How do I refer a friend?"
+_SECTION_PATTERN = re.compile(r"(?<![\w$.])(?=\d{1,2}\.\s+[A-Z])")
+_STOPWORDS = frozenset({
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how",
+    "i", "if", "in", "is", "it", "me", "my", "of", "on", "or", "so", "that", "the", "their",
+    "this", "to", "was", "we", "what", "when", "where", "which", "who", "will", "with", "you", "your",
+})
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercases text and returns its index terms (stopwords removed, plurals folded)."""
+    terms = []
+    for token in _TOKEN_PATTERN.findall(text.lower()):
+        if token in _STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        terms.append(token)
+    return terms
+
+
+def get_text_from_pdf(pdf_path: str) -> Optional[str]:
+    """Extracts all text content from a PDF file."""
+    import fitz  # PyMuPDF; imported on first parse since it is slow to load and usually not needed
+
+    try:
+        doc = fitz.open(pdf_path)
+        text = ""
+        for page_num in range(len(doc)):
+            page = doc.load_page(page_num)
+            text += page.get_text()
+        doc.close()
+        # Basic cleaning: replace multiple newlines/spaces with a single space
+        text = ' '.join(text.replace('\n', ' ').split())
+        return text
+    except FileNotFoundError:
+        logger.error("PDF file not found at %s", pdf_path)
+        return None
+    except Exception as e:
+        logger.error("Error reading PDF file %s: %s", pdf_path, e)
+        return None
+
+
+def split_into_chunks(text: str) -> List[str]:
+    """Splits document text on its numbered sections, windowing any section that is too long."""
+    chunks = []
+    for section in _SECTION_PATTERN.split(text):
+        words = section.split()
+        if not words:
+            continue
+        if len(words) <= MAX_CHUNK_WORDS:
+            chunks.append(" ".join(words))
+            continue
+        step = MAX_CHUNK_WORDS - CHUNK_OVERLAP_WORDS
+        for start in range(0, len(words), step):
+            chunks.append(" ".join(words[start:start + MAX_CHUNK_WORDS]))
+            if start + MAX_CHUNK_WORDS >= len(words):
+                break
+    return chunks
+
+
+@dataclass(frozen=True)
+class Chunk:
+    source: str
+    text: str
+
+
+class KnowledgeBase:
+    """
+    In-memory BM25 index over a set of PDF documents.
+
+    Documents are parsed once (at startup via `load()`, or lazily on first search) and
+    re-parsed only when a file's mtime changes, so the request path never touches PyMuPDF
+    unless a document was actually updated on disk. Parsed chunks are also saved to
+    `cache_path`, which later processes load instead of parsing.
+    """
+
+    def __init__(self, documents: Dict[str, str], cache_path: Optional[str] = KNOWLEDGE_BASE_CACHE_PATH):
+        self.documents = documents
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._mtimes: Dict[str, Optional[float]] = {}
+        self._chunks: List[Chunk] = []
+        self._chunk_lengths: List[int] = []
+        self._avg_chunk_length = 0.0
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}  # term -> [(chunk_id, term_freq)]
+        self._retry_at = 0.0  # Set after a failed parse, so requests do not re-parse on every search
+
+    def _current_mtimes(self) -> Dict[str, Optional[float]]:
+        mtimes = {}
+        for source, path in self.documents.items():
+            try:
+                mtimes[source] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[source] = None
+        return mtimes
+
+    @property
+    def chunks(self) -> List[Chunk]:
+        """The indexed chunks (a new list after every reload)."""
+        return self._chunks
+
+    def is_stale(self) -> bool:
+        return self._current_mtimes() != self._mtimes and time.monotonic() >= self._retry_at
+
+    def load(self) -> None:
+        """(Re)parses every document and rebuilds the inverted index if any file changed."""
+        with self._lock:
+            mtimes = self._current_mtimes()
+            if mtimes == self._mtimes:
+                return
+
+            chunks = self._load_cached_chunks(mtimes)
+            parsed_all = True
+            if chunks is None:
+                chunks = []
+                for source, path in self.documents.items():
+                    if mtimes[source] is None:
+                        logger.warning("Knowledge base document '%s' not found at %s", source, path)
+                        continue
+                    text = get_text_from_pdf(path)
+                    if text:
+                        chunks.extend(Chunk(source=source, text=chunk_text) for chunk_text in split_into_chunks(text))
+                    else:
+                        parsed_all = False
+                if parsed_all:
+                    self._save_cached_chunks(mtimes, chunks)
+
+            postings: Dict[str, List[Tuple[int, int]]] = {}
+            chunk_lengths = []
+            for chunk_id, chunk in enumerate(chunks):
+                term_counts = Counter(tokenize(chunk.text))
+                chunk_lengths.append(sum(term_counts.values()))
+                for term, freq in term_counts.items():
+                    postings.setdefault(term, []).append((chunk_id, freq))
+
+            self._chunks = chunks
+            self._chunk_lengths = chunk_lengths
+            self._avg_chunk_length = (sum(chunk_lengths) / len(chunk_lengths)) if chunk_lengths else 0.0
+            self._postings = postings
+            if parsed_all:
+                self._mtimes = mtimes
+            else:
+                # Serve what parsed, and parse again later rather than keeping a partial index until the files change
+                self._retry_at = time.monotonic() + PARSE_RETRY_SECONDS
+            logger.info("Knowledge base indexed %d chunks from %d documents.", len(chunks), len(self.documents))
+
+    def _load_cached_chunks(self, mtimes: Dict[str, Optional[float]]) -> Optional[List[Chunk]]:
+        """Chunks saved by a previous parse of the same document versions, or None."""
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get("mtimes") != mtimes:
+            return None
+        return [Chunk(source=source, text=text) for source, text in cached["chunks"]]
+
+    def _save_cached_chunks(self, mtimes: Dict[str, Optional[float]], chunks: List[Chunk]) -> None:
+        if not self.cache_path:
+            return
+        temp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump({"mtimes": mtimes, "chunks": [[chunk.source, chunk.text] for chunk in chunks]}, f)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            logger.warning("Could not save the parsed knowledge base to %s: %s", self.cache_path, e)
+
+    def search(self, query: str, top_k: int = 3) -> List[Chunk]:
+        """
+        Returns the top_k chunks for the query ranked by BM25.
+        Falls back to the leading chunks when no query term appears in the index.
+        """
+        if self.is_stale():
+            self.load()
+
+        # One consistent snapshot: load() may replace the index from another thread while scoring
+        with self._lock:
+            chunks, postings = self._chunks, self._postings
+            chunk_lengths, avg_chunk_length = self._chunk_lengths, self._avg_chunk_length
+        if not chunks:
+            return []
+
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            term_postings = postings.get(term)
+            if not term_postings:
+                continue
+            idf = math.log(1 + (len(chunks) - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+            for chunk_id, freq in term_postings:
+                length_norm = 1 - BM25_B + BM25_B * chunk_lengths[chunk_id] / avg_chunk_length
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * freq * (BM25_K1 + 1) / (freq + BM25_K1 * length_norm)
+
+        if not scores:
+            return chunks[:top_k]
+        ranked = sorted(scores, key=lambda chunk_id: (-scores[chunk_id], chunk_id))
+        return [chunks[chunk_id] for chunk_id in ranked[:top_k]]
+
+
+# Shared instance used by the chat endpoint
+referral_knowledge_base = KnowledgeBase(REFERRAL_DOCUMENTS)
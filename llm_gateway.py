@@ -0,0 +1,313 @@
+import asyncio
+import functools
+import logging
+import os
+import random
+import time
+from typing import Optional, Dict, Any, AsyncIterator, Callable, Tuple
+
+logger = logging.getLogger(__name__)
+
+# --- LLM gateway settings (overridable through environment variables) ---
+LLM_MAX_CONCURRENCY = int(os.getenv("CARTON_CAPS_LLM_MAX_CONCURRENCY", "16"))  # Outbound calls in flight
+LLM_MAX_QUEUED = int(os.getenv("CARTON_CAPS_LLM_MAX_QUEUED", "256"))  # Calls waiting for a slot before new ones are rejected
+LLM_ATTEMPT_TIMEOUT_SECONDS = float(os.getenv("CARTON_CAPS_LLM_ATTEMPT_TIMEOUT", "20"))  # Per attempt (per chunk when streaming)
+LLM_DEADLINE_SECONDS = float(os.getenv("CARTON_CAPS_LLM_DEADLINE", "30"))  # Per call, including queueing and retries
+LLM_MAX_RETRIES = int(os.getenv("CARTON_CAPS_LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("CARTON_CAPS_LLM_BACKOFF_BASE", "0.25"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("CARTON_CAPS_LLM_BACKOFF_MAX", "4"))
+# Start a second, concurrent attempt if the first has not answered after this many seconds (0 disables hedging)
+LLM_HEDGE_AFTER_SECONDS = float(os.getenv("CARTON_CAPS_LLM_HEDGE_AFTER", "0"))
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("CARTON_CAPS_LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("CARTON_CAPS_LLM_BREAKER_RESET", "30"))
+
+
+@functools.lru_cache(maxsize=None)
+def non_retryable_errors() -> Tuple[type, ...]:
+    """Errors caused by the request itself; retrying them cannot help and they say nothing about provider health."""
+    # The Gemini SDK takes about a second to import, so it is only loaded once it is needed
+    from google.api_core import exceptions as google_exceptions
+    from google.generativeai.types import BlockedPromptException, StopCandidateException
+
+    return (
+        google_exceptions.InvalidArgument,
+        google_exceptions.PermissionDenied,
+        google_exceptions.Unauthenticated,
+        google_exceptions.FailedPrecondition,
+        BlockedPromptException,
+        StopCandidateException,
+    )
+
+
+class LLMUnavailable(Exception):
+    """Raised when the gateway cannot produce a reply (breaker open, queue full, deadline exceeded or failed call)."""
+
+
+def _response_text(response: Any) -> str:
+    return "".join(part.text for part in response.parts if hasattr(part, 'text'))
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls for `reset_seconds`.
+    Then a single probe call is let through (half-open): success closes the breaker, failure re-opens it.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = LLM_BREAKER_FAILURE_THRESHOLD, reset_seconds: float = LLM_BREAKER_RESET_SECONDS):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        # Open: let a probe through once reset_seconds have passed. Half-open: the probe is in
+        # flight; another is allowed only if it never reported back (e.g. it was cancelled).
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = self.HALF_OPEN
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opens += 1
+                logger.warning("LLM circuit breaker opened after %d consecutive failures.", self.consecutive_failures)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class LLMGateway:
+    """
+    Single entry point for Gemini calls.
+
+    The Gemini SDK is imported and configured on first use (or by `load_sdk()` in the background
+    at startup). One GenerativeModel per model name is created on first use and reused. Outbound calls are
+    capped by a semaphore (callers queue, up to `max_queued`), every call has an overall
+    deadline, failed attempts are retried with jittered exponential backoff, slow attempts can
+    be hedged with a second concurrent attempt, and a circuit breaker fails fast while the
+    provider is down. Callers handle LLMUnavailable by falling back to cached or templated replies.
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, max_queued: int = LLM_MAX_QUEUED,
+                 attempt_timeout: float = LLM_ATTEMPT_TIMEOUT_SECONDS, deadline: float = LLM_DEADLINE_SECONDS,
+                 max_retries: int = LLM_MAX_RETRIES, backoff_base: float = LLM_BACKOFF_BASE_SECONDS,
+                 backoff_max: float = LLM_BACKOFF_MAX_SECONDS, hedge_after: float = LLM_HEDGE_AFTER_SECONDS,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queued = max_queued
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self.api_key: Optional[str] = None
+        # Builds a model for a model name; defaults to genai.GenerativeModel (load tests swap in a fake)
+        self.model_factory: Optional[Callable[[str], Any]] = None
+        self._models: Dict[str, Any] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.queued = 0
+
+        # Metrics
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def configure(self, api_key: str) -> None:
+        """Sets the Gemini API key used when the SDK is loaded."""
+        self.api_key = api_key
+
+    def load_sdk(self) -> Callable[[str], Any]:
+        """Imports and configures the Gemini SDK, returning the model class. Blocking; cheap after the first call."""
+        import google.generativeai as genai
+
+        genai.configure(api_key=self.api_key)
+        non_retryable_errors()
+        return genai.GenerativeModel
+
+    def _get_model(self, model_name: str) -> Any:
+        model = self._models.get(model_name)
+        if model is None:
+            factory = self.model_factory or self.load_sdk()
+            model = self._models[model_name] = factory(model_name)
+        return model
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Created lazily so it binds to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def _backoff(self, attempt: int) -> float:
+        return min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+    async def _acquire_slot(self, deadline_at: float) -> None:
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise LLMUnavailable("circuit breaker open")
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            raise LLMUnavailable("too many queued LLM calls")
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._get_semaphore().acquire(), timeout=max(0.0, deadline_at - time.monotonic()))
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise LLMUnavailable("deadline exceeded waiting for an LLM slot")
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+
+    def _release_slot(self) -> None:
+        self.in_flight -= 1
+        self._get_semaphore().release()
+
+    def _record_failure(self, error: BaseException) -> None:
+        self.failures += 1
+        if isinstance(error, asyncio.TimeoutError):
+            self.timeouts += 1
+        if isinstance(error, non_retryable_errors()):
+            # The provider answered; the request itself was bad
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    async def _attempt(self, model_name: str, prompt: str, deadline_at: float) -> str:
+        timeout = min(self.attempt_timeout, max(0.0, deadline_at - time.monotonic()))
+        response = await asyncio.wait_for(self._get_model(model_name).generate_content_async(prompt), timeout=timeout)
+        return _response_text(response)
+
+    async def _hedged_attempt(self, model_name: str, prompt: str, deadline_at: float) -> str:
+        primary = asyncio.ensure_future(self._attempt(model_name, prompt, deadline_at))
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_after)
+        # Only hedge when a slot is free right now, so hedging never adds load to a saturated provider
+        if done or self._get_semaphore().locked():
+            return await primary
+        await self._get_semaphore().acquire()
+        self.in_flight += 1
+        self.hedges += 1
+        hedge = asyncio.ensure_future(self._attempt(model_name, prompt, deadline_at))
+        try:
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+                    if not pending:
+                        raise task.exception()
+            raise LLMUnavailable("hedged attempts did not complete")
+        finally:
+            for task in (primary, hedge):
+                task.cancel()
+            self._release_slot()
+
+    async def generate(self, prompt: str, model_name: str) -> str:
+        """Returns the reply text for `prompt`. Raises LLMUnavailable if no reply can be produced in time."""
+        self.calls += 1
+        deadline_at = time.monotonic() + self.deadline
+        await self._acquire_slot(deadline_at)
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    if self.hedge_after > 0:
+                        text = await self._hedged_attempt(model_name, prompt, deadline_at)
+                    else:
+                        text = await self._attempt(model_name, prompt, deadline_at)
+                    self.breaker.record_success()
+                    return text
+                except non_retryable_errors() as e:
+                    self._record_failure(e)
+                    raise LLMUnavailable(f"request rejected by the LLM: {str(e)[:100]}") from e
+                except Exception as e:
+                    self._record_failure(e)
+                    delay = self._backoff(attempt)
+                    if attempt >= self.max_retries or not self.breaker.allow() or time.monotonic() + delay >= deadline_at:
+                        raise LLMUnavailable(f"LLM call failed: {type(e).__name__}: {str(e)[:100]}") from e
+                    logger.warning("LLM attempt %d failed (%s: %s); retrying in %.2fs.", attempt + 1, type(e).__name__, str(e)[:100], delay)
+                    self.retries += 1
+                    await asyncio.sleep(delay)
+            raise LLMUnavailable("LLM call failed")
+        finally:
+            self._release_slot()
+
+    async def stream(self, prompt: str, model_name: str) -> AsyncIterator[str]:
+        """
+        Yields reply text chunks. Attempts are retried only until the first chunk arrives (a partly
+        streamed reply cannot be replayed); the attempt timeout applies to each chunk. Not hedged.
+        """
+        self.calls += 1
+        deadline_at = time.monotonic() + self.deadline
+        await self._acquire_slot(deadline_at)
+        try:
+            for attempt in range(self.max_retries + 1):
+                started = False
+                try:
+                    timeout = min(self.attempt_timeout, max(0.0, deadline_at - time.monotonic()))
+                    response = await asyncio.wait_for(self._get_model(model_name).generate_content_async(prompt, stream=True), timeout=timeout)
+                    chunks = response.__aiter__()
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=self.attempt_timeout)
+                        except StopAsyncIteration:
+                            break
+                        text = _response_text(chunk)
+                        if text:
+                            started = True
+                            yield text
+                    self.breaker.record_success()
+                    return
+                except non_retryable_errors() as e:
+                    self._record_failure(e)
+                    raise LLMUnavailable(f"request rejected by the LLM: {str(e)[:100]}") from e
+                except Exception as e:
+                    self._record_failure(e)
+                    delay = self._backoff(attempt)
+                    if started or attempt >= self.max_retries or not self.breaker.allow() or time.monotonic() + delay >= deadline_at:
+                        raise LLMUnavailable(f"LLM stream failed: {type(e).__name__}: {str(e)[:100]}") from e
+                    logger.warning("LLM stream attempt %d failed (%s: %s); retrying in %.2fs.", attempt + 1, type(e).__name__, str(e)[:100], delay)
+                    self.retries += 1
+                    await asyncio.sleep(delay)
+        finally:
+            self._release_slot()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_concurrency": self.max_concurrency,
+            "calls": self.calls,
+            "failures": self.failures,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "breaker_state": self.breaker.state,
+            "breaker_open": int(self.breaker.state != CircuitBreaker.CLOSED),
+            "breaker_opens": self.breaker.opens,
+        }
+
+
+# Shared instance used by get_gemini_response / stream_gemini_response
+llm_gateway = LLMGateway()
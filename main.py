@@ -1,38 +1,79 @@
+import asyncio
 import datetime
+import json
+import logging
 import os
-from typing import List, Optional, Literal, Dict, Any
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import List, Optional, Literal, Dict, Any, Tuple, AsyncIterator, AsyncIterable, Awaitable, Union
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field, validator
 from dotenv import load_dotenv
 
+# Load environment variables from .env file. This runs before the service modules below are
+# imported, since they read their CARTON_CAPS_* settings at import time.
+load_dotenv()
+
+from fastapi import FastAPI, HTTPException, Query, Header, Request
+from pydantic import BaseModel, Field, ValidationError
+
 # NEW IMPORTS for static files and redirect
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse, PlainTextResponse, Response
+
+try:
+    import orjson  # Optional faster JSON encoder (pip install orjson), see CARTON_CAPS_JSON_SERIALIZER
+except ImportError:
+    orjson = None
 
 # Import your database utility functions
-from db_utils import get_user_details, get_products_by_keyword, get_purchase_history, save_conversation_message, get_conversation_history_from_db
+from db_utils import get_products_by_keyword_async, get_products_by_ids_async, get_conversation_history_page_async, apply_migrations, run_in_db_executor, close_connection_pool
 
-# NEW IMPORT for Google Gemini
-import google.generativeai as genai
+# Batched, write-behind persistence for Conversation_History
+from conversation_writer import conversation_writer
 
-# NEW IMPORT for PDF parsing
-import fitz  # PyMuPDF
+# Bounded, evicting session store (replaces the unbounded in-memory dict)
+from session_store import create_session_store, SESSION_MAX_MESSAGES
 
-# Load environment variables from .env file
-load_dotenv()
+# Shared Gemini client with concurrency limiting, deadlines, retries, hedging and a circuit breaker
+from llm_gateway import llm_gateway, LLMUnavailable
+
+# Referral FAQ/rules knowledge base (PDFs parsed once and indexed in memory)
+from knowledge_base import referral_knowledge_base, Chunk
+
+# Cache for Gemini replies keyed on intent, retrieved context and normalized query
+from response_cache import response_cache, make_cache_key, personalize, depersonalize
+
+# Coalescing of identical in-flight retrievals and LLM replies (single flight)
+from single_flight import retrieval_flights, reply_flights
+
+# Cached user profiles (name, school and most purchased products) shared across turns
+from user_profiles import user_profile_cache, UserProfileRecord
+
+# Co-purchase and per-school popularity tables for ranking and suggesting products
+from recommendations import recommendation_index, RECOMMENDATION_REFRESH_SECONDS, RECOMMENDATIONS_PATH
+
+# Embedding search over products (memory-mapped vectors) and referral passages
+from semantic_index import semantic_index, reciprocal_rank_fusion, SEMANTIC_SYNC_SECONDS
 
-# --- Configure Google Gemini API --- 
+# Multi-worker settings and the lock held by the worker that maintains the shared indexes
+from workers import MULTI_WORKER, SERVER_WORKERS, SHARED_STATE_POLL_SECONDS, maintenance_lock, is_maintainer
+
+# Token-budgeted prompt assembly with a cached system prompt and per-session rolling summary
+from prompt_builder import build_prompt, ContextSection, RollingSummary
+
+# Keyword automaton (plus optional n-gram classifier) for intent detection and product term extraction
+from intent_classifier import intent_engine
+
+# Structured logging, per-stage latency tracing and Prometheus metrics
+from observability import configure_logging, metrics_registry, TurnTrace
+
+configure_logging()
+logger = logging.getLogger("carton_caps")
+
+# --- Google Gemini API key (the SDK is configured by the LLM gateway on startup) --- 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-if not GOOGLE_API_KEY:
-    print("Warning: GOOGLE_API_KEY not found in .env file. Gemini integration will not work.")
-    # You could raise an error here or allow the app to run with Gemini disabled
-else:
-    try:
-        genai.configure(api_key=GOOGLE_API_KEY)
-        print("Google Gemini API configured successfully.")
-    except Exception as e:
-        print(f"Error configuring Google Gemini API: {e}")
 
 # --- Pydantic Models (Based on our API Specification) ---
 
@@ -80,6 +121,7 @@ class DebugInfo(BaseModel):
     retrieved_context_summary: Optional[str] = None
     data_sources_used: Optional[List[str]] = None
     llm_prompt: Optional[str] = None # Added for debugging LLM prompts
+    prompt_tokens: Optional[int] = None # Estimated size of llm_prompt
 
 class ChatResponse(BaseModel):
     session_id: str
@@ -88,227 +130,910 @@ class ChatResponse(BaseModel):
     suggested_actions: Optional[List[SuggestedAction]] = None
     debug_info: Optional[DebugInfo] = None
 
+class ChatDeltaResponse(BaseModel):
+    """
+    Slim chat response: only the messages this turn added, plus history versions so a client can
+    keep its own copy of the conversation (and refetch it through the history endpoint if it has
+    fallen behind, i.e. its newest message is not `previous_version`).
+    """
+    session_id: str
+    reply: Reply
+    new_messages: List[Message] # This turn's messages (plus any history seeded from the request)
+    previous_version: Optional[datetime.datetime] = None # Timestamp of the newest message before this turn
+    history_version: datetime.datetime # Timestamp of the newest message after this turn
+    suggested_actions: Optional[List[SuggestedAction]] = None
+    debug_info: Optional[DebugInfo] = None
+
+class ChatStreamEnd(BaseModel):
+    type: Literal["final"] = "final"
+    session_id: str
+    reply: Reply
+    suggested_actions: Optional[List[SuggestedAction]] = None
+    debug_info: Optional[DebugInfo] = None
+
+class BatchChatResult(BaseModel):
+    """One line of a batch chat response: the slim response for input line `line`, or why it failed."""
+    line: int  # 1-based line number in the input
+    session_id: Optional[str] = None
+    response: Optional[ChatDeltaResponse] = None
+    error: Optional[str] = None
+
+class HistoryPage(BaseModel):
+    session_id: str
+    messages: List[Message]
+    next_cursor: Optional[str] = None # Pass as `before` to fetch the next older page
+
+# --- Response negotiation and serialization ---
+# "pydantic" serializes response models with pydantic-core; "orjson" uses orjson when it is installed
+JSON_SERIALIZER = os.getenv("CARTON_CAPS_JSON_SERIALIZER", "pydantic")
+# Whether responses include debug_info (the full prompt and retrieved context) unless a request asks otherwise
+DEBUG_INFO_DEFAULT = os.getenv("CARTON_CAPS_DEBUG_INFO", "false").lower() in ("1", "true", "yes")
+
+def negotiate_response_mode(response_mode: Optional[str], prefer: Optional[str]) -> str:
+    """`?response_mode=` wins; otherwise a `Prefer: return=minimal` header (RFC 7240) selects the slim response."""
+    if response_mode:
+        return response_mode
+    if prefer and "return=minimal" in prefer.replace(" ", "").lower():
+        return "slim"
+    return "full"
+
+def json_response(model: BaseModel, exclude_none: bool = False, headers: Optional[Dict[str, str]] = None) -> Response:
+    """Serializes a response model directly, skipping FastAPI's jsonable_encoder and response model validation passes."""
+    if JSON_SERIALIZER == "orjson" and orjson is not None:
+        content = orjson.dumps(model.model_dump(exclude_none=exclude_none))
+    else:
+        content = model.model_dump_json(exclude_none=exclude_none)
+    return Response(content=content, media_type="application/json", headers=headers)
+
+# --- Application Lifespan ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs once in every worker process. Shared state (sessions, indexes, cached replies) lives in
+    # the database and in files under data/, so workers started together stay consistent.
+    if GOOGLE_API_KEY:
+        llm_gateway.configure(GOOGLE_API_KEY)
+    else:
+        logger.warning("GOOGLE_API_KEY not found in .env file. Gemini integration will not work.")
+    # Bring the schema (e.g. the product full-text index) up to date before serving traffic
+    await run_in_db_executor(apply_migrations)
+    # Parse and index the referral PDFs once, off the event loop, before serving traffic
+    await asyncio.to_thread(referral_knowledge_base.load)
+    # Fit the passage embeddings now, so the first referral question does not pay for it
+    if referral_knowledge_base.chunks:
+        await asyncio.to_thread(semantic_index.prepare_passages, referral_knowledge_base.chunks)
+    # Load the optional intent classifier model (CARTON_CAPS_INTENT_MODEL) once
+    await asyncio.to_thread(intent_engine.load_classifier)
+    await conversation_writer.start()
+    # Import the Gemini SDK (about a second) in the background so neither startup nor the first turn waits for it
+    sdk_task = asyncio.create_task(load_llm_sdk())
+    # Precompute quick-reply answers in the background so startup is not gated on LLM latency
+    warmup_task = asyncio.create_task(warm_response_cache())
+    # Load the most recently active users' profiles in the background as well
+    preload_task = asyncio.create_task(user_profile_cache.preload())
+    recommendations_task = asyncio.create_task(keep_recommendations_fresh())
+    semantic_task = asyncio.create_task(keep_semantic_index_fresh())
+    invalidations_task = asyncio.create_task(keep_profile_invalidations_synced())
+    yield
+    sdk_task.cancel()
+    invalidations_task.cancel()
+    semantic_task.cancel()
+    warmup_task.cancel()
+    preload_task.cancel()
+    recommendations_task.cancel()
+    # Drain buffered conversation messages before the connection pool goes away
+    await conversation_writer.stop()
+    close_connection_pool()
+    response_cache.close()
+    maintenance_lock.release()
+
 # --- FastAPI Application ---
 app = FastAPI(
     title="Carton Caps AI Conversational Assistant",
     version="1.0.0",
     description="API for the Carton Caps AI chat agent.",
+    lifespan=lifespan,
 )
 
 # --- Mount static files directory (for the simple UI) ---
 # This will serve files from the 'static' directory at the '/ui' path
 # For example, your index.html will be at http://127.0.0.1:8008/ui/index.html
 # If 'static' directory is directly inside 'carton_caps_ai_service' along with main.py
-app.mount("/ui", StaticFiles(directory="static"), name="static-ui")
+app.mount("/ui", StaticFiles(directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")), name="static-ui")
 
-# --- In-memory store for conversation history (for prototype) ---
-# In a production system, this would be a database like Redis or the Conversation_History table.
-conversation_sessions: Dict[str, List[Message]] = {}
+# --- Session store for conversation history ---
+# Keeps only a bounded window of recent messages per session (LRU/TTL evicted). With
+# CARTON_CAPS_SESSION_BACKEND=sqlite, cold sessions are rehydrated from Conversation_History.
+def message_from_db_row(row: Dict[str, Any]) -> Message:
+    """Converts a Conversation_History row (sender 'user'/'bot') into a Message."""
+    return Message(role="assistant" if row["role"] == "bot" else "user", content=row["content"], timestamp=row["timestamp"])
 
-# --- NEW: PDF Text Extraction Function ---
-def get_text_from_pdf(pdf_path: str) -> Optional[str]:
-    """Extracts all text content from a PDF file."""
-    try:
-        doc = fitz.open(pdf_path)
-        text = ""
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            text += page.get_text()
-        doc.close()
-        # Basic cleaning: replace multiple newlines/spaces with a single space
-        text = ' '.join(text.replace('\n', ' ').split())
-        return text
-    except FileNotFoundError:
-        print(f"Error: PDF file not found at {pdf_path}")
-        return None
-    except Exception as e:
-        print(f"Error reading PDF file {pdf_path}: {e}")
-        return None
+session_store = create_session_store(message_from_db_row)
+
+# Component counters are sampled at scrape time and exported as gauges on /metrics
+metrics_registry.register_collector("carton_caps_history_writer", conversation_writer.stats)
+metrics_registry.register_collector("carton_caps_session_store", session_store.stats)
+metrics_registry.register_collector("carton_caps_response_cache", response_cache.stats)
+metrics_registry.register_collector("carton_caps_llm_gateway", llm_gateway.stats)
+metrics_registry.register_collector("carton_caps_user_profiles", user_profile_cache.stats)
+metrics_registry.register_collector("carton_caps_recommendations", recommendation_index.stats)
+metrics_registry.register_collector("carton_caps_semantic_index", semantic_index.stats)
+metrics_registry.register_collector("carton_caps_retrieval_flights", retrieval_flights.stats)
+metrics_registry.register_collector("carton_caps_reply_flights", reply_flights.stats)
+
+# Number of referral FAQ/rules passages included in the prompt
+REFERRAL_CONTEXT_TOP_K = 3
+# Search results fetched for personalized ranking, and products kept in the prompt
+PRODUCT_SEARCH_CANDIDATES = 20
+PRODUCT_CONTEXT_LIMIT = 5
 
 # --- NEW: Gemini LLM Interaction Function ---
-async def get_gemini_response(prompt: str, model_name: str = "gemini-1.5-pro") -> Optional[str]:
+DEFAULT_GEMINI_MODEL = "gemini-1.5-pro"
+
+# Shown when neither the LLM nor a cached or templated answer is available
+LLM_UNAVAILABLE_REPLY = "I'm having a little trouble connecting right now. Please try again in a moment."
+
+async def fallback_response(cache_key: Optional[str], personalization: Optional[Dict[str, str]], fallback_reply: Optional[str]) -> str:
+    """Reply used when the LLM gateway gives up: a cached reply (even if expired), else the templated one."""
+    if cache_key:
+        stale_reply = await response_cache.get_stale(cache_key)
+        if stale_reply is not None:
+            return personalize(stale_reply, personalization)
+    return fallback_reply or LLM_UNAVAILABLE_REPLY
+
+# Shown when Gemini returns an empty reply
+EMPTY_LLM_REPLY = "Sorry, I couldn't generate a response at this moment."
+
+async def generate_shared_reply(prompt: str, model_name: str, cache_key: str, personalization: Optional[Dict[str, str]]) -> str:
+    """
+    Generates the reply for a cacheable turn and caches it with the user's personal values templated
+    out. Returns that depersonalized reply ("" if Gemini returned nothing), which every turn waiting
+    on the same key fills in with its own user's values.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Sending prompt to Gemini (%s):\n%s", model_name, prompt)
+    response_text = await llm_gateway.generate(prompt, model_name)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Gemini response:\n%s", response_text)
+    if not response_text:
+        return ""
+    template = depersonalize(response_text, personalization)
+    await response_cache.set(cache_key, template)
+    return template
+
+async def stream_shared_reply(prompt: str, model_name: str, cache_key: str, personalization: Optional[Dict[str, str]],
+                              chunks: "asyncio.Queue[Optional[str]]") -> str:
+    """Streaming counterpart of generate_shared_reply: also puts each chunk on `chunks`, then None when done."""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Streaming prompt to Gemini (%s):\n%s", model_name, prompt)
+    reply_chunks: List[str] = []
+    try:
+        async for chunk_text in llm_gateway.stream(prompt, model_name):
+            reply_chunks.append(chunk_text)
+            chunks.put_nowait(chunk_text)
+    finally:
+        chunks.put_nowait(None)
+    if not reply_chunks:
+        return ""
+    template = depersonalize("".join(reply_chunks), personalization)
+    await response_cache.set(cache_key, template)
+    return template
+
+async def get_gemini_response(prompt: str, model_name: str = DEFAULT_GEMINI_MODEL, cache_key: Optional[str] = None,
+                              personalization: Optional[Dict[str, str]] = None, fallback_reply: Optional[str] = None) -> Optional[str]:
+    """
+    Calls Gemini for a reply through the LLM gateway. With a cache_key, successful replies are cached
+    (with the user's personal values templated out), later requests with the same key skip the LLM
+    call, and concurrent requests with the same key share one call. If the gateway gives up, a
+    cached or templated reply is returned instead.
+    """
     if not GOOGLE_API_KEY:
-        print("Gemini API key not configured. Skipping LLM call.")
+        logger.debug("Gemini API key not configured. Skipping LLM call.")
         return "[LLM Disabled] This is a placeholder response as the LLM is not configured."
     try:
-        print(f"\n--- Sending prompt to Gemini ({model_name}) ---")
-        print(prompt)
-        print("-------------------------------------\n")
-        model = genai.GenerativeModel(model_name)
-        response = await model.generate_content_async(prompt) # Use async for FastAPI
-        
-        # Extract text from the response parts
-        response_text = "".join(part.text for part in response.parts if hasattr(part, 'text'))
-        
-        print(f"--- Gemini Response ---")
-        print(response_text)
-        print("-----------------------\n")
-        return response_text if response_text else "Sorry, I couldn't generate a response at this moment."
+        if cache_key:
+            cached_reply = await response_cache.get(cache_key)
+            if cached_reply is not None:
+                logger.debug("Response cache hit (%s).", cache_key[:12])
+                return personalize(cached_reply, personalization)
+            template = await reply_flights.run(
+                cache_key, lambda: generate_shared_reply(prompt, model_name, cache_key, personalization))
+            return personalize(template, personalization) if template else EMPTY_LLM_REPLY
+        # Full prompts and replies are only logged at DEBUG level; formatting them on every request is not free
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sending prompt to Gemini (%s):\n%s", model_name, prompt)
+        response_text = await llm_gateway.generate(prompt, model_name)
+    except LLMUnavailable as e:
+        logger.error("Gemini unavailable, using fallback reply: %s", e)
+        return await fallback_response(cache_key, personalization, fallback_reply)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Gemini response:\n%s", response_text)
+    return response_text or EMPTY_LLM_REPLY
+
+async def stream_gemini_response(prompt: str, model_name: str = DEFAULT_GEMINI_MODEL, cache_key: Optional[str] = None,
+                                 personalization: Optional[Dict[str, str]] = None, fallback_reply: Optional[str] = None) -> AsyncIterator[str]:
+    """
+    Streaming counterpart of get_gemini_response: yields reply text chunks as Gemini produces them.
+    A cached or fallback reply is yielded as a single chunk; a complete streamed reply is added to the
+    cache. A request whose key is already being generated waits for that reply and gets it as one chunk.
+    """
+    if not GOOGLE_API_KEY:
+        logger.debug("Gemini API key not configured. Skipping LLM call.")
+        yield "[LLM Disabled] This is a placeholder response as the LLM is not configured."
+        return
+    if cache_key:
+        cached_reply = await response_cache.get(cache_key)
+        if cached_reply is not None:
+            logger.debug("Response cache hit (%s).", cache_key[:12])
+            yield personalize(cached_reply, personalization)
+            return
+        chunk_queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+        shared_reply, leader = reply_flights.submit(
+            cache_key, lambda: stream_shared_reply(prompt, model_name, cache_key, personalization, chunk_queue))
+        if not leader:
+            try:
+                template = await asyncio.shield(shared_reply)
+            except LLMUnavailable as e:
+                logger.error("Gemini unavailable, using fallback reply: %s", e)
+                yield await fallback_response(cache_key, personalization, fallback_reply)
+                return
+            yield personalize(template, personalization) if template else EMPTY_LLM_REPLY
+            return
+        chunks = _drain_chunks(chunk_queue)
+    else:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Streaming prompt to Gemini (%s):\n%s", model_name, prompt)
+        shared_reply = None
+        chunks = llm_gateway.stream(prompt, model_name)
+
+    reply_chunks: List[str] = []
+    try:
+        async for chunk_text in chunks:
+            reply_chunks.append(chunk_text)
+            yield chunk_text
+        if shared_reply is not None:
+            # Raises the gateway error if the stream ended early
+            await asyncio.shield(shared_reply)
+    except LLMUnavailable as e:
+        logger.error("Gemini unavailable while streaming, using fallback reply: %s", e)
+        if reply_chunks:
+            # Part of the reply already reached the client and cannot be replaced
+            yield " ... Sorry, I lost my connection while answering. Please try again."
+        else:
+            yield await fallback_response(cache_key, personalization, fallback_reply)
+        return
+    if not reply_chunks:
+        yield EMPTY_LLM_REPLY
+
+async def _drain_chunks(chunk_queue: "asyncio.Queue[Optional[str]]") -> AsyncIterator[str]:
+    while True:
+        chunk_text = await chunk_queue.get()
+        if chunk_text is None:
+            return
+        yield chunk_text
+
+# --- Chat Pipeline Helpers ---
+# Replies for these intents are grounded only in the retrieved context, so they can be cached and shared
+CACHEABLE_INTENTS = {"referral_question", "product_query"}
+
+# Quick replies offered after every turn; their answers are precomputed at startup
+QUICK_REPLY_ACTIONS = [
+    SuggestedAction(type="quick_reply", text_label="Recommend a snack", payload="Recommend a snack for me"),
+    SuggestedAction(type="quick_reply", text_label="How do referrals work?", payload="How do referrals work?"),
+]
+
+# Neutral identity used when warming the response cache (templated back to the real user on a hit)
+WARMUP_USER_NAME = "Carton Caps member"
+WARMUP_SCHOOL_NAME = "their school"
+
+# (intent, message text, product search terms) -> (retrieved context, data sources used, products found)
+RetrievalKey = Tuple[str, str, Optional[str]]
+RetrievalResult = Tuple[ContextSection, List[str], List[Dict[str, Any]]]
+
+def detect_intent(message_text: str) -> Tuple[str, Optional[str]]:
+    """Returns (detected_intent, product keyword to search or None)."""
+    result = intent_engine.detect(message_text)
+    if result.intent != "product_query":
+        return result.intent, None
+    # Every product term found is searched at once (the full-text query ORs them); with none, search
+    # with the original text and let the full-text search drop filler words like "recommend"/"suggest".
+    return result.intent, " ".join(result.product_terms) if result.product_terms else message_text
+
+async def retrieve_context(detected_intent: str, message_text: str, keyword_to_search: Optional[str],
+                           prefetched: Optional[Dict[RetrievalKey, RetrievalResult]] = None) -> RetrievalResult:
+    """
+    Runs intent-specific retrieval. Returns (retrieved context, data sources used, products found).
+    Retrieval does not depend on the user, so concurrent turns asking the same question share one
+    run, and batches look their results up in `prefetched`.
+    """
+    key = (detected_intent, message_text, keyword_to_search)
+    result = prefetched.get(key) if prefetched else None
+    if result is None:
+        result = await retrieval_flights.run(key, lambda: run_retrieval(*key))
+    context, data_sources, products = result
+    # Callers extend these lists, so each gets its own copy
+    return context, list(data_sources), list(products)
+
+async def run_retrieval(detected_intent: str, message_text: str, keyword_to_search: Optional[str]) -> RetrievalResult:
+    context = ContextSection("")
+    data_sources: List[str] = []
+    products: List[Dict[str, Any]] = []
+    if detected_intent == "referral_question":
+        # Pull only the most relevant FAQ/rules passages from the pre-built indexes (off the event loop)
+        referral_chunks = await asyncio.to_thread(search_referral_passages, message_text)
+        for chunk in referral_chunks:
+            if chunk.source not in data_sources:
+                data_sources.append(chunk.source)
+
+        if referral_chunks:
+            context = ContextSection("Context from Referral FAQ and Program Rules Documents:", tuple(chunk.text for chunk in referral_chunks))
+        else:
+            context = ContextSection("I found our general referral information, but I'm having a little trouble accessing the detailed FAQ document right now. Generally, Carton Caps offers a referral program where you can earn rewards for your school by inviting friends. You can usually find your unique referral link in the app's 'Refer a Friend' section.")
+            logger.warning("Fallback referral context used due to PDF loading issue.")
+    elif detected_intent == "product_query":
+        data_sources.append("Product_DB")
+        logger.debug("Product query detected. Searching for keyword: '%s'", keyword_to_search)
+        products = await search_products(message_text, keyword_to_search, data_sources)
+        context = product_context(products[:PRODUCT_CONTEXT_LIMIT])
+    return context, data_sources, products
+
+def search_referral_passages(message_text: str) -> List[Chunk]:
+    """Hybrid passage search: BM25 and embedding rankings merged by reciprocal rank fusion."""
+    lexical = referral_knowledge_base.search(message_text, REFERRAL_CONTEXT_TOP_K * 2)
+    semantic = semantic_index.search_passages(message_text, referral_knowledge_base.chunks, REFERRAL_CONTEXT_TOP_K * 2)
+    return reciprocal_rank_fusion([lexical, semantic])[:REFERRAL_CONTEXT_TOP_K]
+
+async def search_products(message_text: str, keyword_to_search: Optional[str], data_sources: List[str]) -> List[Dict[str, Any]]:
+    """
+    Hybrid product search: full-text matches on the search terms and embedding matches on the whole
+    message, merged by reciprocal rank fusion. Fetches more candidates than the prompt shows, so
+    personalized ranking has some to choose from.
+    """
+    products, semantic_hits = await asyncio.gather(
+        get_products_by_keyword_async(keyword_to_search, PRODUCT_SEARCH_CANDIDATES),
+        asyncio.to_thread(semantic_index.search_products, message_text, PRODUCT_SEARCH_CANDIDATES),
+    )
+    if not semantic_hits:
+        return products
+    data_sources.append("Product_Embeddings")
+    by_id = {prod["id"]: prod for prod in products}
+    missing_ids = [product_id for product_id, _ in semantic_hits if product_id not in by_id]
+    if missing_ids:
+        by_id.update((prod["id"], prod) for prod in await get_products_by_ids_async(missing_ids))
+    ranked_ids = reciprocal_rank_fusion([[prod["id"] for prod in products], [product_id for product_id, _ in semantic_hits]])
+    return [by_id[product_id] for product_id in ranked_ids if product_id in by_id][:PRODUCT_SEARCH_CANDIDATES]
+
+def product_context(products: List[Dict[str, Any]], header: str = "Available products related to your query:") -> ContextSection:
+    """Builds the product context section; products are listed in order, so the prompt budget trims the last ones."""
+    if not products:
+        return ContextSection("No specific products found matching your query in the database.")
+    return ContextSection(header, tuple(
+        f"Name: {prod['name']}, Price: ${prod['price']}, Description: {prod['description']}" for prod in products))
+
+async def personalize_products(products: List[Dict[str, Any]], profile: UserProfileRecord,
+                               data_sources: List[str]) -> Tuple[ContextSection, List[Dict[str, Any]]]:
+    """
+    Ranks product search results for the user (their purchases, products bought with them, and
+    what is popular at their school). With no results, suggests products from the same signals.
+    """
+    products = recommendation_index.rank(products, profile.favorite_product_ids, profile.school_id, PRODUCT_CONTEXT_LIMIT)
+    if products:
+        return product_context(products), products
+    recommended_ids = recommendation_index.recommend(profile.favorite_product_ids, profile.school_id, PRODUCT_CONTEXT_LIMIT)
+    products = await get_products_by_ids_async(recommended_ids) if recommended_ids else []
+    if products:
+        data_sources.append("Purchase_History")
+    return product_context(products, "Nothing matched the query exactly. Products often bought by this user's school and by shoppers like them:"), products
+
+async def keep_semantic_index_fresh() -> None:
+    """
+    Opens the product embedding index, then keeps it current. The maintaining worker builds it if
+    there is none and applies product changes as they happen; other workers reopen the files it writes.
+    """
+    while True:
+        maintainer = is_maintainer()
+        try:
+            if not maintainer or not semantic_index.ready:
+                await asyncio.to_thread(semantic_index.reload)
+            if maintainer and not semantic_index.ready:
+                await asyncio.to_thread(semantic_index.build)
+            elif maintainer:
+                await asyncio.to_thread(semantic_index.sync_products)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            if not semantic_index.ready:
+                # Retried next round, e.g. once the maintaining worker has written the index files
+                logger.error("Semantic product search is unavailable for now: %s", e)
+            else:
+                logger.error("Failed to apply product changes to the semantic index: %s", e)
+        interval = SEMANTIC_SYNC_SECONDS if maintainer else SHARED_STATE_POLL_SECONDS
+        if interval <= 0:
+            return
+        await asyncio.sleep(interval)
+
+async def keep_recommendations_fresh() -> None:
+    """
+    Loads the prebuilt recommendation index (or builds it), then rebuilds it as new purchases arrive.
+    Only the maintaining worker rebuilds, saving to CARTON_CAPS_RECOMMENDATIONS_PATH; other workers
+    map that file and reopen it when it changes.
+    """
+    loaded = await asyncio.to_thread(recommendation_index.load)
+    while True:
+        maintainer = is_maintainer()
+        if not maintainer:
+            await asyncio.to_thread(recommendation_index.reload)
+        elif not loaded:
+            try:
+                if await asyncio.to_thread(recommendation_index.refresh) and RECOMMENDATIONS_PATH:
+                    await asyncio.to_thread(recommendation_index.save)
+            except (sqlite3.Error, OSError) as e:
+                logger.error("Failed to build the recommendation index: %s", e)
+        interval = RECOMMENDATION_REFRESH_SECONDS if maintainer else SHARED_STATE_POLL_SECONDS
+        if interval <= 0:
+            return
+        await asyncio.sleep(interval)
+        loaded = False
+
+async def keep_profile_invalidations_synced() -> None:
+    """With several workers, drops cached profiles that another worker was asked to invalidate."""
+    if not MULTI_WORKER or SHARED_STATE_POLL_SECONDS <= 0:
+        return
+    while True:
+        await asyncio.sleep(SHARED_STATE_POLL_SECONDS)
+        dropped = await user_profile_cache.sync_invalidations()
+        if dropped:
+            logger.debug("Dropped %d cached profiles invalidated by other workers.", dropped)
+
+async def load_llm_sdk() -> None:
+    """Imports and configures the Gemini SDK off the event loop."""
+    if not GOOGLE_API_KEY or llm_gateway.model_factory is not None:
+        return
+    try:
+        await asyncio.to_thread(llm_gateway.load_sdk)
+        logger.info("Google Gemini API configured successfully.")
     except Exception as e:
-        print(f"Error calling Gemini API: {e}")
-        # Check for specific API errors if needed, e.g., related to safety settings
-        if hasattr(e, 'parts') and e.parts:
-            print(f"Gemini API Error Parts: {e.parts}")
-        if hasattr(e, 'message'):
-            print(f"Gemini API Error Message: {e.message}")
-        return f"Sorry, I encountered an error trying to understand that. Error: {str(e)[:100]}"
+        logger.error("Error configuring Google Gemini API: %s", e)
+
+def user_summary_for_prompt(profile: UserProfileRecord, client_profile: Optional[UserProfile]) -> Optional[str]:
+    """Short description of the user's purchases and preferences, from the database or else the client's profile."""
+    lines: List[str] = []
+    purchases = profile.purchase_summary() or (client_profile.past_purchases_summary if client_profile else None)
+    if purchases:
+        lines.append("Frequently buys: " + ", ".join(purchases))
+    if client_profile and client_profile.preferences:
+        lines.append("Preferences: " + ", ".join(client_profile.preferences))
+    return "\n".join(lines) or None
+
+def build_fallback_reply(detected_intent: str, context: ContextSection, products: List[Dict[str, Any]]) -> str:
+    """Templated answer from the retrieved context, used when the LLM is unavailable."""
+    if detected_intent == "product_query" and products:
+        lines = "\n".join(f"- {prod['name']} (${prod['price']})" for prod in products)
+        return f"I can't reach my assistant right now, but here are some products that match your request:\n{lines}"
+    if detected_intent == "referral_question" and context.items:
+        return f"I can't reach my assistant right now, but here is what the referral program guide says:\n\n{context.items[0]}"
+    return LLM_UNAVAILABLE_REPLY
+
+def response_cache_key(detected_intent: str, retrieved_db_context_str: str, message_text: str) -> Optional[str]:
+    """Returns the response cache key for a turn, or None if the turn's reply should not be cached."""
+    if detected_intent not in CACHEABLE_INTENTS:
+        return None
+    return make_cache_key(detected_intent, retrieved_db_context_str, message_text, DEFAULT_GEMINI_MODEL)
+
+async def warm_response_cache() -> None:
+    """Precomputes replies for the quick-reply payloads so the first users to tap them get cached answers."""
+    # With several workers the cache is shared, so only the maintaining worker warms it
+    if not GOOGLE_API_KEY or not is_maintainer():
+        return
+    personalization = {"user_name": WARMUP_USER_NAME, "school_name": WARMUP_SCHOOL_NAME}
+    for action in QUICK_REPLY_ACTIONS:
+        message_text = action.payload
+        detected_intent, keyword_to_search = detect_intent(message_text)
+        context, data_sources, products = await retrieve_context(detected_intent, message_text, keyword_to_search)
+        if detected_intent == "product_query":
+            # Ranked as for a user with no purchases or school, which is what the cached answer is valid for
+            context, products = await personalize_products(products, UserProfileRecord(WARMUP_USER_NAME, found=False), data_sources)
+        cache_key = response_cache_key(detected_intent, context.render(), message_text)
+        if cache_key is None:
+            continue
+        prompt = build_prompt(WARMUP_USER_NAME, WARMUP_SCHOOL_NAME, context, [Message(role="user", content=message_text)], message_text)
+        await get_gemini_response(prompt.text, cache_key=cache_key, personalization=personalization)
+    logger.info("Response cache warmed for %d quick replies.", len(QUICK_REPLY_ACTIONS))
 
 # --- API Endpoint ---
 
-@app.post("/api/v1/carton_caps/chat", response_model=ChatResponse, tags=["Chat"])
-async def chat_endpoint(request: ChatRequest):
+@dataclass
+class ChatTurn:
+    """Everything gathered for one chat turn before the LLM call."""
+    request: ChatRequest
+    session_history: List[Message]
+    new_session_messages: List[Message]
+    detected_intent: str
+    retrieved_db_context_str: str
+    data_sources: List[str]
+    products: List[Dict[str, Any]]
+    user_name: str
+    user_school_name: str
+    prompt: str
+    prompt_tokens: int
+    summary: RollingSummary
+    cache_key: Optional[str]
+    fallback_reply: str
+    trace: TurnTrace
+
+    @property
+    def personalization(self) -> Dict[str, str]:
+        return {"user_name": self.user_name, "school_name": self.user_school_name}
+
+async def _timed(trace: TurnTrace, stage: str, awaitable: Awaitable[Any]) -> Any:
+    """Awaits `awaitable`, recording its duration as `stage` (used for stages that run concurrently)."""
+    with trace.stage(stage):
+        return await awaitable
+
+async def prepare_chat_turn(request: ChatRequest, trace: TurnTrace,
+                            prefetched: Optional[Dict[RetrievalKey, RetrievalResult]] = None) -> ChatTurn:
     """
-    Main endpoint for sending user messages and receiving assistant replies.
+    Loads the session, detects intent, retrieves context and builds the prompt for a chat request.
+    `prefetched` holds retrievals already run for a batch.
     """
-    print(f"Received request for session_id: {request.session_id}, user_id: {request.user_id}")
-    print(f"User message: {request.message.text}")
+    logger.debug("Received request for session_id: %s, user_id: %s, message: %s", request.session_id, request.user_id, request.message.text)
 
-    session_history = conversation_sessions.get(request.session_id, [])
+    with trace.stage("session_lookup"):
+        session_history, summary = await session_store.get_session(request.session_id, request.user_id)
+    new_session_messages: List[Message] = []
     if not session_history and request.conversation_history:
-        session_history = request.conversation_history
-        print(f"Initialized session {request.session_id} history from client.")
+        session_history = request.conversation_history[-SESSION_MAX_MESSAGES:]
+        new_session_messages.extend(session_history)
+        logger.debug("Initialized session %s history from client.", request.session_id)
 
     user_message_record = Message(role="user", content=request.message.text, timestamp=request.message.timestamp)
     session_history.append(user_message_record)
-    save_conversation_message(request.session_id, request.user_id, "user", request.message.text, request.message.timestamp)
-
-    user_details = get_user_details(request.user_id)
-    user_name = user_details.get("user_name", request.user_id) if user_details else request.user_id
-    user_school_name = user_details.get("school_name", "their school") if user_details else "their school"
-
-    # --- Intent Detection and Context Retrieval --- 
-    detected_intent = "unknown"
-    retrieved_db_context_str = ""
-    data_sources = []
-    llm_prompt_for_debug = ""
-
-    lower_message = request.message.text.lower()
-    # More specific keywords first
-    if "referral" in lower_message or "refer" in lower_message or "friend" in lower_message:
-        detected_intent = "referral_question"
-        data_sources.append("Referral_FAQ_PDF") # Changed from _Simulated
-        
-        # --- MODIFIED: Use actual PDF text extraction ---
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        
-        # CORRECTED PDF PATH:
-        # Assumes 'CartonCapsReferralFAQs.pdf' is in the 'data' subdirectory 
-        # relative to where main.py is (i.e., carton_caps_ai_service/data/)
-        pdf_path = os.path.join(current_dir, "data", "CartonCapsReferralFAQs.pdf")
-        
-        pdf_path = os.path.normpath(pdf_path) # Normalize path for OS compatibility
-
-        print(f"Attempting to load PDF from: {pdf_path}")
-        referral_faq_text = get_text_from_pdf(pdf_path)
-
-        if referral_faq_text:
-            retrieved_db_context_str = f"Context from Referral FAQ Document:\n{referral_faq_text}"
-        else:
-            retrieved_db_context_str = "I found our general referral information, but I'm having a little trouble accessing the detailed FAQ document right now. Generally, Carton Caps offers a referral program where you can earn rewards for your school by inviting friends. You can usually find your unique referral link in the app's 'Refer a Friend' section."
-            print("Fallback referral context used due to PDF loading issue.")
-        # --- END MODIFICATION ---
-    elif any(kw in lower_message for kw in ["product", "recommend", "buy", "find", "search", "cereal", "snack", "fruit", "cheese", "oatmeal", "flakes", "bars"]):
-        detected_intent = "product_query"
-        data_sources.append("Product_DB")
-        
-        # Improved keyword extraction for product search
-        keyword_to_search = None
-        # Prioritize specific product types mentioned
-        product_type_keywords = ["cereal", "snack", "fruit", "cheese", "oatmeal", "flakes", "bar", "bars", "juice", "milk", "yogurt", "pasta", "bread"]
-        for pt_kw in product_type_keywords:
-            if pt_kw in lower_message:
-                keyword_to_search = pt_kw
-                break
-        
-        # If no specific type, and it's a general recommendation, try broader terms or the original query
-        if not keyword_to_search:
-            if "recommend" in lower_message or "suggest" in lower_message:
-                # For general recommendations, we might not have a good single keyword.
-                # Could try to pull out nouns, or for now, let LLM handle broader query if no specific keyword found.
-                # For this iteration, let's try with the original text if no better keyword is found.
-                keyword_to_search = request.message.text # Or try a very generic term like "product" if that makes sense for your DB
-            else:
-                # If not a recommendation, use the original text as a search term
-                keyword_to_search = request.message.text 
-
-        print(f"Product query detected. Searching for keyword: '{keyword_to_search}'")
-        products = get_products_by_keyword(keyword_to_search)
-        if products:
-            retrieved_db_context_str = "Available products related to your query:"
-            for prod in products:
-                retrieved_db_context_str += f"\n- Name: {prod['name']}, Price: ${prod['price']}, Description: {prod['description']}"
-        else:
-            retrieved_db_context_str = "No specific products found matching your query in the database."
-    else:
-        detected_intent = "general_conversation"
-        # No specific data source for general chat, LLM will rely on its general knowledge and persona
+    new_session_messages.append(user_message_record)
 
-    # --- Construct Prompt for Gemini --- 
-    system_prompt = (
-        f"You are a friendly and helpful AI assistant for Carton Caps, an app that empowers consumers to raise money for schools. "
-        f"Your name is Cappy. You are assisting user '{user_name}' who supports '{user_school_name}'. "
-        f"Your primary goals are to help users find personalized product recommendations and understand the referral process. "
-        f"Be concise and engaging. Your responses should be based *only* on the information provided in the 'Retrieved Context' section of this prompt and the 'Conversation History'. "
-        f"When asked for product recommendations, list products *only* if they are present in the 'Retrieved Context'. "
-        f"If the 'Retrieved Context' is empty or contains a message like 'No specific products found', you must state that you couldn't find specific products matching the query and should not invent any. You can then offer to search for something else or pivot to another topic like referrals. "
-        f"Similarly, for referral information, base your answer *only* on the 'Retrieved Context' if provided for referral questions. Do not make up referral program details."
+    # --- Intent Detection --- 
+    with trace.stage("intent_detection"):
+        detected_intent, keyword_to_search = detect_intent(request.message.text)
+    trace.intent = detected_intent
+
+    # Persisted in the background by the write-behind queue, off the response path
+    conversation_writer.enqueue(request.session_id, request.user_id, "user", request.message.text, request.message.timestamp)
+
+    # --- Context Retrieval --- 
+    # The user lookup and intent-specific retrieval are independent, so they run concurrently
+    # off the event loop (DB calls on the DB executor, index search on a worker thread).
+    profile, (context, data_sources, products) = await asyncio.gather(
+        _timed(trace, "user_lookup", user_profile_cache.get(request.user_id)),
+        _timed(trace, "retrieval", retrieve_context(detected_intent, request.message.text, keyword_to_search, prefetched)),
     )
 
-    # Build conversation history for the prompt (role: user/model for Gemini)
-    gemini_history_prompt = []
-    for msg in session_history[-10:]: # Use last 10 messages for context window
-        role = "model" if msg.role == "assistant" else "user"
-        gemini_history_prompt.append(f"{role}: {msg.content}")
-    
-    full_prompt = f"{system_prompt}\n\n"
-    if retrieved_db_context_str:
-        full_prompt += f"Retrieved Context:\n{retrieved_db_context_str}\n\n"
-    full_prompt += "Conversation History (most recent first):\n" + "\n".join(reversed(gemini_history_prompt[:-1])) # Show history, excluding current user query
-    full_prompt += f"\n\nUser '{user_name}' (current query): {request.message.text}\nAssistant Cappy:"
+    # The database record wins; the client-supplied profile fills in for users it does not know
+    client_profile = request.user_profile
+    client_school = client_profile.school_info.school_name if client_profile and client_profile.school_info else None
+    user_name = profile.user_name or request.user_id
+    user_school_name = profile.school_name or client_school or "their school"
 
-    llm_prompt_for_debug = full_prompt # For debug output
+    # Products are ranked for the user. The ranking changes the context (and so the cache key), so
+    # cached replies never carry another user's history; the purchase summary itself only goes into
+    # prompts for uncached intents.
+    user_summary = None
+    if detected_intent == "product_query":
+        with trace.stage("personalization"):
+            context, products = await personalize_products(products, profile, data_sources)
+    if detected_intent not in CACHEABLE_INTENTS:
+        user_summary = user_summary_for_prompt(profile, client_profile)
 
-    # --- Get Response from Gemini --- 
-    assistant_reply_text = await get_gemini_response(full_prompt)
+    # --- Construct Prompt for Gemini --- 
+    with trace.stage("prompt_build"):
+        # Trimmed to the token budget; turns older than the verbatim window are folded into the rolling summary
+        prompt = build_prompt(user_name, user_school_name, context, session_history, request.message.text, summary,
+                              user_summary)
+        retrieved_db_context_str = context.render()
+        # Repeated grounded questions are served from the response cache
+        cache_key = response_cache_key(detected_intent, retrieved_db_context_str, request.message.text)
+
+    return ChatTurn(
+        request=request,
+        session_history=session_history,
+        new_session_messages=new_session_messages,
+        detected_intent=detected_intent,
+        retrieved_db_context_str=retrieved_db_context_str,
+        data_sources=data_sources,
+        products=products,
+        user_name=user_name,
+        user_school_name=user_school_name,
+        prompt=prompt.text,
+        prompt_tokens=prompt.tokens,
+        summary=prompt.summary,
+        cache_key=cache_key,
+        fallback_reply=build_fallback_reply(detected_intent, context, products),
+        trace=trace,
+    )
+
+async def complete_chat_turn(turn: ChatTurn, assistant_reply_text: Optional[str],
+                             include_debug: bool = False) -> Tuple[Message, List[SuggestedAction], Optional[DebugInfo]]:
+    """Records the assistant reply and builds the suggested actions (and, if requested, debug info) for the turn."""
+    request = turn.request
     if assistant_reply_text is None:
-        assistant_reply_text = "I'm having a little trouble connecting right now. Please try again in a moment."
+        assistant_reply_text = LLM_UNAVAILABLE_REPLY
 
     assistant_message_record = Message(role="assistant", content=assistant_reply_text, timestamp=datetime.datetime.now())
-    session_history.append(assistant_message_record)
+    turn.session_history.append(assistant_message_record)
+    turn.new_session_messages.append(assistant_message_record)
     
-    # MODIFIED: Map 'assistant' role to 'bot' for database saving
-    db_sender_role = "bot" if assistant_message_record.role == "assistant" else assistant_message_record.role
-    save_conversation_message(request.session_id, request.user_id, db_sender_role, assistant_reply_text, assistant_message_record.timestamp)
-    
-    conversation_sessions[request.session_id] = session_history
+    with turn.trace.stage("persistence"):
+        # MODIFIED: Map 'assistant' role to 'bot' for database saving
+        db_sender_role = "bot" if assistant_message_record.role == "assistant" else assistant_message_record.role
+        conversation_writer.enqueue(request.session_id, request.user_id, db_sender_role, assistant_reply_text, assistant_message_record.timestamp)
+        await session_store.append(request.session_id, request.user_id, turn.new_session_messages, turn.summary)
 
     # TODO: Implement logic to generate relevant suggested_actions based on LLM response or intent
-    current_suggested_actions = [
-        SuggestedAction(type="quick_reply", text_label="Recommend a snack", payload="Recommend a snack for me"),
-        SuggestedAction(type="quick_reply", text_label="How do referrals work?", payload="How do referrals work?")
-    ]
-    if detected_intent == "product_query" and products:
-         current_suggested_actions.append(SuggestedAction(type="quick_reply", text_label=f"Tell me more about {products[0]['name']}", payload=f"Tell me more about {products[0]['name']}"))
+    current_suggested_actions = list(QUICK_REPLY_ACTIONS)
+    if turn.detected_intent == "product_query" and turn.products:
+         current_suggested_actions.append(SuggestedAction(type="quick_reply", text_label=f"Tell me more about {turn.products[0]['name']}", payload=f"Tell me more about {turn.products[0]['name']}"))
+
+    debug_info = None
+    if include_debug:
+        debug_info = DebugInfo(
+            intent_detected=turn.detected_intent,
+            retrieved_context_summary=turn.retrieved_db_context_str if turn.retrieved_db_context_str else "No specific context retrieved.",
+            data_sources_used=turn.data_sources if turn.data_sources else ["none"],
+            llm_prompt=turn.prompt, # For debug output
+            prompt_tokens=turn.prompt_tokens,
+        )
+
+    total_seconds = turn.trace.finish()
+    logger.info(
+        "Chat turn completed",
+        extra={
+            "session_id": request.session_id,
+            "endpoint": turn.trace.endpoint,
+            "intent": turn.detected_intent,
+            "total_ms": round(total_seconds * 1000, 3),
+            "stages_ms": turn.trace.summary(),
+        },
+    )
+    return assistant_message_record, current_suggested_actions, debug_info
+
+def delta_response(turn: ChatTurn, assistant_message_record: Message, suggested_actions: List[SuggestedAction],
+                   debug_info: Optional[DebugInfo]) -> ChatDeltaResponse:
+    """Builds the slim response: the messages this turn added plus the history versions before and after it."""
+    known_messages = len(turn.session_history) - len(turn.new_session_messages)
+    previous_version = turn.session_history[known_messages - 1].timestamp if known_messages > 0 else None
+    return ChatDeltaResponse(
+        session_id=turn.request.session_id,
+        reply=Reply(text=assistant_message_record.content, timestamp=assistant_message_record.timestamp),
+        new_messages=turn.new_session_messages,
+        previous_version=previous_version,
+        history_version=assistant_message_record.timestamp,
+        suggested_actions=suggested_actions,
+        debug_info=debug_info,
+    )
+
+@app.post("/api/v1/carton_caps/chat", response_model=Union[ChatResponse, ChatDeltaResponse], tags=["Chat"])
+async def chat_endpoint(request: ChatRequest, response_mode: Optional[Literal["full", "slim"]] = None,
+                        debug: bool = DEBUG_INFO_DEFAULT, prefer: Optional[str] = Header(None)):
+    """
+    Main endpoint for sending user messages and receiving assistant replies.
 
-    return ChatResponse(
+    The full response echoes the whole session history. The slim response (`?response_mode=slim`
+    or `Prefer: return=minimal`) returns only the new messages and history versions. `?debug=true`
+    adds the prompt and retrieved context.
+    """
+    preference_applied = response_mode is None
+    response_mode = negotiate_response_mode(response_mode, prefer)
+    turn = await prepare_chat_turn(request, TurnTrace("chat"))
+
+    # --- Get Response from Gemini --- 
+    with turn.trace.stage("llm"):
+        assistant_reply_text = await get_gemini_response(turn.prompt, cache_key=turn.cache_key, personalization=turn.personalization,
+                                                         fallback_reply=turn.fallback_reply)
+
+    assistant_message_record, current_suggested_actions, debug_info = await complete_chat_turn(turn, assistant_reply_text, debug)
+    if response_mode == "slim":
+        return json_response(delta_response(turn, assistant_message_record, current_suggested_actions, debug_info),
+                             exclude_none=True, headers={"Preference-Applied": "return=minimal"} if preference_applied else None)
+    return json_response(ChatResponse(
         session_id=request.session_id,
-        reply=Reply(text=assistant_reply_text, timestamp=assistant_message_record.timestamp),
-        updated_conversation_history=session_history,
+        reply=Reply(text=assistant_message_record.content, timestamp=assistant_message_record.timestamp),
+        updated_conversation_history=turn.session_history,
         suggested_actions=current_suggested_actions,
-        debug_info=DebugInfo(
-            intent_detected=detected_intent,
-            retrieved_context_summary=retrieved_db_context_str if retrieved_db_context_str else "No specific context retrieved.",
-            data_sources_used=data_sources if data_sources else ["none"],
-            llm_prompt=llm_prompt_for_debug
+        debug_info=debug_info
+    ))
+
+@app.post("/api/v1/carton_caps/chat/stream", tags=["Chat"])
+async def chat_stream_endpoint(request: ChatRequest, debug: bool = DEBUG_INFO_DEFAULT):
+    """
+    Streaming variant of the chat endpoint. Responds with newline-delimited JSON frames:
+    `{"type": "delta", "text": ...}` for each chunk as Gemini produces it, then a single
+    `ChatStreamEnd` frame (`"type": "final"`) carrying the reply, suggested actions and, with
+    `?debug=true`, debug info. The conversation history is not echoed back; clients append the
+    streamed reply themselves.
+    """
+    turn = await prepare_chat_turn(request, TurnTrace("chat_stream"))
+
+    async def frames() -> AsyncIterator[str]:
+        reply_chunks: List[str] = []
+        llm_started = time.perf_counter()
+        async for text in stream_gemini_response(turn.prompt, cache_key=turn.cache_key, personalization=turn.personalization,
+                                                 fallback_reply=turn.fallback_reply):
+            if not reply_chunks:
+                turn.trace.stages["llm_first_token"] = time.perf_counter() - llm_started
+            reply_chunks.append(text)
+            yield json.dumps({"type": "delta", "text": text}) + "\n"
+        turn.trace.stages["llm"] = time.perf_counter() - llm_started
+
+        assistant_message_record, current_suggested_actions, debug_info = await complete_chat_turn(turn, "".join(reply_chunks) or None, debug)
+        final_frame = ChatStreamEnd(
+            session_id=request.session_id,
+            reply=Reply(text=assistant_message_record.content, timestamp=assistant_message_record.timestamp),
+            suggested_actions=current_suggested_actions,
+            debug_info=debug_info,
         )
-    )
+        yield final_frame.model_dump_json(exclude_none=True) + "\n"
+
+    return StreamingResponse(frames(), media_type="application/x-ndjson")
+
+# --- Batch chat (offline evaluation and backfills) ---
+# Input lines run together: the chunk's user profiles are bulk-loaded and each distinct question is retrieved once
+BATCH_CHUNK_SIZE = int(os.getenv("CARTON_CAPS_BATCH_CHUNK_SIZE", "500"))
+# Turns of a batch in flight at once (Gemini calls are further limited by the LLM gateway)
+BATCH_CONCURRENCY = int(os.getenv("CARTON_CAPS_BATCH_CONCURRENCY", "32"))
+
+async def run_chat_batch(lines: AsyncIterable[str], debug: bool = False) -> AsyncIterator[BatchChatResult]:
+    """
+    Runs JSON lines of ChatRequests through the chat pipeline, `BATCH_CHUNK_SIZE` lines at a time.
+    Yields a result per non-blank line as its turn finishes, so results are not in input order;
+    turns of the same session still run in input order.
+    """
+    chunk: List[Tuple[int, str]] = []
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        chunk.append((line_number, line))
+        if len(chunk) >= BATCH_CHUNK_SIZE:
+            async for result in run_chat_batch_chunk(chunk, debug):
+                yield result
+            chunk = []
+    if chunk:
+        async for result in run_chat_batch_chunk(chunk, debug):
+            yield result
+
+async def run_chat_batch_chunk(chunk: List[Tuple[int, str]], debug: bool) -> AsyncIterator[BatchChatResult]:
+    sessions: Dict[str, List[Tuple[int, ChatRequest]]] = {}
+    for line_number, line in chunk:
+        try:
+            request = ChatRequest.model_validate_json(line)
+        except ValidationError as e:
+            errors = "; ".join(f"{'.'.join(str(part) for part in error['loc']) or 'line'}: {error['msg']}" for error in e.errors())
+            yield BatchChatResult(line=line_number, error=f"Invalid chat request: {errors}")
+            continue
+        sessions.setdefault(request.session_id, []).append((line_number, request))
+    requests = [request for turns in sessions.values() for _, request in turns]
+    if not requests:
+        return
+
+    # One IN (...) query per table loads every user in the chunk, instead of a lookup per turn
+    await user_profile_cache.preload(sorted({request.user_id for request in requests}))
+
+    semaphore = asyncio.Semaphore(max(1, BATCH_CONCURRENCY))
+
+    async def prefetch(key: RetrievalKey) -> RetrievalResult:
+        async with semaphore:
+            return await retrieval_flights.run(key, lambda: run_retrieval(*key))
+
+    # Each distinct (intent, message, search terms) is retrieved once for the chunk. A failed
+    # retrieval is left out and retried by the turns that need it.
+    keys: Dict[RetrievalKey, None] = {}
+    for request in requests:
+        detected_intent, keyword_to_search = detect_intent(request.message.text)
+        keys[(detected_intent, request.message.text, keyword_to_search)] = None
+    retrieved = await asyncio.gather(*(prefetch(key) for key in keys), return_exceptions=True)
+    prefetched = {key: result for key, result in zip(keys, retrieved) if not isinstance(result, BaseException)}
+
+    results: "asyncio.Queue[BatchChatResult]" = asyncio.Queue()
+
+    async def run_session(turns: List[Tuple[int, ChatRequest]]) -> None:
+        for line_number, request in turns:
+            async with semaphore:
+                result = await run_batch_turn(line_number, request, prefetched, debug)
+            results.put_nowait(result)
+
+    tasks = [asyncio.create_task(run_session(turns)) for turns in sessions.values()]
+    try:
+        for _ in range(len(requests)):
+            yield await results.get()
+    finally:
+        # The consumer may stop early (e.g. a client disconnecting); don't leave turns running
+        for task in tasks:
+            task.cancel()
+    # Write the chunk's history before taking the next one, so a long batch cannot outrun the writer
+    await conversation_writer.flush()
+
+async def run_batch_turn(line_number: int, request: ChatRequest, prefetched: Dict[RetrievalKey, RetrievalResult],
+                         debug: bool) -> BatchChatResult:
+    """Runs one batch line through the same steps as the chat endpoint. A failure is reported on its line only."""
+    try:
+        turn = await prepare_chat_turn(request, TurnTrace("chat_batch"), prefetched)
+        with turn.trace.stage("llm"):
+            assistant_reply_text = await get_gemini_response(turn.prompt, cache_key=turn.cache_key, personalization=turn.personalization,
+                                                             fallback_reply=turn.fallback_reply)
+        assistant_message_record, current_suggested_actions, debug_info = await complete_chat_turn(turn, assistant_reply_text, debug)
+    except Exception as e:
+        logger.exception("Batch chat turn on line %d failed", line_number)
+        return BatchChatResult(line=line_number, session_id=request.session_id, error=str(e) or type(e).__name__)
+    return BatchChatResult(line=line_number, session_id=request.session_id,
+                           response=delta_response(turn, assistant_message_record, current_suggested_actions, debug_info))
+
+@app.post("/api/v1/carton_caps/chat/batch", tags=["Chat"])
+async def chat_batch_endpoint(request: Request, debug: bool = DEBUG_INFO_DEFAULT):
+    """
+    Runs many chat turns in one request. The body is newline-delimited JSON, one `ChatRequest` per
+    line; turns of the same session run in order. Responds with newline-delimited `BatchChatResult`
+    frames as turns finish (each carries its input line number and the slim response, or an error).
+    """
+    # Read in full first: the streaming response listens for client disconnects on the same channel
+    try:
+        body = (await request.body()).decode("utf-8")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Batch body must be UTF-8 encoded JSON lines.")
+
+    async def lines() -> AsyncIterator[str]:
+        for line in body.splitlines():
+            yield line
+
+    async def frames() -> AsyncIterator[str]:
+        async for result in run_chat_batch(lines(), debug):
+            yield result.model_dump_json(exclude_none=True) + "\n"
+
+    return StreamingResponse(frames(), media_type="application/x-ndjson")
+
+@app.get("/api/v1/carton_caps/sessions/{session_id}/history", response_model=HistoryPage, tags=["Chat"])
+async def session_history_endpoint(session_id: str, before: Optional[str] = None, limit: int = Query(20, ge=1, le=100)):
+    """
+    Keyset-paginated conversation history for a session, newest page first.
+    """
+    try:
+        rows, next_cursor = await get_conversation_history_page_async(session_id, before, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except (sqlite3.Error, FileNotFoundError) as e:
+        logger.error("Database error fetching history for session %s: %s", session_id, e)
+        raise HTTPException(status_code=503, detail="Conversation history is temporarily unavailable.")
+    return json_response(HistoryPage(session_id=session_id, messages=[message_from_db_row(row) for row in rows], next_cursor=next_cursor))
+
+@app.delete("/api/v1/carton_caps/users/{user_id}/profile", tags=["Users"])
+async def invalidate_user_profile_endpoint(user_id: str):
+    """
+    Drops a user's cached profile after their name, school or purchases change; the next turn reloads it.
+    With several workers, the others drop it within CARTON_CAPS_SHARED_STATE_POLL seconds.
+    """
+    return {"user_id": user_id, "invalidated": await user_profile_cache.invalidate_everywhere(user_id)}
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    """
+    Prometheus scrape endpoint: per-stage and per-intent latency histograms plus component gauges.
+    """
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/health", tags=["Health"])
 async def health_check():
     """
-    Simple health check endpoint.
+    Simple health check endpoint, with component stats and the worker that answered.
     """
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "conversation_writer": conversation_writer.stats(),
+        "session_store": session_store.stats(),
+        "response_cache": response_cache.stats(),
+        "llm_gateway": llm_gateway.stats(),
+        "user_profiles": user_profile_cache.stats(),
+        "recommendations": recommendation_index.stats(),
+        "semantic_index": semantic_index.stats(),
+        "retrieval_flights": retrieval_flights.stats(),
+        "reply_flights": reply_flights.stats(),
+        "worker": {"pid": os.getpid(), "workers": SERVER_WORKERS, "maintainer": is_maintainer()},
+    }
 
 # --- Add a root redirect to the UI for convenience ---
 @app.get("/", include_in_schema=False)
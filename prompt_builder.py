@@ -0,0 +1,168 @@
+import datetime
+import functools
+import os
+from dataclasses import dataclass
+from typing import Optional, List, Tuple, Any
+
+# --- Prompt budget settings (overridable through environment variables) ---
+PROMPT_MAX_TOKENS = int(os.getenv("CARTON_CAPS_PROMPT_MAX_TOKENS", "3000"))
+PROMPT_HISTORY_MAX_MESSAGES = int(os.getenv("CARTON_CAPS_PROMPT_HISTORY_MESSAGES", "10"))
+PROMPT_SUMMARY_MAX_TOKENS = int(os.getenv("CARTON_CAPS_PROMPT_SUMMARY_TOKENS", "300"))
+SYSTEM_PROMPT_CACHE_SIZE = int(os.getenv("CARTON_CAPS_SYSTEM_PROMPT_CACHE_SIZE", "4096"))
+
+# Retrieved context may always use this share of the budget left after the system prompt and query;
+# history and summary get the rest, and any part of it they do not need goes back to the context.
+CONTEXT_MIN_SHARE = 0.6
+# Words kept per message when it is folded into the rolling summary
+SUMMARY_WORDS_PER_MESSAGE = 25
+
+# Rough estimate (about 4 characters per token for English); counting exactly would need a tokenizer round trip
+_CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN
+
+
+@dataclass(frozen=True)
+class ContextSection:
+    """Retrieved context: a header line followed by items in descending relevance."""
+    header: str
+    items: Tuple[str, ...] = ()
+
+    def render(self, items: Optional[Tuple[str, ...]] = None) -> str:
+        items = self.items if items is None else items
+        return self.header + "".join(f"\n- {item}" for item in items)
+
+
+@dataclass(frozen=True)
+class RollingSummary:
+    """Condensed lines for turns older than the verbatim history window, oldest first."""
+    lines: Tuple[str, ...] = ()
+    summarized_until: Optional[datetime.datetime] = None  # Timestamp of the newest folded message
+
+    def render(self) -> str:
+        return "\n".join(self.lines)
+
+
+@dataclass
+class BuiltPrompt:
+    text: str
+    tokens: int
+    context_items: int  # Retrieved items that fit in the budget
+    history_messages: int  # Verbatim history messages that fit in the budget
+    summary: RollingSummary  # Updated rolling summary to store with the session
+
+
+@functools.lru_cache(maxsize=SYSTEM_PROMPT_CACHE_SIZE)
+def system_prompt(user_name: str, user_school_name: str) -> Tuple[str, int]:
+    """Returns the (cached) system prompt for a user and school, with its token estimate."""
+    text = (
+        f"You are a friendly and helpful AI assistant for Carton Caps, an app that empowers consumers to raise money for schools. "
+        f"Your name is Cappy. You are assisting user '{user_name}' who supports '{user_school_name}'. "
+        f"Your primary goals are to help users find personalized product recommendations and understand the referral process. "
+        f"Be concise and engaging. Your responses should be based *only* on the information provided in the 'Retrieved Context' section of this prompt and the 'Conversation History'. "
+        f"When asked for product recommendations, list products *only* if they are present in the 'Retrieved Context'. "
+        f"If the 'Retrieved Context' is empty or contains a message like 'No specific products found', you must state that you couldn't find specific products matching the query and should not invent any. You can then offer to search for something else or pivot to another topic like referrals. "
+        f"Similarly, for referral information, base your answer *only* on the 'Retrieved Context' if provided for referral questions. Do not make up referral program details."
+    )
+    return text, estimate_tokens(text)
+
+
+def _speaker(message: Any) -> str:
+    return "model" if message.role == "assistant" else "user"
+
+
+def summarize_message(message: Any) -> str:
+    """Condenses one message into a summary line (speaker plus its leading words)."""
+    words = message.content.split()
+    text = " ".join(words[:SUMMARY_WORDS_PER_MESSAGE])
+    if len(words) > SUMMARY_WORDS_PER_MESSAGE:
+        text += " ..."
+    return f"{_speaker(message)}: {text}"
+
+
+def update_summary(summary: RollingSummary, earlier_messages: List[Any],
+                   max_tokens: int = PROMPT_SUMMARY_MAX_TOKENS) -> RollingSummary:
+    """
+    Folds messages that have left the verbatim window into the summary. Only messages newer than
+    the last folded one are processed, so each message is condensed once; the oldest lines are
+    dropped when the summary exceeds `max_tokens`.
+    """
+    new_messages = [m for m in earlier_messages
+                    if summary.summarized_until is None or m.timestamp > summary.summarized_until]
+    if not new_messages:
+        return summary
+    lines = list(summary.lines) + [summarize_message(m) for m in new_messages]
+    tokens = sum(estimate_tokens(line) + 1 for line in lines)
+    while lines and tokens > max_tokens:
+        tokens -= estimate_tokens(lines.pop(0)) + 1
+    return RollingSummary(tuple(lines), max(m.timestamp for m in new_messages))
+
+
+def build_prompt(user_name: str, user_school_name: str, context: ContextSection, session_history: List[Any],
+                 message_text: str, summary: Optional[RollingSummary] = None, user_summary: Optional[str] = None,
+                 max_tokens: int = PROMPT_MAX_TOKENS, history_max_messages: int = PROMPT_HISTORY_MAX_MESSAGES) -> BuiltPrompt:
+    """
+    Assembles the Gemini prompt within `max_tokens`. `session_history` ends with the current user message.
+
+    The system prompt and the current query are always included. Retrieved context items are
+    kept in relevance order, then the optional `user_summary` (what we know about the user), the
+    most recent history messages (newest first) and the rolling summary of older turns, until
+    the budget is used up.
+    """
+    prior_messages = session_history[:-1]
+    recent_messages = prior_messages[-history_max_messages:] if history_max_messages > 0 else []
+    summary = update_summary(summary or RollingSummary(), prior_messages[:len(prior_messages) - len(recent_messages)])
+
+    system_text, system_tokens = system_prompt(user_name, user_school_name)
+    query_text = f"User '{user_name}' (current query): {message_text}\nAssistant Cappy:"
+    remaining = max_tokens - system_tokens - estimate_tokens(query_text)
+
+    history_lines = [f"{_speaker(m)}: {m.content}" for m in recent_messages]
+    history_need = sum(estimate_tokens(line) + 1 for line in history_lines) + estimate_tokens(summary.render())
+
+    # --- Retrieved context, by relevance ---
+    context_budget = max(int(remaining * CONTEXT_MIN_SHARE), remaining - history_need)
+    used = estimate_tokens(context.header)
+    context_items: List[str] = []
+    if context.header and used <= context_budget:
+        for item in context.items:
+            item_tokens = estimate_tokens(item) + 1
+            if used + item_tokens <= context_budget:
+                context_items.append(item)
+                used += item_tokens
+    context_text = context.render(tuple(context_items)) if context.header and used <= context_budget else ""
+    remaining -= estimate_tokens(context_text)
+
+    user_text = f"About the User:\n{user_summary}" if user_summary else ""
+    if user_text and estimate_tokens(user_text) <= remaining:
+        remaining -= estimate_tokens(user_text)
+    else:
+        user_text = ""
+
+    # --- Recent history, newest first, then the summary of older turns ---
+    kept_history: List[str] = []
+    for line in reversed(history_lines):
+        line_tokens = estimate_tokens(line) + 1
+        if line_tokens > remaining:
+            break
+        kept_history.insert(0, line)
+        remaining -= line_tokens
+    # Keep the newest summary lines that still fit
+    summary_lines = list(summary.lines)
+    while summary_lines and sum(estimate_tokens(line) + 1 for line in summary_lines) > remaining:
+        summary_lines.pop(0)
+    summary_text = "\n".join(summary_lines)
+
+    parts = [system_text]
+    if user_text:
+        parts.append(user_text)
+    if context_text:
+        parts.append(f"Retrieved Context:\n{context_text}")
+    if summary_text:
+        parts.append(f"Summary of Earlier Conversation:\n{summary_text}")
+    parts.append("Conversation History (oldest first):\n" + "\n".join(kept_history))
+    parts.append(query_text)
+    text = "\n\n".join(parts)
+    return BuiltPrompt(text, estimate_tokens(text), len(context_items), len(kept_history), summary)
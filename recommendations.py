@@ -0,0 +1,358 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zipfile
+from dataclasses import dataclass, fields
+from typing import Optional, List, Dict, Any, Iterable, Tuple
+
+import numpy as np
+
+from db_utils import iter_user_product_purchases, get_purchase_history_version
+from workers import MULTI_WORKER, SHARED_STATE_DIR
+
+logger = logging.getLogger(__name__)
+
+# --- Recommendation index settings (overridable through environment variables) ---
+# Prebuilt index (.npz), memory-mapped when loaded; rebuilds are saved back to it. Built from the DB
+# when unset, except with several workers, which share one file that only one of them rebuilds.
+RECOMMENDATIONS_PATH = os.getenv("CARTON_CAPS_RECOMMENDATIONS_PATH",
+                                 os.path.join(SHARED_STATE_DIR, "recommendations.npz") if MULTI_WORKER else None)
+RECOMMENDATION_NEIGHBORS = int(os.getenv("CARTON_CAPS_RECOMMENDATION_NEIGHBORS", "20"))  # Co-purchase neighbors kept per product
+RECOMMENDATION_POPULAR = int(os.getenv("CARTON_CAPS_RECOMMENDATION_POPULAR", "50"))  # Popular products kept per school
+RECOMMENDATION_REFRESH_SECONDS = float(os.getenv("CARTON_CAPS_RECOMMENDATIONS_REFRESH", "3600"))
+
+# Only each user's most purchased products count toward co-purchases, which bounds the pairs per user
+MAX_BASKET_SIZE = 50
+# Pairs are counted in chunks of at most this many to bound peak memory
+PAIR_CHUNK_SIZE = 5_000_000
+# Added to the cosine denominator so pairs seen once or twice score below well-supported ones
+SIMILARITY_SHRINKAGE = 2.0
+
+# --- Ranking weights (search results are reordered by the sum of these) ---
+RELEVANCE_WEIGHT = 1.0  # Search rank, from 1 for the best match down towards 0
+PURCHASED_WEIGHT = 1.0  # Product the user has bought before
+CO_PURCHASE_WEIGHT = 1.0  # Summed similarity to the user's purchases
+SCHOOL_POPULARITY_WEIGHT = 0.5  # Popularity at the user's school, relative to its most popular product
+
+
+def _top_n_per_group(groups: np.ndarray, items: np.ndarray, scores: np.ndarray, group_count: int,
+                     n: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Keeps the `n` best-scoring items of every group. Returns CSR-style tables: the items of
+    group g are items[offsets[g]:offsets[g + 1]], best first.
+    """
+    order = np.lexsort((-scores, groups))
+    groups, items, scores = groups[order], items[order], scores[order]
+    group_starts = np.searchsorted(groups, np.arange(group_count))
+    rank = np.arange(len(groups)) - group_starts[groups]
+    keep = rank < n
+    groups, items, scores = groups[keep], items[keep], scores[keep]
+    offsets = np.zeros(group_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(groups, minlength=group_count), out=offsets[1:])
+    return offsets, items.astype(np.int32), scores.astype(np.float32)
+
+
+def _co_purchase_counts(users: np.ndarray, items: np.ndarray, item_count: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Counts, for every pair of products, the users who bought both. `users` must be sorted.
+    Returns (pair keys as low * item_count + high, counts).
+    """
+    row_count = len(users)
+    group_ends = np.searchsorted(users, users, side="right")
+    partners = group_ends - np.arange(row_count) - 1  # Later rows of the same user
+    pairs_before = np.concatenate(([0], np.cumsum(partners)))
+    keys_parts: List[np.ndarray] = []
+    counts_parts: List[np.ndarray] = []
+    start = 0
+    while start < row_count:
+        # Take rows until the chunk holds PAIR_CHUNK_SIZE pairs (always at least one row)
+        stop = max(start + 1, int(np.searchsorted(pairs_before, pairs_before[start] + PAIR_CHUNK_SIZE, side="right")) - 1)
+        stop = min(stop, row_count)
+        chunk_partners = partners[start:stop]
+        total = int(chunk_partners.sum())
+        if total:
+            left = np.repeat(np.arange(start, stop), chunk_partners)
+            offset = np.arange(total) - np.repeat(pairs_before[start:stop] - pairs_before[start], chunk_partners)
+            right = left + 1 + offset
+            a, b = items[left], items[right]
+            keys = np.minimum(a, b).astype(np.int64) * item_count + np.maximum(a, b)
+            chunk_keys, chunk_counts = np.unique(keys, return_counts=True)
+            keys_parts.append(chunk_keys)
+            counts_parts.append(chunk_counts)
+        start = stop
+    if not keys_parts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    keys, inverse = np.unique(np.concatenate(keys_parts), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(counts_parts)).astype(np.int64)
+    return keys, counts
+
+
+@dataclass(frozen=True)
+class RecommendationTables:
+    """Compact, read-only neighbor and popularity tables (row positions index into `product_ids`)."""
+    product_ids: np.ndarray  # Sorted ids of every purchased product
+    neighbor_offsets: np.ndarray
+    neighbor_items: np.ndarray
+    neighbor_scores: np.ndarray  # Shrunk cosine similarity of co-purchases
+    school_ids: np.ndarray  # Sorted
+    popular_offsets: np.ndarray
+    popular_items: np.ndarray
+    popular_scores: np.ndarray  # Distinct buyers at the school, relative to its most popular product
+    global_popular_items: np.ndarray
+    source_version: np.ndarray  # Purchase_History version the tables were built from (0-d)
+
+    @classmethod
+    def build(cls, users: np.ndarray, schools: np.ndarray, products: np.ndarray, quantities: np.ndarray,
+              neighbors: int = RECOMMENDATION_NEIGHBORS, popular: int = RECOMMENDATION_POPULAR,
+              max_basket_size: int = MAX_BASKET_SIZE, source_version: int = 0) -> "RecommendationTables":
+        """Builds the tables from per-(user, product) purchase aggregates; a school id of -1 means none."""
+        product_ids, items = np.unique(products, return_inverse=True)
+        item_count = len(product_ids)
+        buyers = np.bincount(items, minlength=item_count)
+
+        # --- Per-school popularity (distinct buyers) ---
+        has_school = schools >= 0
+        school_ids, school_index = np.unique(schools[has_school], return_inverse=True)
+        school_keys, school_buyers = np.unique(school_index.astype(np.int64) * item_count + items[has_school], return_counts=True)
+        popular_offsets, popular_items, popular_scores = _top_n_per_group(
+            school_keys // item_count, school_keys % item_count, school_buyers.astype(np.float64), len(school_ids), popular)
+        group_sizes = np.diff(popular_offsets)
+        popular_scores /= np.repeat(popular_scores[popular_offsets[:-1][group_sizes > 0]], group_sizes[group_sizes > 0])
+        global_popular_items = np.argsort(-buyers, kind="stable")[:popular].astype(np.int32)
+
+        # --- Item-item co-purchase similarity over each user's top products ---
+        order = np.lexsort((-quantities, users))
+        basket_users, basket_items = users[order], items[order]
+        basket_rank = np.arange(len(basket_users)) - np.searchsorted(basket_users, basket_users)
+        keep = basket_rank < max_basket_size
+        pair_keys, co_counts = _co_purchase_counts(basket_users[keep], basket_items[keep], item_count)
+        low, high = pair_keys // item_count, pair_keys % item_count
+        similarity = co_counts / (np.sqrt(buyers[low].astype(np.float64) * buyers[high]) + SIMILARITY_SHRINKAGE)
+        neighbor_offsets, neighbor_items, neighbor_scores = _top_n_per_group(
+            np.concatenate((low, high)), np.concatenate((high, low)), np.concatenate((similarity, similarity)),
+            item_count, neighbors)
+
+        return cls(product_ids, neighbor_offsets, neighbor_items, neighbor_scores, school_ids, popular_offsets,
+                   popular_items, popular_scores, global_popular_items, np.array(source_version, dtype=np.int64))
+
+    def save(self, path: str) -> None:
+        """Writes the tables as an uncompressed .npz, replacing `path` atomically (readers keep the old file mapped)."""
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, **{field.name: getattr(self, field.name) for field in fields(self)})
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "RecommendationTables":
+        """Memory-maps the tables, so worker processes loading the same file share its pages."""
+        arrays = _map_npz(path)
+        return cls(**{field.name: arrays[field.name] for field in fields(cls)})
+
+    def positions(self, product_ids: Iterable[int]) -> np.ndarray:
+        """Row positions of the given product ids (ids without purchases are dropped)."""
+        ids = np.fromiter(product_ids, dtype=np.int64)
+        if not len(self.product_ids) or not len(ids):
+            return np.zeros(0, dtype=np.int64)
+        found = np.minimum(np.searchsorted(self.product_ids, ids), len(self.product_ids) - 1)
+        return found[self.product_ids[found] == ids]
+
+    def school_position(self, school_id: Optional[int]) -> Optional[int]:
+        if school_id is None:
+            return None
+        position = int(np.searchsorted(self.school_ids, school_id))
+        if position < len(self.school_ids) and self.school_ids[position] == school_id:
+            return position
+        return None
+
+
+def _map_npz(path: str) -> Dict[str, np.ndarray]:
+    """
+    Opens the arrays of an uncompressed .npz (as written by np.savez) as read-only memory maps.
+    np.load cannot map archive members, so each member's .npy header is located in the zip.
+    """
+    arrays: Dict[str, np.ndarray] = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            name = info.filename[:-len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(archive.open(info))
+                continue
+            # Local file header: 30 fixed bytes, then the file name and extra field
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            if not shape or 0 in shape:
+                # Scalars and empty arrays cannot be mapped (and are not worth it)
+                arrays[name] = np.load(archive.open(info))
+                continue
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=f.tell(), shape=shape,
+                                     order="F" if fortran_order else "C")
+    return arrays
+
+
+class RecommendationIndex:
+    """
+    Item-item co-purchase neighbors and per-school popularity, built from Purchase_History with
+    NumPy and kept in memory. Lookups are dictionary-sized work over a handful of table slices.
+    `refresh()` rebuilds the tables in the background when new purchases have arrived and swaps
+    them in atomically, so readers never see a half-built index.
+    """
+
+    def __init__(self, neighbors: int = RECOMMENDATION_NEIGHBORS, popular: int = RECOMMENDATION_POPULAR):
+        self.neighbors = neighbors
+        self.popular = popular
+        self._tables: Optional[RecommendationTables] = None
+        self._loaded_mtime: Optional[int] = None  # Of the file the tables were loaded from
+        self._build_lock = threading.Lock()
+        self.builds = 0
+        self.last_build_seconds = 0.0
+
+    @property
+    def tables(self) -> Optional[RecommendationTables]:
+        return self._tables
+
+    def build_from_db(self) -> RecommendationTables:
+        """Reads the purchase aggregates and builds new tables (does not install them)."""
+        source_version = get_purchase_history_version()
+        columns: List[np.ndarray] = []
+        for batch in iter_user_product_purchases():
+            columns.append(np.array(batch, dtype=np.int64))
+        data = np.concatenate(columns) if columns else np.zeros((0, 4), dtype=np.int64)
+        return RecommendationTables.build(data[:, 0], data[:, 1], data[:, 2], data[:, 3], self.neighbors, self.popular,
+                                          source_version=source_version)
+
+    def refresh(self, force: bool = False) -> bool:
+        """Rebuilds the tables if Purchase_History changed since the last build. Returns whether it rebuilt."""
+        with self._build_lock:
+            current = self._tables
+            if not force and current is not None and int(current.source_version) == get_purchase_history_version():
+                return False
+            started = time.perf_counter()
+            tables = self.build_from_db()
+            self._tables = tables
+            self.builds += 1
+            self.last_build_seconds = time.perf_counter() - started
+        logger.info("Recommendation index built: %d products, %d neighbor entries, %d schools in %.2fs.",
+                    len(tables.product_ids), len(tables.neighbor_items), len(tables.school_ids), self.last_build_seconds)
+        return True
+
+    def load(self, path: Optional[str] = RECOMMENDATIONS_PATH) -> bool:
+        """Installs prebuilt tables from `path`. Returns False if there is no file to load."""
+        if not path or not os.path.exists(path):
+            return False
+        mtime = os.stat(path).st_mtime_ns
+        self._tables = RecommendationTables.load(path)
+        self._loaded_mtime = mtime
+        logger.info("Recommendation index loaded from %s (%d products).", path, len(self._tables.product_ids))
+        return True
+
+    def reload(self, path: Optional[str] = RECOMMENDATIONS_PATH) -> bool:
+        """Loads `path` again if it was rewritten (e.g. by another worker) since it was loaded. Returns whether it did."""
+        try:
+            if not path or os.stat(path).st_mtime_ns == self._loaded_mtime:
+                return False
+        except FileNotFoundError:
+            return False
+        return self.load(path)
+
+    def save(self, path: Optional[str] = RECOMMENDATIONS_PATH) -> bool:
+        """Writes the current tables to `path`. Returns False if there is nothing to save or nowhere to save it."""
+        tables = self._tables
+        if not path or tables is None:
+            return False
+        tables.save(path)
+        self._loaded_mtime = os.stat(path).st_mtime_ns
+        return True
+
+    def _affinity(self, tables: RecommendationTables, purchased_ids: Iterable[int],
+                  school_id: Optional[int]) -> Dict[int, float]:
+        """Co-purchase plus school popularity score per product id, from the user's purchases and school."""
+        scores: Dict[int, float] = {}
+        for position in tables.positions(purchased_ids):
+            group = slice(tables.neighbor_offsets[position], tables.neighbor_offsets[position + 1])
+            for item, score in zip(tables.neighbor_items[group].tolist(), tables.neighbor_scores[group].tolist()):
+                scores[item] = scores.get(item, 0.0) + CO_PURCHASE_WEIGHT * score
+        school = tables.school_position(school_id)
+        if school is not None:
+            group = slice(tables.popular_offsets[school], tables.popular_offsets[school + 1])
+            for item, score in zip(tables.popular_items[group].tolist(), tables.popular_scores[group].tolist()):
+                scores[item] = scores.get(item, 0.0) + SCHOOL_POPULARITY_WEIGHT * score
+        product_ids = tables.product_ids
+        return {int(product_ids[item]): score for item, score in scores.items()}
+
+    def rank(self, products: List[Dict[str, Any]], purchased_ids: Iterable[int], school_id: Optional[int],
+             limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Reorders search results (best match first) for a user: relevance, plus products they bought,
+        products bought together with theirs, and products popular at their school.
+        """
+        tables = self._tables
+        purchased = set(purchased_ids)
+        if not products or (tables is None and not purchased):
+            return products[:limit]
+        affinity = self._affinity(tables, purchased, school_id) if tables is not None else {}
+        count = len(products)
+
+        def score(entry: Tuple[int, Dict[str, Any]]) -> float:
+            rank, product = entry
+            product_id = product.get("id")
+            return (RELEVANCE_WEIGHT * (1.0 - rank / count) + PURCHASED_WEIGHT * (product_id in purchased)
+                    + affinity.get(product_id, 0.0))
+
+        ranked = sorted(enumerate(products), key=score, reverse=True)
+        return [product for _, product in ranked][:limit]
+
+    def recommend(self, purchased_ids: Iterable[int], school_id: Optional[int], limit: int = 5) -> List[int]:
+        """
+        Product ids to suggest without a search query: bought together with the user's purchases or
+        popular at their school, topped up with the most popular products overall.
+        """
+        tables = self._tables
+        if tables is None:
+            return []
+        purchased = set(purchased_ids)
+        affinity = self._affinity(tables, purchased, school_id)
+        ranked = [product_id for product_id, _ in sorted(affinity.items(), key=lambda item: item[1], reverse=True)
+                  if product_id not in purchased]
+        for item in tables.global_popular_items.tolist():
+            if len(ranked) >= limit:
+                break
+            product_id = int(tables.product_ids[item])
+            if product_id not in purchased and product_id not in ranked:
+                ranked.append(product_id)
+        return ranked[:limit]
+
+    def stats(self) -> Dict[str, Any]:
+        tables = self._tables
+        return {
+            "loaded": tables is not None,
+            "products": len(tables.product_ids) if tables is not None else 0,
+            "neighbor_entries": len(tables.neighbor_items) if tables is not None else 0,
+            "schools": len(tables.school_ids) if tables is not None else 0,
+            "source_version": int(tables.source_version) if tables is not None else 0,
+            "builds": self.builds,
+            "last_build_seconds": round(self.last_build_seconds, 3),
+        }
+
+
+# Shared instance used by the chat endpoint
+recommendation_index = RecommendationIndex()
+
+
+# --- Offline build ---
+# python recommendations.py build data/recommendations.npz
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 3 or sys.argv[1] != "build":
+        print("Usage: python recommendations.py build OUTPUT.npz")
+        sys.exit(1)
+    recommendation_index.refresh(force=True)
+    recommendation_index.tables.save(sys.argv[2])
+    print(f"Recommendation index written to {sys.argv[2]}")
@@ -0,0 +1,214 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+
+from workers import MULTI_WORKER, SHARED_STATE_DIR
+
+logger = logging.getLogger(__name__)
+
+# --- Response cache settings (overridable through environment variables) ---
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("CARTON_CAPS_RESPONSE_CACHE_MAX_ENTRIES", "2048"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("CARTON_CAPS_RESPONSE_CACHE_TTL", "3600"))
+# How long past the TTL persisted replies are kept as a fallback for when the LLM is unavailable
+RESPONSE_CACHE_STALE_SECONDS = float(os.getenv("CARTON_CAPS_RESPONSE_CACHE_STALE", "86400"))
+# The persistent tier deletes replies older than TTL + stale window once every this many writes
+RESPONSE_CACHE_PURGE_INTERVAL = 500
+# Set to a file path (e.g. data/ResponseCache.sqlite) to keep cached replies across restarts. With
+# several workers it defaults to one, so a reply generated by one worker is served by all of them.
+RESPONSE_CACHE_PATH = os.getenv("CARTON_CAPS_RESPONSE_CACHE_PATH",
+                                os.path.join(SHARED_STATE_DIR, "ResponseCache.sqlite") if MULTI_WORKER else None)
+
+# Personalized values shorter than this are not templated out of replies (e.g. numeric user ids)
+_MIN_PERSONALIZED_VALUE_LENGTH = 3
+_PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+
+
+def normalize_query(text: str) -> str:
+    """Lowercases, strips punctuation and collapses whitespace so trivially different phrasings share a key."""
+    return " ".join(_PUNCTUATION_PATTERN.sub(" ", text.lower()).split())
+
+
+def make_cache_key(intent: str, retrieved_context: str, query: str, model_name: str) -> str:
+    """Builds the cache key from the intent, the retrieved context, the normalized query and the model."""
+    material = "\x1f".join((model_name, intent, retrieved_context, normalize_query(query)))
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def depersonalize(text: str, personalization: Optional[Dict[str, str]]) -> str:
+    """Replaces the user's personal values in a reply with {placeholders} so it can be shared across users."""
+    if not personalization:
+        return text
+    text = text.replace("{", "{{").replace("}", "}}")
+    # Longest values first so e.g. a school name containing the user's name is templated whole
+    for field, value in sorted(personalization.items(), key=lambda item: -len(item[1] or "")):
+        if value and len(value) >= _MIN_PERSONALIZED_VALUE_LENGTH:
+            text = text.replace(value, "{" + field + "}")
+    return text
+
+
+def personalize(template: str, personalization: Optional[Dict[str, str]]) -> str:
+    """Fills a depersonalized reply with the current user's values."""
+    if not personalization:
+        personalization = {}
+    try:
+        return template.format_map(_DefaultPlaceholders(personalization))
+    except (ValueError, IndexError):
+        return template
+
+
+class _DefaultPlaceholders(dict):
+    def __missing__(self, key: str) -> str:
+        return "{" + key + "}"
+
+
+class ResponseCache:
+    """
+    LRU/TTL cache for LLM replies with an optional persistent SQLite backend.
+
+    The in-memory tier serves hot keys. With a `persistent_path`, every entry is written through
+    to a small SQLite file (separate from the application database), and memory misses are
+    looked up there, so cached replies survive restarts and are shared across workers. Rows
+    older than the TTL plus `stale_seconds` are deleted periodically on the write path.
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS,
+                 persistent_path: Optional[str] = RESPONSE_CACHE_PATH, stale_seconds: float = RESPONSE_CACHE_STALE_SECONDS):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.persistent_path = persistent_path
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()  # key -> (stored_at, reply)
+        self._lock = threading.Lock()
+        self._persistent_conn: Optional[sqlite3.Connection] = None
+        self._persistent_lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.persistent_writes = 0
+        self.purged = 0
+
+    # --- Persistent tier (runs in worker threads) ---
+    def _get_persistent_conn(self) -> sqlite3.Connection:
+        if self._persistent_conn is None:
+            conn = sqlite3.connect(self.persistent_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute("CREATE TABLE IF NOT EXISTS Response_Cache (key TEXT PRIMARY KEY, reply TEXT NOT NULL, stored_at REAL NOT NULL);")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_stored_at ON Response_Cache (stored_at);")
+            self._persistent_conn = conn
+        return self._persistent_conn
+
+    def _persistent_get(self, key: str, allow_stale: bool = False) -> Optional[Tuple[float, str]]:
+        oldest = time.time() - self.ttl_seconds - (self.stale_seconds if allow_stale else 0.0)
+        with self._persistent_lock:
+            row = self._get_persistent_conn().execute(
+                "SELECT stored_at, reply FROM Response_Cache WHERE key = ? AND stored_at >= ?;", (key, oldest),
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def _persistent_set(self, key: str, stored_at: float, reply: str) -> None:
+        with self._persistent_lock:
+            conn = self._get_persistent_conn()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO Response_Cache (key, reply, stored_at) VALUES (?, ?, ?);", (key, reply, stored_at))
+                self.persistent_writes += 1
+                if self.persistent_writes % RESPONSE_CACHE_PURGE_INTERVAL == 0:
+                    # Bounds the file: even get_stale() no longer serves rows this old
+                    oldest = stored_at - self.ttl_seconds - self.stale_seconds
+                    self.purged += conn.execute("DELETE FROM Response_Cache WHERE stored_at < ?;", (oldest,)).rowcount
+
+    # --- Public API ---
+    def _memory_get(self, key: str, allow_stale: bool = False) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            # Expired entries are kept until LRU eviction so they can still be served by get_stale()
+            if not allow_stale and time.time() - entry[0] > self.ttl_seconds:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _memory_set(self, key: str, stored_at: float, reply: str) -> None:
+        with self._lock:
+            self._entries[key] = (stored_at, reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    async def get(self, key: str) -> Optional[str]:
+        reply = self._memory_get(key)
+        if reply is not None:
+            self.hits += 1
+            return reply
+        if self.persistent_path:
+            try:
+                entry = await asyncio.to_thread(self._persistent_get, key)
+            except sqlite3.Error as e:
+                logger.warning("Response cache lookup failed: %s", e)
+                entry = None
+            if entry is not None:
+                self._memory_set(key, entry[0], entry[1])
+                self.hits += 1
+                self.persistent_hits += 1
+                return entry[1]
+        self.misses += 1
+        return None
+
+    async def get_stale(self, key: str) -> Optional[str]:
+        """Looks up a reply ignoring the TTL; used as a fallback when the LLM is unavailable."""
+        reply = self._memory_get(key, allow_stale=True)
+        if reply is None and self.persistent_path:
+            try:
+                entry = await asyncio.to_thread(self._persistent_get, key, True)
+            except sqlite3.Error as e:
+                logger.warning("Response cache lookup failed: %s", e)
+                entry = None
+            reply = entry[1] if entry else None
+        if reply is not None:
+            self.stale_hits += 1
+        return reply
+
+    async def set(self, key: str, reply: str) -> None:
+        stored_at = time.time()
+        self._memory_set(key, stored_at, reply)
+        if self.persistent_path:
+            try:
+                await asyncio.to_thread(self._persistent_set, key, stored_at, reply)
+            except sqlite3.Error as e:
+                logger.warning("Response cache write failed: %s", e)
+
+    def close(self) -> None:
+        with self._persistent_lock:
+            if self._persistent_conn is not None:
+                self._persistent_conn.close()
+                self._persistent_conn = None
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "persistent": bool(self.persistent_path),
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "purged": self.purged,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# Shared instance used in front of get_gemini_response
+response_cache = ResponseCache()
@@ -0,0 +1,583 @@
+import functools
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Optional, List, Dict, Tuple, Sequence, Any
+
+import numpy as np
+
+from db_utils import iter_product_texts, get_product_changes, get_product_changes_version, clear_product_changes, get_products_by_ids
+from knowledge_base import tokenize, Chunk
+
+logger = logging.getLogger(__name__)
+
+# --- Semantic index settings (overridable through environment variables) ---
+SEMANTIC_INDEX_DIR = os.getenv("CARTON_CAPS_SEMANTIC_INDEX_DIR",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'semantic_index'))
+EMBEDDING_DIM = int(os.getenv("CARTON_CAPS_EMBEDDING_DIM", "128"))
+SEMANTIC_IVF_PROBES = int(os.getenv("CARTON_CAPS_SEMANTIC_IVF_PROBES", "8"))  # Clusters searched per query
+SEMANTIC_SYNC_SECONDS = float(os.getenv("CARTON_CAPS_SEMANTIC_SYNC_SECONDS", "30"))  # Product change polling; 0 disables
+# Hits below this cosine similarity are treated as unrelated to the query
+SEMANTIC_MIN_SCORE = float(os.getenv("CARTON_CAPS_SEMANTIC_MIN_SCORE", "0.3"))
+
+# Words, word pairs and character 4-grams (which tie "lunchbox" to "lunch") are hashed into this many features
+HASH_BUCKETS = 1 << 16
+CHAR_NGRAM = 4
+CHAR_NGRAM_WEIGHT = 0.5
+TERM_FEATURE_CACHE_SIZE = 100_000
+# Queries whose TF-IDF vector keeps less than this share of its length in the embedding space mostly
+# fall outside it, so their (renormalized) embedding would point somewhere arbitrary
+MIN_QUERY_COVERAGE = 0.25
+# The product projection is fitted on a random sample of this many product texts
+FIT_SAMPLE_SIZE = 50_000
+SVD_OVERSAMPLES = 10
+SVD_POWER_ITERATIONS = 2
+# Brute force below this many vectors; above it, an IVF index with about sqrt(n) clusters
+IVF_MIN_VECTORS = 20_000
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+EMBED_BATCH_SIZE = 10_000
+# Sparse products are summed this many nonzeros at a time to bound memory
+SPARSE_CHUNK_SIZE = 200_000
+# Reciprocal rank fusion constant (from the original RRF paper)
+RRF_K = 60
+
+_MANIFEST_NAME = "manifest.json"
+
+
+def _feature(name: str) -> int:
+    return zlib.crc32(name.encode("utf-8")) % HASH_BUCKETS
+
+
+@functools.lru_cache(maxsize=TERM_FEATURE_CACHE_SIZE)
+def _term_features(term: str) -> Tuple[Tuple[int, float], ...]:
+    padded = f"<{term}>"
+    return ((_feature("w:" + term), 1.0),) + tuple(
+        (_feature("c:" + padded[start:start + CHAR_NGRAM]), CHAR_NGRAM_WEIGHT) for start in range(len(padded) - CHAR_NGRAM + 1))
+
+
+def text_features(text: str) -> Dict[int, float]:
+    """Hashed, sublinearly weighted word, word pair and character n-gram counts."""
+    terms = tokenize(text)
+    counts: Dict[int, float] = {}
+    for term in terms:
+        for bucket, weight in _term_features(term):
+            counts[bucket] = counts.get(bucket, 0.0) + weight
+    for first, second in zip(terms, terms[1:]):
+        bucket = _feature(f"b:{first} {second}")
+        counts[bucket] = counts.get(bucket, 0.0) + 1.0
+    return {bucket: math.log1p(count) for bucket, count in counts.items()}
+
+
+def _segment_sum(keys: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+    """Sums the rows of `values` sharing a key into a (size, ...) array."""
+    out = np.zeros((size,) + values.shape[1:], dtype=np.float32)
+    if not len(keys):
+        return out
+    order = np.argsort(keys, kind="stable")
+    keys, values = keys[order], values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    out[keys[starts]] = np.add.reduceat(values, starts, axis=0)
+    return out
+
+
+class SparseRows:
+    """A row-major sparse matrix in coordinate form (rows, cols, vals) with its sparse-dense products."""
+
+    def __init__(self, rows: np.ndarray, cols: np.ndarray, vals: np.ndarray, shape: Tuple[int, int]):
+        self.rows, self.cols, self.vals, self.shape = rows, cols, vals, shape
+
+    @classmethod
+    def from_features(cls, features: List[Dict[int, float]]) -> "SparseRows":
+        nnz = sum(len(row) for row in features)
+        rows = np.repeat(np.arange(len(features)), [len(row) for row in features])
+        cols = np.fromiter(itertools.chain.from_iterable(features), dtype=np.int64, count=nnz)
+        vals = np.fromiter(itertools.chain.from_iterable(row.values() for row in features), dtype=np.float32, count=nnz)
+        return cls(rows, cols, vals, (len(features), HASH_BUCKETS))
+
+    def dot(self, dense: np.ndarray) -> np.ndarray:
+        """self @ dense"""
+        out = np.zeros((self.shape[0], dense.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.vals), SPARSE_CHUNK_SIZE):
+            chunk = slice(start, start + SPARSE_CHUNK_SIZE)
+            out += _segment_sum(self.rows[chunk], self.vals[chunk, None] * dense[self.cols[chunk]], self.shape[0])
+        return out
+
+    def transpose_dot(self, dense: np.ndarray) -> np.ndarray:
+        """self.T @ dense"""
+        out = np.zeros((self.shape[1], dense.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.vals), SPARSE_CHUNK_SIZE):
+            chunk = slice(start, start + SPARSE_CHUNK_SIZE)
+            out += _segment_sum(self.cols[chunk], self.vals[chunk, None] * dense[self.rows[chunk]], self.shape[1])
+        return out
+
+
+def _tfidf(matrix: SparseRows, idf: np.ndarray) -> SparseRows:
+    """Weights a feature count matrix by idf and scales each row to unit length (in place)."""
+    matrix.vals = matrix.vals * idf[matrix.cols]
+    norms = np.sqrt(_segment_sum(matrix.rows, matrix.vals ** 2, matrix.shape[0]))
+    matrix.vals = matrix.vals / np.maximum(norms[matrix.rows], 1e-12)
+    return matrix
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+class TextEmbedder:
+    """
+    CPU-only text embeddings by latent semantic analysis: TF-IDF over hashed features, projected
+    onto the top singular vectors of the corpus (randomized SVD), so words that occur in similar
+    products ("healthy", "fruit", "lunch") land near each other.
+    """
+
+    def __init__(self, projection: np.ndarray, idf: np.ndarray):
+        self.projection = projection  # (HASH_BUCKETS, dim)
+        self.idf = idf  # (HASH_BUCKETS,)
+
+    @property
+    def dim(self) -> int:
+        return self.projection.shape[1]
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Unit-length (len(texts), dim) float32 embeddings (zero for texts with no known features)."""
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        matrix = _tfidf(SparseRows.from_features([text_features(text) for text in texts]), self.idf)
+        return _normalize(matrix.dot(self.projection))
+
+    def embed_query(self, text: str) -> Optional[np.ndarray]:
+        """Embedding of a search query, or None if too little of it is known to the embedding space."""
+        projected = _tfidf(SparseRows.from_features([text_features(text)]), self.idf).dot(self.projection)[0]
+        coverage = float(np.linalg.norm(projected))
+        if coverage < MIN_QUERY_COVERAGE:
+            return None
+        return (projected / coverage).astype(np.float32)
+
+    @classmethod
+    def fit(cls, texts: Sequence[str], dim: int = EMBEDDING_DIM, seed: int = 0) -> "TextEmbedder":
+        matrix = SparseRows.from_features([text_features(text) for text in texts])
+        document_frequency = np.bincount(matrix.cols, minlength=HASH_BUCKETS)
+        # Features the corpus never uses carry no meaning in the embedding space, so they get no weight
+        idf = np.where(document_frequency > 0, np.log((1 + len(texts)) / (1 + document_frequency)) + 1, 0).astype(np.float32)
+        matrix = _tfidf(matrix, idf)
+
+        # Randomized SVD (Halko et al.): a range finder with power iterations, then an exact SVD of the small projection
+        rng = np.random.default_rng(seed)
+        sketch = matrix.dot(rng.standard_normal((HASH_BUCKETS, dim + SVD_OVERSAMPLES)).astype(np.float32))
+        for _ in range(SVD_POWER_ITERATIONS):
+            basis, _ = np.linalg.qr(sketch)
+            column_basis, _ = np.linalg.qr(matrix.transpose_dot(basis))
+            sketch = matrix.dot(column_basis)
+        basis, _ = np.linalg.qr(sketch)
+        _, _, right_vectors = np.linalg.svd(matrix.transpose_dot(basis).T, full_matrices=False)
+        projection = np.zeros((HASH_BUCKETS, dim), dtype=np.float32)
+        components = min(dim, right_vectors.shape[0])
+        projection[:, :components] = right_vectors[:components].T
+        return cls(projection, idf)
+
+    def save(self, path: str) -> None:
+        np.savez(path, projection=self.projection, idf=self.idf)
+
+    @classmethod
+    def load(cls, path: str) -> "TextEmbedder":
+        with np.load(path) as data:
+            return cls(data["projection"], data["idf"])
+
+
+class VectorStore:
+    """
+    Float32 vectors and their int64 ids in memory-mapped .npy files. Pages are loaded by the OS on
+    demand and shared by every process that opens the files. Rows are updated in place and the
+    files double in size when full; an id of -1 marks an empty (deleted) row.
+    """
+
+    def __init__(self, vectors: np.ndarray, ids: np.ndarray, size: int):
+        self.vectors = vectors
+        self.ids = ids
+        self.size = size
+
+    @staticmethod
+    def paths(directory: str, name: str) -> Tuple[str, str]:
+        return os.path.join(directory, f"{name}.vectors.npy"), os.path.join(directory, f"{name}.ids.npy")
+
+    @classmethod
+    def create(cls, directory: str, name: str, dim: int, capacity: int) -> "VectorStore":
+        vectors_path, ids_path = cls.paths(directory, name)
+        vectors = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=np.float32, shape=(max(1, capacity), dim))
+        ids = np.lib.format.open_memmap(ids_path, mode="w+", dtype=np.int64, shape=(max(1, capacity),))
+        ids[:] = -1
+        return cls(vectors, ids, 0)
+
+    @classmethod
+    def open(cls, directory: str, name: str, size: int) -> "VectorStore":
+        vectors_path, ids_path = cls.paths(directory, name)
+        return cls(np.load(vectors_path, mmap_mode="r+"), np.load(ids_path, mmap_mode="r+"), size)
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def append(self, ids: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+        """Writes new rows (the caller ensures capacity, e.g. via `grow()`). Returns their row numbers."""
+        rows = np.arange(self.size, self.size + len(ids))
+        self.vectors[rows] = vectors
+        self.ids[rows] = ids
+        self.size += len(ids)
+        return rows
+
+    def grow(self, directory: str, name: str, needed: int) -> "VectorStore":
+        """Returns this store, or a copy in files twice as large if `needed` more rows do not fit."""
+        capacity = len(self.ids)
+        if self.size + needed <= capacity:
+            return self
+        while capacity < self.size + needed:
+            capacity *= 2
+        grown = VectorStore.create(directory, name, self.dim, capacity)
+        grown.append(self.ids[:self.size], self.vectors[:self.size])
+        return grown
+
+    def rows_of(self, ids: np.ndarray) -> np.ndarray:
+        """Row number of each id, or -1 where it is not stored."""
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        if not self.size:
+            return rows
+        live = np.asarray(self.ids[:self.size])
+        order = np.argsort(live, kind="stable")
+        candidates = order[np.minimum(np.searchsorted(live, ids, sorter=order), self.size - 1)]
+        found = live[candidates] == ids
+        rows[found] = candidates[found]
+        return rows
+
+    def flush(self) -> None:
+        self.vectors.flush()
+        self.ids.flush()
+
+    def search(self, query: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Top-k (id, cosine similarity) among `rows` (default: every row), best first."""
+        if rows is None:
+            candidate_ids, scores = self.ids[:self.size], self.vectors[:self.size] @ query
+        else:
+            candidate_ids, scores = self.ids[rows], self.vectors[rows] @ query
+        scores = np.where(candidate_ids >= 0, scores, -np.inf)
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(candidate_ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+
+@dataclass
+class IvfLists:
+    """Inverted file index: k-means centroids and, per centroid, the rows assigned to it (CSR layout)."""
+    centroids: np.ndarray
+    offsets: np.ndarray
+    rows: np.ndarray
+    covered_rows: int  # Rows beyond this were added after the lists were built and are always scanned
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, size: int, lists: int, seed: int = 0) -> "IvfLists":
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(vectors[np.sort(rng.choice(size, min(size, lists * KMEANS_SAMPLE_PER_LIST), replace=False))])
+        centroids = sample[rng.choice(len(sample), lists, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = _segment_sum(assignment, sample, lists)
+            filled = np.linalg.norm(sums, axis=1) > 0
+            centroids[filled] = _normalize(sums[filled])
+        assignment = np.concatenate([np.argmax(vectors[start:min(size, start + EMBED_BATCH_SIZE)] @ centroids.T, axis=1)
+                                     for start in range(0, size, EMBED_BATCH_SIZE)])
+        offsets = np.zeros(lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=lists), out=offsets[1:])
+        return cls(centroids.astype(np.float32), offsets, np.argsort(assignment, kind="stable").astype(np.int64), size)
+
+    def candidates(self, query: np.ndarray, probes: int) -> np.ndarray:
+        probes = min(probes, len(self.centroids))
+        nearest = np.argpartition(-(self.centroids @ query), probes - 1)[:probes]
+        return np.concatenate([self.rows[self.offsets[c]:self.offsets[c + 1]] for c in nearest])
+
+    def save(self, path: str) -> None:
+        np.savez(path, centroids=self.centroids, offsets=self.offsets, rows=self.rows, covered_rows=self.covered_rows)
+
+    @classmethod
+    def load(cls, path: str) -> "IvfLists":
+        with np.load(path) as data:
+            return cls(data["centroids"], data["offsets"], data["rows"], int(data["covered_rows"]))
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Any]], k: int = RRF_K) -> List[Any]:
+    """Merges ranked lists of keys: each key scores the sum of 1 / (k + rank) over the lists it appears in."""
+    scores: Dict[Any, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda key: scores[key], reverse=True)
+
+
+def product_text(name: str, description: Optional[str]) -> str:
+    return f"{name}. {description or ''}"
+
+
+class SemanticIndex:
+    """
+    Embedding search over Products (memory-mapped vectors on disk) and the referral FAQ/rules
+    passages (a small in-memory matrix with its own embedder, fitted on the passages at startup
+    by `prepare_passages()`).
+
+    `build()` fits the embedder and embeds every product. `sync_products()` then applies the
+    Product_Changes log (filled by triggers on Products) so added, edited and deleted products
+    are re-embedded without a rebuild. Builds write new files and switch over through the
+    manifest, so searches keep using the previous files until the new ones are complete. With
+    several workers one of them builds and syncs, and the others `reload()` when the manifest
+    changes, mapping the same files.
+    """
+
+    def __init__(self, directory: str = SEMANTIC_INDEX_DIR, dim: int = EMBEDDING_DIM, probes: int = SEMANTIC_IVF_PROBES):
+        self.directory = directory
+        self.dim = dim
+        self.probes = probes
+        self._lock = threading.Lock()  # Serializes builds and syncs; searches read a consistent snapshot without it
+        self._embedder: Optional[TextEmbedder] = None
+        self._store: Optional[VectorStore] = None
+        self._ivf: Optional[IvfLists] = None
+        self._unlisted_rows = np.zeros(0, dtype=np.int64)  # Rows added or changed since the IVF lists were built
+        self._manifest: Dict[str, Any] = {}
+        self._passages: Optional[Tuple[List[Chunk], TextEmbedder, np.ndarray]] = None  # (chunks, embedder, vectors)
+        self.builds = 0
+        self.synced_changes = 0
+        self.last_build_seconds = 0.0
+
+    @property
+    def ready(self) -> bool:
+        return self._store is not None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _write_manifest(self, manifest: Dict[str, Any]) -> None:
+        temp_path = self._path(_MANIFEST_NAME + ".tmp")
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, self._path(_MANIFEST_NAME))
+        self._manifest = manifest
+
+    def load(self) -> bool:
+        """Opens the index files named by the manifest. Returns False if no index has been built."""
+        try:
+            with open(self._path(_MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        generation = manifest["generation"]
+        embedder = TextEmbedder.load(self._path(f"embedder-{generation}.npz"))
+        store = VectorStore.open(self.directory, manifest["store"], manifest["size"])
+        ivf = IvfLists.load(self._path(f"ivf-{generation}.npz")) if manifest.get("ivf") else None
+        with self._lock:
+            self._embedder, self._store, self._ivf = embedder, store, ivf
+            self._unlisted_rows = np.arange(ivf.covered_rows, store.size) if ivf is not None else np.zeros(0, dtype=np.int64)
+            self._unlisted_rows = np.union1d(self._unlisted_rows, np.asarray(manifest.get("changed_rows", []), dtype=np.int64))
+            self._manifest = manifest
+        logger.info("Semantic index loaded: %d products (%s search).", store.size, "IVF" if ivf is not None else "brute-force")
+        return True
+
+    def reload(self) -> bool:
+        """Opens the index again if another process has written a new manifest. Returns whether it did."""
+        try:
+            with open(self._path(_MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if manifest == self._manifest:
+            return False
+        return self.load()
+
+    def build(self) -> None:
+        """Fits the embedder on a sample of product texts and embeds every product."""
+        with self._lock:
+            started = time.perf_counter()
+            os.makedirs(self.directory, exist_ok=True)
+            changes_version = get_product_changes_version()  # Changes after this are applied by the next sync
+
+            # Reservoir-sample the fitting corpus in one pass over Products
+            sample: List[str] = []
+            rng = random.Random(0)
+            product_count = 0
+            for batch in iter_product_texts():
+                for _, name, description in batch:
+                    product_count += 1
+                    if len(sample) < FIT_SAMPLE_SIZE:
+                        sample.append(product_text(name, description))
+                    else:
+                        slot = rng.randrange(product_count)
+                        if slot < FIT_SAMPLE_SIZE:
+                            sample[slot] = product_text(name, description)
+            embedder = TextEmbedder.fit(sample, self.dim)
+
+            generation = int(time.time() * 1000)
+            store_name = f"products-{generation}"
+            store = VectorStore.create(self.directory, store_name, self.dim, product_count)
+            for batch in iter_product_texts(EMBED_BATCH_SIZE):
+                # Products inserted since the counting pass are picked up from the change log
+                batch = batch[:len(store.ids) - store.size]
+                store.append(np.array([product_id for product_id, _, _ in batch], dtype=np.int64),
+                             embedder.embed([product_text(name, description) for _, name, description in batch]))
+            store.flush()
+            ivf = None
+            if store.size >= IVF_MIN_VECTORS:
+                ivf = IvfLists.build(store.vectors, store.size, int(math.sqrt(store.size)))
+                ivf.save(self._path(f"ivf-{generation}.npz"))
+            embedder.save(self._path(f"embedder-{generation}.npz"))
+
+            previous = self._manifest
+            self._write_manifest({"generation": generation, "store": store_name, "size": store.size, "dim": self.dim,
+                                  "ivf": ivf is not None, "changed_rows": []})
+            self._embedder, self._store, self._ivf = embedder, store, ivf
+            self._unlisted_rows = np.zeros(0, dtype=np.int64)
+            clear_product_changes(changes_version)
+            if previous:
+                self._remove_files(previous)
+            self.builds += 1
+            self.last_build_seconds = time.perf_counter() - started
+        logger.info("Semantic index built: %d products in %.1fs.", store.size, self.last_build_seconds)
+
+    def _remove_files(self, manifest: Dict[str, Any], store_only: bool = False) -> None:
+        # Processes that still map the old files keep reading them until they reload, so unlinking is safe
+        paths = list(VectorStore.paths(self.directory, manifest["store"]))
+        if not store_only:
+            paths += [self._path(f"embedder-{manifest['generation']}.npz"), self._path(f"ivf-{manifest['generation']}.npz")]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def sync_products(self) -> int:
+        """Re-embeds products from the change log (adds, edits and deletes). Returns the number applied."""
+        if not self.ready:
+            return 0
+        with self._lock:
+            changes = get_product_changes()
+            if not changes:
+                return 0
+            product_ids = list(dict.fromkeys(product_id for _, product_id in changes))
+            current = {product["id"]: product for product in get_products_by_ids(product_ids)}
+            store = self._store
+            deleted_rows: List[int] = []
+            edited: List[Tuple[int, int]] = []  # (product_id, row)
+            added: List[int] = []
+            for product_id, row in zip(product_ids, store.rows_of(np.array(product_ids, dtype=np.int64)).tolist()):
+                if product_id not in current:
+                    if row >= 0:
+                        deleted_rows.append(row)
+                elif row >= 0:
+                    edited.append((product_id, row))
+                else:
+                    added.append(product_id)
+
+            def embed(ids: List[int]) -> np.ndarray:
+                return self._embedder.embed([product_text(current[i]["name"], current[i]["description"]) for i in ids])
+
+            store.ids[deleted_rows] = -1
+            touched_rows = np.array([row for _, row in edited], dtype=np.int64)
+            if edited:
+                store.vectors[touched_rows] = embed([product_id for product_id, _ in edited])
+            manifest = self._manifest
+            if added:
+                store_name = f"products-{manifest['generation']}-{store.size + len(added)}"
+                grown = store.grow(self.directory, store_name, len(added))
+                touched_rows = np.concatenate((touched_rows, grown.append(np.array(added, dtype=np.int64), embed(added))))
+                if grown is not store:
+                    manifest = dict(manifest, store=store_name)
+                store = grown
+            store.flush()
+
+            if self._ivf is not None:
+                self._unlisted_rows = np.union1d(self._unlisted_rows, touched_rows)
+            self._store = store
+            previous = self._manifest
+            self._write_manifest(dict(manifest, size=store.size, changed_rows=self._unlisted_rows.tolist()))
+            if manifest["store"] != previous["store"]:
+                self._remove_files(previous, store_only=True)
+            clear_product_changes(changes[-1][0])
+            self.synced_changes += len(changes)
+        logger.info("Semantic index applied %d product changes.", len(changes))
+        return len(changes)
+
+    def search_products(self, query: str, k: int = 20, min_score: float = SEMANTIC_MIN_SCORE) -> List[Tuple[int, float]]:
+        """Top-k (product_id, similarity) for the query, best first."""
+        embedder, store, ivf, unlisted = self._embedder, self._store, self._ivf, self._unlisted_rows
+        if store is None:
+            return []
+        query_vector = embedder.embed_query(query)
+        if query_vector is None:
+            return []
+        rows = None
+        if ivf is not None:
+            rows = np.union1d(ivf.candidates(query_vector, self.probes), unlisted)
+        return [(product_id, score) for product_id, score in store.search(query_vector, k, rows) if score >= min_score]
+
+    def prepare_passages(self, chunks: List[Chunk]) -> Tuple[List[Chunk], TextEmbedder, np.ndarray]:
+        """Fits the passage embedder and embeds `chunks` unless already done for this list (called at startup)."""
+        passages = self._passages
+        if passages is None or passages[0] is not chunks:
+            texts = [chunk.text for chunk in chunks]
+            embedder = TextEmbedder.fit(texts, self.dim)
+            passages = self._passages = (chunks, embedder, embedder.embed(texts))
+        return passages
+
+    def search_passages(self, query: str, chunks: List[Chunk], k: int = 3,
+                        min_score: float = SEMANTIC_MIN_SCORE) -> List[Chunk]:
+        """Top-k of the knowledge base `chunks` for the query; the passage embeddings are refitted when the list changes."""
+        if not chunks:
+            return []
+        _, embedder, vectors = self.prepare_passages(chunks)
+        query_vector = embedder.embed_query(query)
+        if query_vector is None:
+            return []
+        scores = vectors @ query_vector
+        ranked = np.argsort(-scores, kind="stable")[:k]
+        return [chunks[i] for i in ranked if scores[i] >= min_score]
+
+    def stats(self) -> Dict[str, Any]:
+        store = self._store
+        return {
+            "ready": store is not None,
+            "products": int((store.ids[:store.size] >= 0).sum()) if store is not None else 0,
+            "ivf_lists": len(self._ivf.centroids) if self._ivf is not None else 0,
+            "unlisted_rows": len(self._unlisted_rows),
+            "builds": self.builds,
+            "synced_changes": self.synced_changes,
+            "last_build_seconds": round(self.last_build_seconds, 3),
+        }
+
+
+# Shared instance used by the chat endpoint
+semantic_index = SemanticIndex()
+
+
+# --- Maintenance commands ---
+# python semantic_index.py build | sync
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if command == "build":
+        semantic_index.build()
+    elif command == "sync":
+        if not semantic_index.load():
+            print("No semantic index found; run 'python semantic_index.py build' first.")
+            sys.exit(1)
+        print(f"Applied {semantic_index.sync_products()} product changes.")
+    else:
+        print(f"Unknown command: {command}. Expected 'build' or 'sync'.")
+        sys.exit(1)
@@ -0,0 +1,287 @@
+import datetime
+import json
+import logging
+import sqlite3
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, Callable, Tuple
+
+from db_utils import (get_conversation_history_from_db_async, get_session_window_async, get_session_summary_async,
+                      update_session_window_async, delete_expired_session_windows_async)
+from prompt_builder import RollingSummary
+from workers import MULTI_WORKER
+
+logger = logging.getLogger(__name__)
+
+# --- Session store settings (overridable through environment variables) ---
+# "memory", "sqlite" or "shared" (required with several worker processes, and the default then)
+SESSION_BACKEND = os.getenv("CARTON_CAPS_SESSION_BACKEND", "shared" if MULTI_WORKER else "memory")
+SESSION_MAX_SESSIONS = int(os.getenv("CARTON_CAPS_SESSION_MAX_SESSIONS", "10000"))
+SESSION_MAX_MESSAGES = int(os.getenv("CARTON_CAPS_SESSION_MAX_MESSAGES", "20"))
+SESSION_TTL_SECONDS = float(os.getenv("CARTON_CAPS_SESSION_TTL", "1800"))
+# The shared store deletes expired session windows once every this many appends
+SHARED_SESSION_SWEEP_INTERVAL = 1000
+
+
+class SessionStore(ABC):
+    """Holds the recent message window for each chat session."""
+
+    @abstractmethod
+    async def get_history(self, session_id: str, user_id: str) -> List[Any]:
+        """Returns the session's recent messages (oldest first); empty for unknown sessions."""
+
+    @abstractmethod
+    async def append(self, session_id: str, user_id: str, messages: List[Any], summary: Optional[Any] = None) -> None:
+        """Appends messages to the session, keeping only the most recent window, and stores its rolling summary."""
+
+    @abstractmethod
+    async def get_summary(self, session_id: str) -> Optional[Any]:
+        """Returns the session's rolling summary of older turns, if one has been stored."""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        """Returns counters describing the store's current state."""
+
+    async def get_session(self, session_id: str, user_id: str) -> Tuple[List[Any], Optional[Any]]:
+        """Returns (the session's recent messages, its rolling summary)."""
+        return await self.get_history(session_id, user_id), await self.get_summary(session_id)
+
+
+class InMemorySessionStore(SessionStore):
+    """
+    In-process LRU/TTL session store.
+
+    Memory is bounded on both axes: at most `max_sessions` sessions (least recently used are
+    evicted first) and at most `max_messages` messages per session. Sessions idle for longer
+    than `ttl_seconds` expire.
+    """
+
+    def __init__(self, max_sessions: int = SESSION_MAX_SESSIONS, max_messages: int = SESSION_MAX_MESSAGES,
+                 ttl_seconds: float = SESSION_TTL_SECONDS):
+        self.max_sessions = max(1, max_sessions)
+        self.max_messages = max(1, max_messages)
+        self.ttl_seconds = ttl_seconds
+        self._sessions: "OrderedDict[str, Tuple[float, List[Any], Optional[Any]]]" = OrderedDict()  # session_id -> (last_access, messages, summary)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expire(self, now: float) -> None:
+        # The dict is kept in access order, so expired sessions are always at the front
+        while self._sessions:
+            session_id, (last_access, _, _) = next(iter(self._sessions.items()))
+            if now - last_access <= self.ttl_seconds:
+                break
+            del self._sessions[session_id]
+            self.expirations += 1
+
+    def _lookup(self, session_id: str) -> Optional[List[Any]]:
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._sessions[session_id] = (now, entry[1], entry[2])
+            self._sessions.move_to_end(session_id)
+            return list(entry[1])
+
+    def _store(self, session_id: str, messages: List[Any], summary: Optional[Any] = None) -> None:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            window = (entry[1] if entry else []) + list(messages)
+            if summary is None and entry:
+                summary = entry[2]
+            self._sessions[session_id] = (now, window[-self.max_messages:], summary)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    async def get_history(self, session_id: str, user_id: str) -> List[Any]:
+        return self._lookup(session_id) or []
+
+    async def append(self, session_id: str, user_id: str, messages: List[Any], summary: Optional[Any] = None) -> None:
+        self._store(session_id, messages, summary)
+
+    async def get_summary(self, session_id: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            return entry[2] if entry else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "max_messages_per_session": self.max_messages,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class SQLiteSessionStore(InMemorySessionStore):
+    """
+    LRU/TTL window cache backed by Conversation_History.
+
+    Messages are persisted by the conversation write-behind queue, so this store only keeps the
+    hot window in memory. On a miss (cold session, another worker, or after a restart) the
+    window is rehydrated from the database and converted with `message_from_row`.
+    """
+
+    def __init__(self, message_from_row: Callable[[Dict[str, Any]], Any], **kwargs: Any):
+        super().__init__(**kwargs)
+        self.message_from_row = message_from_row
+        self.rehydrations = 0
+
+    async def get_history(self, session_id: str, user_id: str) -> List[Any]:
+        cached = self._lookup(session_id)
+        if cached is not None:
+            return cached
+        rows = await get_conversation_history_from_db_async(session_id, user_id, limit=self.max_messages)
+        messages = []
+        for row in rows:
+            if isinstance(row.get("timestamp"), datetime.datetime):
+                messages.append(self.message_from_row(row))
+        if messages:
+            self.rehydrations += 1
+            self._store(session_id, messages)
+        return messages
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats.update(backend="sqlite", rehydrations=self.rehydrations)
+        return stats
+
+
+class SharedSessionStore(SessionStore):
+    """
+    Session store for multi-worker deployments. Each session's message window and rolling summary
+    live in the Session_Windows table, so whichever worker serves a turn sees the turns before it.
+    Nothing is cached in the process: a turn costs one primary-key read (`get_session()` returns
+    the messages and summary together) and one small upsert. Sessions idle for longer than
+    `ttl_seconds` are rehydrated from Conversation_History and stored as a new window.
+    """
+
+    def __init__(self, message_from_row: Callable[[Dict[str, Any]], Any], max_messages: int = SESSION_MAX_MESSAGES,
+                 ttl_seconds: float = SESSION_TTL_SECONDS):
+        self.message_from_row = message_from_row
+        self.max_messages = max(1, max_messages)
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.rehydrations = 0
+        self.appends = 0
+        self.append_failures = 0
+        self.expirations = 0
+
+    def _message_row(self, message: Any) -> Dict[str, Any]:
+        # Same shape as a Conversation_History row, so message_from_row converts both
+        return {"role": "bot" if message.role == "assistant" else message.role, "content": message.content,
+                "timestamp": message.timestamp.isoformat()}
+
+    def _decode_messages(self, text: str) -> List[Any]:
+        return [self.message_from_row(dict(row, timestamp=datetime.datetime.fromisoformat(row["timestamp"])))
+                for row in json.loads(text)]
+
+    @staticmethod
+    def _encode_summary(summary: RollingSummary) -> str:
+        until = summary.summarized_until.isoformat() if summary.summarized_until else None
+        return json.dumps({"lines": list(summary.lines), "summarized_until": until})
+
+    @staticmethod
+    def _decode_summary(text: str) -> RollingSummary:
+        data = json.loads(text)
+        until = data.get("summarized_until")
+        return RollingSummary(tuple(data["lines"]), datetime.datetime.fromisoformat(until) if until else None)
+
+    async def get_history(self, session_id: str, user_id: str) -> List[Any]:
+        messages, _ = await self.get_session(session_id, user_id)
+        return messages
+
+    async def get_session(self, session_id: str, user_id: str) -> Tuple[List[Any], Optional[Any]]:
+        window = await get_session_window_async(session_id, time.time() - self.ttl_seconds)
+        if window is not None:
+            self.hits += 1
+            summary = self._decode_summary(window["summary"]) if window["summary"] else None
+            return self._decode_messages(window["messages"]), summary
+        self.misses += 1
+        rows = await get_conversation_history_from_db_async(session_id, user_id, limit=self.max_messages)
+        messages = [self.message_from_row(row) for row in rows if isinstance(row.get("timestamp"), datetime.datetime)]
+        if messages:
+            self.rehydrations += 1
+            await self._seed_window(session_id, user_id, messages)
+        return messages, None
+
+    async def _seed_window(self, session_id: str, user_id: str, messages: List[Any]) -> None:
+        """Stores rehydrated messages as the session's window, so the next append builds on them."""
+        seed = json.dumps([self._message_row(message) for message in messages[-self.max_messages:]])
+
+        def update(window: Optional[Dict[str, Any]]) -> Tuple[str, Optional[str]]:
+            # Another worker may have started the window in the meantime; keep theirs
+            return (window["messages"], window["summary"]) if window else (seed, None)
+
+        now = time.time()
+        try:
+            await update_session_window_async(session_id, user_id, now - self.ttl_seconds, now, update)
+        except (sqlite3.Error, FileNotFoundError) as e:
+            logger.error("Failed to store the rehydrated window of session %s: %s", session_id, e)
+
+    async def append(self, session_id: str, user_id: str, messages: List[Any], summary: Optional[Any] = None) -> None:
+        new_rows = [self._message_row(message) for message in messages]
+        encoded_summary = self._encode_summary(summary) if summary is not None else None
+
+        def update(window: Optional[Dict[str, Any]]) -> Tuple[str, Optional[str]]:
+            rows = (json.loads(window["messages"]) if window else []) + new_rows
+            return json.dumps(rows[-self.max_messages:]), encoded_summary or (window["summary"] if window else None)
+
+        now = time.time()
+        try:
+            await update_session_window_async(session_id, user_id, now - self.ttl_seconds, now, update)
+        except (sqlite3.Error, FileNotFoundError) as e:
+            self.append_failures += 1
+            logger.error("Failed to store the window of session %s: %s", session_id, e)
+            return
+        self.appends += 1
+        if self.appends % SHARED_SESSION_SWEEP_INTERVAL == 0:
+            self.expirations += await delete_expired_session_windows_async(now - self.ttl_seconds)
+
+    async def get_summary(self, session_id: str) -> Optional[Any]:
+        text = await get_session_summary_async(session_id, time.time() - self.ttl_seconds)
+        return self._decode_summary(text) if text else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "shared",
+            "max_messages_per_session": self.max_messages,
+            "hits": self.hits,
+            "misses": self.misses,
+            "rehydrations": self.rehydrations,
+            "appends": self.appends,
+            "append_failures": self.append_failures,
+            "expirations": self.expirations,
+        }
+
+
+def create_session_store(message_from_row: Callable[[Dict[str, Any]], Any], backend: str = SESSION_BACKEND) -> SessionStore:
+    """Builds the session store selected by CARTON_CAPS_SESSION_BACKEND."""
+    if backend == "shared":
+        return SharedSessionStore(message_from_row)
+    if MULTI_WORKER:
+        logger.warning("Session backend '%s' keeps sessions per worker process; use 'shared' with several workers.", backend)
+    if backend == "sqlite":
+        return SQLiteSessionStore(message_from_row)
+    if backend != "memory":
+        logger.warning("Unknown session backend '%s', using the in-memory store.", backend)
+    return InMemorySessionStore()
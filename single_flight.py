@@ -0,0 +1,66 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent identical work: while a call for a key is in flight, later calls for the
+    same key wait for its result instead of starting their own.
+
+    The work runs as its own task, so a caller that goes away (e.g. a client disconnecting) does
+    not cancel it for the others; a finished call is forgotten, so results are not cached here.
+    Results are shared as-is, so callers must not mutate them.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, "asyncio.Task[Any]"] = {}
+        self.executions = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def submit(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Tuple["asyncio.Task[Any]", bool]:
+        """
+        Returns (the in-flight task for `key`, whether this call started it). `factory` is only
+        called when no call for `key` is in flight.
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return task, False
+        task = asyncio.ensure_future(factory())
+        self._calls[key] = task
+        self.executions += 1
+        task.add_done_callback(lambda done: self._finished(key, done))
+        return task, True
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Awaits the in-flight call for `key`, starting it with `factory()` if there is none."""
+        task, _ = self.submit(key, factory)
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: "asyncio.Task[Any]") -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Retrieve the exception so a call nobody waits for any more does not log "never retrieved"
+        if not task.cancelled() and task.exception() is not None:
+            self.failures += 1
+            logger.debug("Single-flight %s call failed: %r", self.name, task.exception())
+
+    def stats(self) -> Dict[str, Any]:
+        calls = self.executions + self.coalesced
+        return {
+            "in_flight": len(self._calls),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "coalesced_ratio": round(self.coalesced / calls, 4) if calls else 0.0,
+        }
+
+
+# Shared instances used by the chat endpoints: one for context retrieval, one for cacheable LLM replies
+retrieval_flights = SingleFlight("retrieval")
+reply_flights = SingleFlight("llm_reply")
@@ -5,7 +5,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const suggestedActionsContainer = document.getElementById('suggestedActionsContainer');
 
     // --- Configuration ---
-    const API_URL = 'http://127.0.0.1:8008/api/v1/carton_caps/chat'; // Your FastAPI backend URL
+    const API_URL = 'http://127.0.0.1:8008/api/v1/carton_caps/chat/stream'; // Streaming (NDJSON) variant of the chat endpoint
     let currentSessionId = `session_${Date.now()}_${Math.random().toString(36).substring(2, 15)}`; // Simple unique session ID
     let currentUserId = '1'; // Replace with actual user ID if/when auth is available
     let conversationHistory = [];
@@ -23,6 +23,36 @@ document.addEventListener('DOMContentLoaded', () => {
         }
         chatMessages.appendChild(messageDiv);
         chatMessages.scrollTop = chatMessages.scrollHeight; // Auto-scroll to bottom
+        return messageDiv;
+    }
+
+    // Creates an empty assistant message and returns a function that appends streamed text to it
+    function startStreamingMessage() {
+        const messageDiv = appendMessage('', 'assistant');
+        const p = messageDiv.querySelector('p');
+        return (text) => {
+            p.textContent += text;
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        };
+    }
+
+    // Reads a newline-delimited JSON response body, calling onFrame for each parsed frame as it arrives
+    async function readNdjsonStream(response, onFrame) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let newlineIndex;
+            while ((newlineIndex = buffer.indexOf('\n')) >= 0) {
+                const line = buffer.slice(0, newlineIndex).trim();
+                buffer = buffer.slice(newlineIndex + 1);
+                if (line) onFrame(JSON.parse(line));
+            }
+        }
+        if (buffer.trim()) onFrame(JSON.parse(buffer));
     }
 
     function displaySuggestedActions(actions) {
@@ -100,18 +130,30 @@ document.addEventListener('DOMContentLoaded', () => {
                 return;
             }
 
-            const data = await response.json();
-            
-            appendMessage(data.reply.text, 'assistant');
-            displaySuggestedActions(data.suggested_actions);
-
-            // Update conversation history with the full history from the server
-            if (data.updated_conversation_history) {
-                conversationHistory = data.updated_conversation_history.map(msg => ({
-                    ...msg,
-                    // Ensure timestamp is in a consistent format if needed, though API should provide ISO
-                })); 
+            // Render tokens as they arrive; metadata comes in the final frame
+            const appendToReply = startStreamingMessage();
+            let replyText = '';
+            let finalFrame = null;
+            await readNdjsonStream(response, (frame) => {
+                if (frame.type === 'delta') {
+                    replyText += frame.text;
+                    appendToReply(frame.text);
+                } else if (frame.type === 'final') {
+                    finalFrame = frame;
+                }
+            });
+
+            if (finalFrame) {
+                displaySuggestedActions(finalFrame.suggested_actions);
+                replyText = finalFrame.reply.text;
             }
+
+            // The stream does not echo the whole history back; track the reply locally
+            conversationHistory.push({
+                role: "assistant",
+                content: replyText,
+                timestamp: finalFrame ? finalFrame.reply.timestamp : new Date().toISOString()
+            });
             
         } catch (error) {
             console.error('Fetch Error:', error);
@@ -0,0 +1,22 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import db_utils  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A migrated copy of the bundled database, used by every db_utils call in the test."""
+    path = str(tmp_path / "CartonCapsData.sqlite")
+    shutil.copy(os.path.join(REPO_DIR, "data", "CartonCapsData.sqlite"), path)
+    db_utils.close_connection_pool()
+    monkeypatch.setattr(db_utils, "DATABASE_PATH", path)
+    db_utils.apply_migrations()
+    yield path
+    db_utils.close_connection_pool()
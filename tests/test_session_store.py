@@ -0,0 +1,62 @@
+import asyncio
+import datetime
+from dataclasses import dataclass
+from typing import Any, Dict
+
+from db_utils import save_conversation_messages
+from prompt_builder import RollingSummary
+from session_store import SharedSessionStore
+
+START = datetime.datetime(2026, 1, 1, 12, 0, 0)
+
+
+@dataclass
+class Message:
+    role: str
+    content: str
+    timestamp: datetime.datetime
+
+
+def message_from_row(row: Dict[str, Any]) -> Message:
+    return Message(role="assistant" if row["role"] == "bot" else "user", content=row["content"], timestamp=row["timestamp"])
+
+
+def at(minutes: int) -> datetime.datetime:
+    return START + datetime.timedelta(minutes=minutes)
+
+
+def test_rehydrated_session_keeps_earlier_messages_after_append(database):
+    # Turns written before a restart (or before the window expired) exist only in Conversation_History
+    save_conversation_messages([
+        ("s1", "1", "user", "How do referrals work?", at(0)),
+        ("s1", "1", "bot", "Share your link.", at(1)),
+    ])
+    store = SharedSessionStore(message_from_row)
+
+    async def turn_after_restart():
+        history, summary = await store.get_session("s1", "1")
+        await store.append("s1", "1", [Message("user", "Thanks!", at(2)), Message("assistant", "Anytime.", at(3))])
+        return history, summary, await store.get_history("s1", "1")
+
+    rehydrated, summary, history = asyncio.run(turn_after_restart())
+
+    assert [m.content for m in rehydrated] == ["How do referrals work?", "Share your link."]
+    assert summary is None
+    assert [m.content for m in history] == ["How do referrals work?", "Share your link.", "Thanks!", "Anytime."]
+    assert [m.role for m in history] == ["user", "assistant", "user", "assistant"]
+    assert store.rehydrations == 1
+
+
+def test_get_session_returns_messages_and_summary_from_one_window(database):
+    store = SharedSessionStore(message_from_row)
+    summary = RollingSummary(("User asked about referrals.",), at(1))
+
+    async def two_turns():
+        await store.append("s2", "1", [Message("user", "Hi", at(0)), Message("assistant", "Hello!", at(1))], summary)
+        return await store.get_session("s2", "1")
+
+    history, stored_summary = asyncio.run(two_turns())
+
+    assert [m.content for m in history] == ["Hi", "Hello!"]
+    assert stored_summary == summary
+    assert store.hits == 1 and store.misses == 0
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, List, Dict, Any, Tuple, FrozenSet
+
+from db_utils import (get_user_details_async, get_user_purchase_summary_async, get_user_details_bulk_async,
+                      get_purchase_summaries_bulk_async, get_recently_active_user_ids_async,
+                      record_profile_invalidation_async, get_profile_invalidations_since_async)
+from workers import MULTI_WORKER
+
+logger = logging.getLogger(__name__)
+
+# --- User profile cache settings (overridable through environment variables) ---
+PROFILE_CACHE_MAX_ENTRIES = int(os.getenv("CARTON_CAPS_PROFILE_CACHE_MAX_ENTRIES", "50000"))
+PROFILE_CACHE_TTL_SECONDS = float(os.getenv("CARTON_CAPS_PROFILE_CACHE_TTL", "600"))
+PROFILE_PRELOAD_COUNT = int(os.getenv("CARTON_CAPS_PROFILE_PRELOAD", "1000"))  # Recently active users loaded at startup
+PROFILE_PURCHASE_SUMMARY_SIZE = 5
+
+
+@dataclass(frozen=True)
+class UserProfileRecord:
+    """A user's name and school plus their most purchased products, as cached between turns."""
+    user_id: str
+    found: bool  # False for user ids with no Users row (cached too, so unknown ids don't hit the DB every turn)
+    user_name: Optional[str] = None
+    school_id: Optional[int] = None
+    school_name: Optional[str] = None
+    purchases: Tuple[Dict[str, Any], ...] = ()  # product_id, product_name, total_quantity, last_purchased_at
+
+    @property
+    def favorite_product_ids(self) -> FrozenSet[int]:
+        return frozenset(purchase["product_id"] for purchase in self.purchases)
+
+    def purchase_summary(self) -> List[str]:
+        return [f"{purchase['product_name']} (x{purchase['total_quantity']})" for purchase in self.purchases]
+
+
+def _make_record(user_id: str, details: Optional[Dict[str, Any]], purchases: List[Dict[str, Any]]) -> UserProfileRecord:
+    if not details:
+        return UserProfileRecord(user_id=user_id, found=False)
+    return UserProfileRecord(
+        user_id=user_id,
+        found=True,
+        user_name=details.get("user_name"),
+        school_id=details.get("school_id"),
+        school_name=details.get("school_name"),
+        purchases=tuple(purchases),
+    )
+
+
+class UserProfileCache:
+    """
+    LRU/TTL cache of UserProfileRecords.
+
+    A miss loads the user's details and purchase summary (aggregated per product, served by the
+    Purchase_History user index) in parallel. `preload()` bulk-loads recently active users,
+    and `invalidate()` drops a user after their name, school or purchases change. With several
+    workers, `invalidate_everywhere()` also records the invalidation in the database, and each
+    worker's `sync_invalidations()` drops the profiles other workers invalidated.
+    """
+
+    def __init__(self, max_entries: int = PROFILE_CACHE_MAX_ENTRIES, ttl_seconds: float = PROFILE_CACHE_TTL_SECONDS,
+                 purchase_summary_size: int = PROFILE_PURCHASE_SUMMARY_SIZE):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.purchase_summary_size = purchase_summary_size
+        self._entries: "OrderedDict[str, Tuple[float, UserProfileRecord]]" = OrderedDict()  # user_id -> (stored_at, record)
+        self._lock = threading.Lock()
+        self._invalidations_seen: Dict[str, float] = {}  # user_id -> latest shared invalidation already applied
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.preloaded = 0
+
+    def _lookup(self, user_id: str) -> Optional[UserProfileRecord]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def _store(self, record: UserProfileRecord) -> None:
+        with self._lock:
+            self._entries[record.user_id] = (time.monotonic(), record)
+            self._entries.move_to_end(record.user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    async def get(self, user_id: str) -> UserProfileRecord:
+        record = self._lookup(user_id)
+        if record is not None:
+            self.hits += 1
+            return record
+        self.misses += 1
+        details, purchases = await asyncio.gather(
+            get_user_details_async(user_id),
+            get_user_purchase_summary_async(user_id, self.purchase_summary_size),
+        )
+        record = _make_record(user_id, details, purchases)
+        self._store(record)
+        return record
+
+    def invalidate(self, user_id: str) -> bool:
+        """Drops a cached profile; the next turn reloads it. Returns whether one was cached."""
+        with self._lock:
+            removed = self._entries.pop(user_id, None) is not None
+        if removed:
+            self.invalidations += 1
+        return removed
+
+    async def invalidate_everywhere(self, user_id: str) -> bool:
+        """Drops a cached profile in this worker and, with several workers, in the others at their next sync."""
+        if MULTI_WORKER:
+            invalidated_at = time.time()
+            if await record_profile_invalidation_async(user_id, invalidated_at):
+                self._invalidations_seen[user_id] = invalidated_at
+        return self.invalidate(user_id)
+
+    async def sync_invalidations(self) -> int:
+        """
+        Drops profiles invalidated by other workers. Every invalidation younger than the TTL is read
+        (older ones no longer matter: profiles cached before them have expired). Returns the number dropped.
+        """
+        rows = await get_profile_invalidations_since_async(time.time() - self.ttl_seconds)
+        dropped = 0
+        for user_id, invalidated_at in rows:
+            if invalidated_at > self._invalidations_seen.get(user_id, 0.0) and self.invalidate(user_id):
+                dropped += 1
+        self._invalidations_seen = dict(rows)
+        return dropped
+
+    def clear(self) -> None:
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    async def preload(self, user_ids: Optional[List[str]] = None, limit: int = PROFILE_PRELOAD_COUNT) -> int:
+        """Bulk-loads profiles (by default the `limit` most recently active users). Returns the number loaded."""
+        if user_ids is None:
+            if limit <= 0:
+                return 0
+            user_ids = await get_recently_active_user_ids_async(limit)
+        if not user_ids:
+            return 0
+        details, purchases = await asyncio.gather(
+            get_user_details_bulk_async(user_ids),
+            get_purchase_summaries_bulk_async(user_ids, self.purchase_summary_size),
+        )
+        for user_id in user_ids:
+            self._store(_make_record(user_id, details.get(user_id), purchases.get(user_id, [])))
+        self.preloaded += len(user_ids)
+        logger.info("Preloaded %d user profiles.", len(user_ids))
+        return len(user_ids)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "preloaded": self.preloaded,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# Shared instance used by the chat endpoint
+user_profile_cache = UserProfileCache()
@@ -0,0 +1,87 @@
+import logging
+import os
+from typing import Optional, IO
+
+try:
+    import fcntl
+except ImportError:  # Windows has no flock; serve with a single worker there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# --- Multi-worker settings (overridable through environment variables) ---
+# Worker processes serving the app. uvicorn and gunicorn take their worker count from
+# WEB_CONCURRENCY, so setting it configures the server and the app together.
+SERVER_WORKERS = int(os.getenv("CARTON_CAPS_WORKERS", os.getenv("WEB_CONCURRENCY", "1")))
+MULTI_WORKER = SERVER_WORKERS > 1
+# Files shared by the workers on a host (lock files, the recommendation index, the response cache)
+SHARED_STATE_DIR = os.getenv("CARTON_CAPS_SHARED_STATE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+# How often workers that do not maintain the indexes check for files rewritten by the one that does
+SHARED_STATE_POLL_SECONDS = float(os.getenv("CARTON_CAPS_SHARED_STATE_POLL", "10"))
+
+
+class FileLock:
+    """
+    Exclusive advisory lock (flock) on a file, shared by every process on the host. The OS drops
+    it when the holder exits, so a crashed worker never leaves it held. Without fcntl every
+    acquire succeeds.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file: Optional[IO[str]] = None
+        self._held = False
+
+    @property
+    def held(self) -> bool:
+        return self._held
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Takes the lock (waiting for it if `blocking`). Returns whether this process holds it."""
+        if self._held:
+            return True
+        if fcntl is not None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            lock_file = open(self.path, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            self._file = lock_file
+        self._held = True
+        return True
+
+    def release(self) -> None:
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._held = False
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.release()
+
+
+# Held for its lifetime by the one worker that builds and syncs the shared indexes
+maintenance_lock = FileLock(os.path.join(SHARED_STATE_DIR, ".maintenance.lock"))
+
+
+def is_maintainer() -> bool:
+    """
+    Whether this process runs the index builds, syncs and cache warmup: always with a single
+    worker, otherwise only the worker holding the maintenance lock. Workers keep trying, so
+    another one takes over if the maintainer exits.
+    """
+    if not MULTI_WORKER:
+        return True
+    if maintenance_lock.held:
+        return True
+    if maintenance_lock.acquire(blocking=False):
+        logger.info("Worker %d now maintains the shared indexes.", os.getpid())
+        return True
+    return False